@@ -0,0 +1,956 @@
+#!/usr/bin/env python
+
+#
+#   Copyright 2013 Markus Gronholm <markus@alshain.fi> / Alshain Oy
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+#
+# Micro benchmarks for the in-memory graph.
+#
+# Usage: python bench.py [name ...]
+#
+
+import sys, time, os, json, shutil, socket, subprocess, tempfile, threading, multiprocessing
+
+from libs.Hawthorn import (Edge, Node, Graph, QueryEngine)
+import libs.QuerySet as QuerySet
+import libs.RedisProtocol as RedisProtocol
+
+
+def _rate( count, elapsed ):
+	if elapsed <= 0:
+		return float( "inf" )
+	return count / elapsed
+
+
+def bench_connect():
+	# CONNECT throughput on a hub node as its degree grows. With the
+	# hash-indexed adjacency the rate should stay flat.
+	batch = 2000
+
+	for degree in [1000, 10000, 100000]:
+		graph = Graph()
+		hub = 1
+		graph.create( hub )
+		for i in range( 2, degree + batch + 2 ):
+			graph.create( i )
+
+		for i in range( 2, degree + 2 ):
+			graph.connect( hub, i, "link", "" )
+
+		started = time.time()
+		for i in range( degree + 2, degree + batch + 2 ):
+			graph.connect( hub, i, "link", "" )
+		connect_elapsed = time.time() - started
+
+		started = time.time()
+		for i in range( degree + 2, degree + batch + 2 ):
+			graph.disconnect( hub, i, "link" )
+		disconnect_elapsed = time.time() - started
+
+		print "connect    degree=%-7i %10.0f ops/s" % ( degree, _rate( batch, connect_elapsed ) )
+		print "disconnect degree=%-7i %10.0f ops/s" % ( degree, _rate( batch, disconnect_elapsed ) )
+
+
+def _legacy_forward( nodes, reverse_types, source_nodes, types ):
+	# FORWARD as it was before edges were partitioned by type: each node
+	# kept a plain list of [source, target, type_id, weight] edges, and
+	# every edge was expanded into a dict by get_forward_edges() and
+	# filtered afterwards.
+	result = []
+	for node in source_nodes:
+		out = []
+		for edge in nodes[ node ]:
+			type_value = reverse_types[ edge[ Edge.TYPE ] ]
+			out.append({"source": edge[ Edge.SOURCE ], "target": edge[ Edge.TARGET ], "type": type_value, "weight": edge[ Edge.WEIGHT ] })
+
+		for edge in out:
+			if edge["type"] in types:
+				result.append( edge["target"] )
+	return result
+
+
+def bench_traverse():
+	# FORWARD over one edge type on a graph where every node has edges
+	# of 24 different types.
+	node_count = 20000
+	type_count = 24
+	fanout = 2
+	rounds = 5
+
+	graph = Graph()
+	legacy_nodes = {}
+	for i in range( 1, node_count + 1 ):
+		graph.create( i )
+		legacy_nodes[i] = []
+
+	types = ["type%i" % t for t in range( type_count )]
+	for i in range( 1, node_count + 1 ):
+		for t in range( type_count ):
+			for k in range( fanout ):
+				target = ( i * 7 + t * 13 + k ) % node_count + 1
+				graph.connect( i, target, types[t], "" )
+				legacy_nodes[i].append( Edge.create( i, target, graph.types[ types[t] ], "" ) )
+
+	source_nodes = range( 1, node_count + 1 )
+	query = QueryEngine( graph )
+	query.start( "all", source_nodes )
+
+	started = time.time()
+	for i in range( rounds ):
+		expected = _legacy_forward( legacy_nodes, graph.reverse_types, source_nodes, ["type3"] )
+	legacy_elapsed = time.time() - started
+
+	started = time.time()
+	for i in range( rounds ):
+		query.forward( "all", "out", ["type3"] )
+	elapsed = time.time() - started
+
+	assert sorted( set( expected ) ) == list( query.querysets["out"] )
+
+	edges = node_count * type_count * fanout
+	print "%i nodes, %i edges, %i types" % ( node_count, edges, type_count )
+	print "before  %8.1f ms/FORWARD" % ( legacy_elapsed * 1000.0 / rounds )
+	print "after   %8.1f ms/FORWARD" % ( elapsed * 1000.0 / rounds )
+
+
+def _legacy_set_property( node, key_id, value ):
+	# Per-node list of (key_id, value) tuples, the layout used before
+	# properties were stored by column.
+	props = node[1]
+	for i in range( len( props ) ):
+		if props[i][0] == key_id:
+			props[i] = (key_id, value)
+			return
+	props.append( (key_id, value) )
+
+
+def _legacy_get_property( node, key_id ):
+	for entry in node[1]:
+		if entry[0] == key_id:
+			return entry[1]
+	return None
+
+
+def bench_properties():
+	# Memory and SET/FILTER throughput of the columnar property store
+	# against per-node tuple lists.
+	node_count = 200000
+	keys = ["name", "color", "created_at"]
+	values = ["v%i" % i for i in range( 100 )]
+
+	legacy = {}
+	for i in range( 1, node_count + 1 ):
+		legacy[i] = [i, [], {}, {}]
+
+	started = time.time()
+	for (key_id, key) in enumerate( keys ):
+		for i in range( 1, node_count + 1 ):
+			_legacy_set_property( legacy[i], key_id, values[ i % 100 ] )
+	legacy_set = time.time() - started
+
+	started = time.time()
+	legacy_hits = [i for i in legacy if _legacy_get_property( legacy[i], 2 ) == "v7"]
+	legacy_filter = time.time() - started
+
+	legacy_bytes = 0
+	for node in legacy.itervalues():
+		legacy_bytes += sys.getsizeof( node[1] )
+		for entry in node[1]:
+			legacy_bytes += sys.getsizeof( entry )
+
+	graph = Graph()
+	for i in range( 1, node_count + 1 ):
+		graph.create( i )
+
+	started = time.time()
+	for key in keys:
+		for i in range( 1, node_count + 1 ):
+			graph.set_property( i, key, values[ i % 100 ] )
+	column_set = time.time() - started
+
+	query = QueryEngine( graph )
+	query.start( "all", range( 1, node_count + 1 ) )
+	started = time.time()
+	query.filter( "all", "hits", "created_at", "v7", "=" )
+	column_filter = time.time() - started
+
+	assert sorted( legacy_hits ) == sorted( query.querysets["hits"] )
+
+	column_bytes = 0
+	for column in graph.columns.itervalues():
+		column_bytes += sys.getsizeof( column )
+
+	sets = node_count * len( keys )
+	print "%i nodes, %i keys" % ( node_count, len( keys ) )
+	print "tuple lists  %10.0f SET/s  %8.1f ms/FILTER  %8.1f MB" % ( _rate( sets, legacy_set ), legacy_filter * 1000.0, legacy_bytes / 1e6 )
+	print "columns      %10.0f SET/s  %8.1f ms/FILTER  %8.1f MB" % ( _rate( sets, column_set ), column_filter * 1000.0, column_bytes / 1e6 )
+
+
+def _adjacency_bytes( graph ):
+	# Rough size of the live adjacency: the per node bucket dicts and
+	# their edge order lists.
+	total = 0
+	for node in graph.nodes.itervalues():
+		for buckets in [node[ Node.FORWARD_EDGES ], node[ Node.BACKWARD_EDGES ]]:
+			total += sys.getsizeof( buckets )
+			for bucket in buckets.itervalues():
+				total += sum( map( sys.getsizeof, bucket ) )
+	return total
+
+
+def bench_csr():
+	# Three hop FORWARD traversal on the live graph and on its CSR
+	# snapshot, with every node having edges of every type and with many
+	# types that each only some nodes have.
+	node_count = 50000
+	hops = 3
+	rounds = 3
+
+	for (type_count, fanout, type_stride) in [(4, 5, 1), (24, 2, 6)]:
+		graph = Graph()
+		for i in range( 1, node_count + 1 ):
+			graph.create( i )
+
+		types = ["type%i" % t for t in range( type_count )]
+		edges = 0
+		for i in range( 1, node_count + 1 ):
+			for t in range( type_count ):
+				if ( i + t ) % type_stride:
+					continue
+				for k in range( fanout ):
+					target = ( i * 31 + t * 17 + k * 7919 ) % node_count + 1
+					graph.connect( i, target, types[t], "" )
+					edges += 1
+
+		def traverse():
+			query = QueryEngine( graph )
+			query.start( "q0", range( 1, 2001 ) )
+			for hop in range( hops ):
+				query.forward( "q%i" % hop, "q%i" % ( hop + 1 ), ["type1", "type2"] )
+			return query.querysets[ "q%i" % hops ]
+
+		started = time.time()
+		for i in range( rounds ):
+			expected = traverse()
+		live_elapsed = time.time() - started
+
+		started = time.time()
+		graph.freeze()
+		build_elapsed = time.time() - started
+
+		started = time.time()
+		for i in range( rounds ):
+			result = traverse()
+		csr_elapsed = time.time() - started
+
+		assert expected == result
+
+		print "%i nodes, %i edges, %i types, %i hops, %i results" % ( node_count, edges, type_count, hops, len( result ) )
+		print "live  %8.1f ms/query  ~%6.1f MB adjacency" % ( live_elapsed * 1000.0 / rounds, _adjacency_bytes( graph ) / 1e6 )
+		print "csr   %8.1f ms/query   %6.1f MB adjacency, built in %.1f ms" % ( csr_elapsed * 1000.0 / rounds, graph.csr.nbytes() / 1e6, build_elapsed * 1000.0 )
+
+
+def bench_querysets():
+	# Set operations on querysets of a million ids, as plain lists
+	# converted through set() and as sorted id arrays.
+	import random
+	random.seed( 1 )
+
+	size = 1000000
+	ids0 = [random.randint( 1, 4 * size ) for i in range( size )]
+	ids1 = [random.randint( 1, 4 * size ) for i in range( size )]
+
+	def run( name, fn ):
+		started = time.time()
+		result = fn()
+		print "%-28s %8.1f ms  (%i ids)" % ( name, ( time.time() - started ) * 1000.0, len( result ) )
+
+	run( "list union", lambda: list( set( ids0 ).union( set( ids1 ) ) ) )
+	run( "list intersection", lambda: list( set( ids0 ).intersection( set( ids1 ) ) ) )
+	run( "list difference", lambda: list( set( ids0 ).difference( set( ids1 ) ) ) )
+
+	set0 = QuerySet.from_ids( ids0 )
+	set1 = QuerySet.from_ids( ids1 )
+
+	backends = [("array", None)]
+	if QuerySet.numpy is not None:
+		backends.append( ("numpy", QuerySet.numpy) )
+
+	for (name, numpy) in backends:
+		saved = QuerySet.numpy
+		QuerySet.numpy = numpy
+		run( "%s union" % name, lambda: QuerySet.union( set0, set1 ) )
+		run( "%s intersection" % name, lambda: QuerySet.intersection( set0, set1 ) )
+		run( "%s difference" % name, lambda: QuerySet.difference( set0, set1 ) )
+		QuerySet.numpy = saved
+
+	multiset = QuerySet.append( set0, set1 )
+	run( "array unique", lambda: QuerySet.unique( multiset ) )
+
+	small = ids0[:20000]
+	def list_unique():
+		result = []
+		for node in small:
+			if node not in result:
+				result.append( node )
+		return result
+	run( "list unique (20k ids)", list_unique )
+
+	list_bytes = sys.getsizeof( ids0 ) + sum( sys.getsizeof( node_id ) for node_id in set( ids0 ) )
+	print "memory: list %.1f MB, array %.1f MB" % ( list_bytes / 1e6, set0.itemsize * len( set0 ) / 1e6 )
+
+
+def bench_lazy():
+	# FORWARD -> FILTER (keeps ~1%) -> INTERSECTION, eagerly storing every
+	# intermediate queryset and as one fused lazy pipeline.
+	node_count = 200000
+	fanout = 4
+	rounds = 3
+
+	graph = Graph()
+	for i in range( 1, node_count + 1 ):
+		graph.create( i )
+		graph.set_property( i, "bucket", str( i % 100 ) )
+
+	for i in range( 1, node_count + 1 ):
+		for k in range( fanout ):
+			graph.connect( i, ( i * 7919 + k * 104729 ) % node_count + 1, "link", "" )
+
+	def pipeline( lazy ):
+		query = QueryEngine( graph )
+		query.set_lazy( lazy )
+		query.start( "all", range( 1, node_count + 1 ) )
+		query.start( "third", range( 1, node_count + 1, 3 ) )
+		query.forward( "all", "out", ["link"] )
+		query.filter( "out", "hit", "bucket", "42", "=" )
+		query.intersection( "hit", "third", "result" )
+		return list( query.fetch( "result" )[1] )
+
+	results = {}
+	for lazy in [False, True]:
+		started = time.time()
+		for i in range( rounds ):
+			results[lazy] = pipeline( lazy )
+		elapsed = time.time() - started
+		print "%-6s %8.1f ms/pipeline  (%i ids)" % ( "lazy" if lazy else "eager", elapsed * 1000.0 / rounds, len( results[lazy] ) )
+
+	assert results[False] == results[True]
+
+
+class _Feed( object ):
+	# Socket stand-in that hands out a byte string in pieces of at most
+	# 64 kB, like a TCP receive would.
+	def __init__( self, data ):
+		self.data = data
+		self.pos = 0
+	
+	def recv( self, size ):
+		size = min( size, 65536 )
+		chunk = self.data[ self.pos:self.pos + size ]
+		self.pos += len( chunk )
+		return chunk
+	
+	def recv_into( self, view ):
+		chunk = self.recv( len( view ) )
+		view[ :len( chunk ) ] = chunk
+		return len( chunk )
+
+
+class _LegacyProtocol( object ):
+	# The multibulk parser before the offset based rewrite: 1 kB reads
+	# appended to a string that is split again for every element.
+	def __init__( self, conn ):
+		self.conn = conn
+		self.buf = ""
+	
+	def _recv( self ):
+		chunk = self.conn.recv( 1024 )
+		if len( chunk ) < 1:
+			raise IOError
+		self.buf += chunk
+	
+	def _line( self ):
+		while '\r\n' not in self.buf:
+			self._recv()
+		(line, self.buf) = self.buf.split( "\r\n", 1 )
+		return line
+	
+	def receive( self ):
+		out = []
+		for i in range( int( self._line()[1:] ) ):
+			next_bytes = int( self._line()[1:] )
+			while len( self.buf ) < next_bytes + 2:
+				self._recv()
+			out.append( self._line() )
+		return out
+
+
+def bench_protocol():
+	# Parsing a START request with a growing number of ids, best of three.
+	rounds = 3
+	
+	for count in [1000, 10000, 100000]:
+		request = ["START", "q"] + [str( i ) for i in range( count )]
+		data = "".join( RedisProtocol.RedisProtocol( None )._pack_list( request ) )
+		
+		for (name, parser) in [("legacy", _LegacyProtocol), ("offsets", RedisProtocol.RedisProtocol)]:
+			best = None
+			for i in range( rounds ):
+				started = time.time()
+				result = parser( _Feed( data ) ).receive()
+				elapsed = time.time() - started
+				if best is None or elapsed < best:
+					best = elapsed
+			
+			assert result == request
+			print "%-8s %6i ids %8.1f ms %8.1f MB/s" % ( name, count, best * 1000.0, _rate( len( data ), best ) / 1e6 )
+
+
+def _legacy_pack_list( data ):
+	# The reply encoder before the streaming rewrite, for flat lists.
+	out = "*%i\r\n" % len( data )
+	for entry in data:
+		if isinstance( entry, int ):
+			out += ":%i\r\n" % entry
+		else:
+			out += "$%i\r\n" % len( str(entry) )
+			out += "%s\r\n" % str( entry )
+	return out
+
+
+class _Sink( object ):
+	# Socket stand-in that records when the first byte was written.
+	def __init__( self ):
+		self.first = None
+		self.size = 0
+	
+	def sendall( self, data ):
+		if self.first is None:
+			self.first = time.time()
+		self.size += len( data )
+
+
+def bench_encoder():
+	# Encoding a FETCH reply of a million ids and of 100k strings.
+	replies = [
+		("1M ids", range( 1000000 )),
+		("100k strings", ["node%i" % i for i in range( 100000 )]),
+		]
+	
+	for (name, reply) in replies:
+		started = time.time()
+		sink = _Sink()
+		sink.sendall( _legacy_pack_list( reply ) )
+		legacy_elapsed = time.time() - started
+		
+		started = time.time()
+		streamed = _Sink()
+		RedisProtocol.RedisProtocol( streamed ).send_response( reply )
+		elapsed = time.time() - started
+		
+		assert sink.size == streamed.size
+		print "%-13s legacy %8.1f ms    streaming %8.1f ms, first byte after %6.2f ms" % ( name, legacy_elapsed * 1000.0, elapsed * 1000.0, ( streamed.first - started ) * 1000.0 )
+
+
+def _start_server( directory, settings = {} ):
+	# Runs hawthorn.py on a free port with its log in directory and
+	# settings added to its configuration.
+	probe = socket.socket()
+	probe.bind( ("127.0.0.1", 0) )
+	port = probe.getsockname()[1]
+	probe.close()
+	
+	config = {
+		"host": "127.0.0.1",
+		"port": port,
+		"database": os.path.join( directory, "append.log" ),
+		"replication": {"hosts": []},
+		}
+	config.update( settings )
+	filename = os.path.join( directory, "config.json" )
+	with open( filename, "w" ) as handle:
+		json.dump( config, handle )
+	
+	script = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "hawthorn.py" )
+	with open( os.devnull, "w" ) as devnull:
+		server = subprocess.Popen( [sys.executable, script, filename], stdout = devnull )
+	
+	from libs.HawthornProtocol import HawthornClient
+	for i in range( 100 ):
+		try:
+			return (server, HawthornClient( "127.0.0.1", config["port"] ))
+		except socket.error:
+			time.sleep( 0.1 )
+	
+	server.kill()
+	raise IOError( "Server did not start." )
+
+
+def bench_bulk():
+	# Loading nodes, one property per node and two edges per node through
+	# HawthornClient, one command per item and in batches.
+	batch = 1000
+	
+	for (name, node_count) in [("single", 5000), ("batched", 100000)]:
+		directory = tempfile.mkdtemp()
+		(server, client) = _start_server( directory )
+		try:
+			started = time.time()
+			if name == "single":
+				for i in range( 1, node_count + 1 ):
+					client.create( i )
+				for i in range( 1, node_count + 1 ):
+					client.set( i, "name", "node%i" % i )
+				for i in range( 1, node_count + 1 ):
+					client.connect( i, i % node_count + 1, "next", "" )
+					client.connect( i, ( i * 7 ) % node_count + 1, "jump", "" )
+			else:
+				for offset in range( 1, node_count + 1, batch ):
+					client.mcreate( range( offset, offset + batch ) )
+				for offset in range( 1, node_count + 1, batch ):
+					client.mset( [(i, "name", "node%i" % i) for i in range( offset, offset + batch )] )
+				for offset in range( 1, node_count + 1, batch ):
+					edges = []
+					for i in range( offset, offset + batch ):
+						edges.append( (i, i % node_count + 1, "next", "") )
+						edges.append( (i, ( i * 7 ) % node_count + 1, "jump", "") )
+					client.mconnect( edges )
+			elapsed = time.time() - started
+			
+			assert client.get( node_count )["properties"]["name"] == "node%i" % node_count
+		finally:
+			client.close()
+			server.kill()
+			server.wait()
+			shutil.rmtree( directory )
+		
+		items = node_count * 4
+		print "%-8s %7i nodes %10.0f items/s" % ( name, node_count, _rate( items, elapsed ) )
+
+
+def bench_pipeline():
+	# CREATE + SET + GET per node, one round trip per command and
+	# pipelined.
+	node_count = 5000
+	
+	directory = tempfile.mkdtemp()
+	(server, client) = _start_server( directory )
+	try:
+		started = time.time()
+		for i in range( 1, node_count + 1 ):
+			client.create( i )
+			client.set( i, "name", "node%i" % i )
+			client.get( i )
+		single_elapsed = time.time() - started
+		
+		started = time.time()
+		with client.pipeline() as pipe:
+			for i in range( node_count + 1, 2 * node_count + 1 ):
+				pipe.create( i )
+				pipe.set( i, "name", "node%i" % i )
+				pipe.get( i )
+		pipelined_elapsed = time.time() - started
+		
+		assert pipe.results[-1] == {"id": 2 * node_count, "properties": {"name": "node%i" % ( 2 * node_count )}}
+	finally:
+		client.close()
+		server.kill()
+		server.wait()
+		shutil.rmtree( directory )
+	
+	commands = node_count * 3
+	print "single     %10.0f commands/s" % _rate( commands, single_elapsed )
+	print "pipelined  %10.0f commands/s" % _rate( commands, pipelined_elapsed )
+
+
+def _restart( directory, settings = {} ):
+	started = time.time()
+	(server, client) = _start_server( directory, settings )
+	try:
+		node = client.get( 1 )
+		elapsed = time.time() - started
+	finally:
+		client.close()
+		server.kill()
+		server.wait()
+	return (node, elapsed)
+
+def bench_restart():
+	# Server start up time with the whole log to replay and with a
+	# snapshot of it.
+	node_count = 100000
+	batch = 1000
+	
+	directory = tempfile.mkdtemp()
+	try:
+		(server, client) = _start_server( directory )
+		try:
+			for offset in range( 1, node_count + 1, batch ):
+				ids = range( offset, offset + batch )
+				client.mcreate( ids )
+				client.mset( [(i, "name", "node%i" % i) for i in ids] )
+				client.mconnect( [(i, i % node_count + 1, "next", "") for i in ids] )
+			client.snapshot()
+		finally:
+			client.close()
+			server.kill()
+			server.wait()
+		
+		snapshot = os.path.join( directory, "append.log.snapshot" )
+		os.rename( snapshot, snapshot + ".saved" )
+		(replayed, replay_elapsed) = _restart( directory )
+		
+		os.rename( snapshot + ".saved", snapshot )
+		(restored, snapshot_elapsed) = _restart( directory )
+		
+		assert replayed == restored
+	finally:
+		shutil.rmtree( directory )
+	
+	print "replay     %7.2f s" % replay_elapsed
+	print "snapshot   %7.2f s" % snapshot_elapsed
+
+
+def _set_nodes( client, node_ids, latencies ):
+	for node_id in node_ids:
+		started = time.time()
+		client.set( node_id, "name", "node%i" % node_id )
+		latencies.append( time.time() - started )
+
+def bench_durability():
+	# SET latency with one client and throughput with several concurrent
+	# clients under each fsync policy.
+	client_count = 8
+	node_count = 2000
+	
+	from libs.HawthornProtocol import HawthornClient
+	
+	for (policy, interval) in [("os", None), ("interval", 0.1), ("always", None)]:
+		directory = tempfile.mkdtemp( dir = os.path.dirname( os.path.abspath( __file__ ) ) )
+		(server, client) = _start_server( directory, {"durability": {"fsync": policy, "interval": interval}} )
+		clients = []
+		try:
+			client.mcreate( range( 1, node_count + 1 ) )
+			
+			latencies = []
+			_set_nodes( client, range( 1, node_count + 1 ), latencies )
+			latencies.sort()
+			
+			clients = [HawthornClient( "127.0.0.1", client.port ) for i in range( client_count )]
+			threads = []
+			for (i, other) in enumerate( clients ):
+				node_ids = range( i + 1, node_count + 1, client_count )
+				threads.append( threading.Thread( target = _set_nodes, args = (other, node_ids, []) ) )
+			
+			started = time.time()
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			elapsed = time.time() - started
+		finally:
+			for other in clients:
+				other.close()
+			client.close()
+			server.kill()
+			server.wait()
+			shutil.rmtree( directory )
+		
+		average = sum( latencies ) / len( latencies )
+		p99 = latencies[ int( len( latencies ) * 0.99 ) ]
+		print "%-9s avg %7.3f ms  p99 %7.3f ms  %8.0f sets/s with %i clients" % ( policy, average * 1000, p99 * 1000, _rate( node_count, elapsed ), client_count )
+
+
+def _find_loop( port, running, finds ):
+	# Runs in a process of its own, so that it doesn't hold the GIL of
+	# the process measuring GETs. No name sorts before "a", so every FIND
+	# scans the whole column and the replies stay small.
+	from libs.HawthornProtocol import HawthornClient
+	client = HawthornClient( "127.0.0.1", port )
+	while running.is_set():
+		client.find( "none", "name", "a", "<" )
+		finds.value += 1
+	client.close()
+
+def bench_slicing():
+	# GET latency on one connection while another connection runs FINDs
+	# over the whole graph, without and with time slices.
+	node_count = 300000
+	duration = 5.0
+
+	for time_slice in [None, 0.005, 0.001]:
+		settings = {}
+		if time_slice:
+			settings = {"scheduling": {"time_slice": time_slice}}
+
+		directory = tempfile.mkdtemp()
+		(server, client) = _start_server( directory, settings )
+		try:
+			node_ids = range( 1, node_count + 1 )
+			for offset in xrange( 0, node_count, 10000 ):
+				chunk = node_ids[ offset:offset + 10000 ]
+				client.mcreate( chunk )
+				client.mset( [(node_id, "name", "node%i" % node_id) for node_id in chunk] )
+
+			running = multiprocessing.Event()
+			running.set()
+			finds = multiprocessing.Value( "i", 0 )
+			scanner = multiprocessing.Process( target = _find_loop, args = (client.port, running, finds) )
+			scanner.start()
+			time.sleep( 0.5 )
+
+			latencies = []
+			started = time.time()
+			while time.time() - started < duration:
+				sent = time.time()
+				client.get( 1 )
+				latencies.append( time.time() - sent )
+			elapsed = time.time() - started
+
+			running.clear()
+			scanner.join()
+		finally:
+			client.close()
+			server.kill()
+			server.wait()
+			shutil.rmtree( directory )
+
+		latencies.sort()
+		p50 = latencies[ len( latencies ) // 2 ]
+		p99 = latencies[ int( len( latencies ) * 0.99 ) ]
+		label = "off"
+		if time_slice:
+			label = "%.3f s" % time_slice
+		print "slice %-8s %6i GETs  p50 %7.2f ms  p99 %8.2f ms  max %8.2f ms  %4.2f FIND/s" % ( label, len( latencies ), p50 * 1000, p99 * 1000, latencies[-1] * 1000, finds.value / elapsed )
+
+
+def bench_isolation():
+	# Writes while queries hold pinned versions of the graph, and queryset
+	# commands reading through a version instead of the live graph.
+	import random
+	random.seed( 1 )
+
+	node_count = 100000
+	write_count = 20000
+
+	def build():
+		graph = Graph()
+		for node_id in xrange( 1, node_count + 1 ):
+			graph.create( node_id )
+			graph.set_property( node_id, "name", "node%i" % node_id )
+		for i in xrange( node_count * 10 ):
+			graph.connect( random.randint( 1, node_count ), random.randint( 1, node_count ), "link", "" )
+		return graph
+
+	graph = build()
+	writes = [(random.randint( 1, node_count ), random.randint( 1, node_count )) for i in xrange( write_count )]
+
+	for pin_every in [None, 1000, 100]:
+		queries = []
+		started = time.time()
+		for (i, (source, target)) in enumerate( writes ):
+			if pin_every and i % pin_every == 0:
+				# The last few queries keep their versions.
+				queries = queries[-4:] + [QueryEngine( graph, isolated = True )]
+				queries[-1].start( "a", [source] )
+			graph.connect( source, target, "link", "" )
+			graph.set_property( target, "name", "renamed%i" % i )
+		elapsed = time.time() - started
+
+		saved = 0
+		for ref in graph.versions:
+			saved += len( ref().saved_nodes ) + sum( len( values ) for values in ref().saved_values.itervalues() )
+		label = "no pins"
+		if pin_every:
+			label = "pin/%i writes" % pin_every
+		print "%-18s %8.0f writes/s  %2i versions  %6i saved entries" % ( label, _rate( write_count, elapsed ), len( graph.versions ), saved )
+
+		del queries
+		print "%-18s %8s versions left after the queries end: %i" % ( "", "", len( graph.versions ) )
+
+	start_ids = random.sample( xrange( 1, node_count + 1 ), 20000 )
+	for isolated in [False, True]:
+		query = QueryEngine( graph, isolated = isolated )
+		query.start( "a", start_ids )
+		for i in xrange( write_count ):
+			graph.set_property( random.randint( 1, node_count ), "name", "node%i" % i )
+
+		started = time.time()
+		query.forward( "a", "b", ["link"] )
+		query.filter( "b", "c", "name", "node", "PREFIX" )
+		elapsed = time.time() - started
+		label = "live graph"
+		if isolated:
+			label = "pinned version"
+		print "%-18s FORWARD + FILTER %7.1f ms  (%i ids)" % ( label, elapsed * 1000.0, len( query.querysets["c"] ) )
+		del query
+
+
+def bench_replay():
+	# Writing a log of single commands through AppendLogStorage.save, its
+	# size, and server start up time replaying it, for each log format
+	# and with the JSON log decoded in a worker process.
+	import libs.Storage as Storage
+	
+	node_count = 100000
+	commands = []
+	for i in range( 1, node_count + 1 ):
+		commands.append( ("CREATE", [str( i )]) )
+	for i in range( 1, node_count + 1 ):
+		commands.append( ("SET", [str( i ), "name", "node%i" % i]) )
+	for i in range( 1, node_count + 1 ):
+		commands.append( ("CONNECT", [str( i ), str( i % node_count + 1 ), "next", ""]) )
+	
+	for (log_format, workers) in [("json", 0), ("json", 1), ("binary", 0)]:
+		directory = tempfile.mkdtemp()
+		try:
+			storage = Storage.AppendLogStorage( os.path.join( directory, "append.log" ), log_format = log_format )
+			started = time.time()
+			for (op, params) in commands:
+				storage.save( op, params )
+			storage.handle.close()
+			write_elapsed = time.time() - started
+			size = os.path.getsize( storage.filename )
+			
+			settings = {"database_format": log_format, "replay": {"workers": workers}}
+			(node, elapsed) = _restart( directory, settings )
+			assert node["properties"]["name"] == "node1"
+		finally:
+			shutil.rmtree( directory )
+		
+		print "%-6s %i workers  write %8.0f records/s  %9i bytes  start up %5.2f s  %8.0f records/s" % ( log_format, workers, _rate( len( commands ), write_elapsed ), size, elapsed, _rate( len( commands ), elapsed ) )
+
+
+def bench_replication():
+	# SETs on a primary with one replica: the rate the primary answers
+	# them at and the time until the replica has applied all of them.
+	node_count = 5000
+	
+	replica_directory = tempfile.mkdtemp()
+	primary_directory = tempfile.mkdtemp()
+	(replica_server, replica) = _start_server( replica_directory )
+	try:
+		replication = {"hosts": ["127.0.0.1:%i" % replica.port]}
+		(primary_server, primary) = _start_server( primary_directory, {"replication": replication} )
+		try:
+			primary.mcreate( range( 1, node_count + 1 ) )
+			
+			started = time.time()
+			for i in range( 1, node_count + 1 ):
+				primary.set( i, "name", "node%i" % i )
+			elapsed = time.time() - started
+			
+			while ( replica.get( node_count )["properties"] or {} ).get( "name" ) != "node%i" % node_count:
+				time.sleep( 0.001 )
+			replicated_elapsed = time.time() - started
+		finally:
+			primary.close()
+			primary_server.kill()
+			primary_server.wait()
+	finally:
+		replica.close()
+		replica_server.kill()
+		replica_server.wait()
+		shutil.rmtree( replica_directory )
+		shutil.rmtree( primary_directory )
+	
+	print "primary    %8.0f sets/s" % _rate( node_count, elapsed )
+	print "replicated %8.0f sets/s" % _rate( node_count, replicated_elapsed )
+
+def _catch_up( primary, node_id ):
+	# SETs on the primary until its replica has caught up; returns the
+	# time it took and the number of SETs answered meanwhile.
+	started = time.time()
+	count = 0
+	while True:
+		primary.set( node_id, "name", "set%i" % count )
+		count += 1
+		status = primary.replication()[0]
+		if status["state"] == "connected" and status["queued"] == 0:
+			return (time.time() - started, count)
+
+def bench_join():
+	# A replica joining a running primary, which keeps answering SETs:
+	# first from a dump of the graph, then, after the replica has been
+	# down, from the log.
+	node_count = 100000
+
+	replica_directory = tempfile.mkdtemp()
+	primary_directory = tempfile.mkdtemp()
+	(primary_server, primary) = _start_server( primary_directory )
+	try:
+		node_ids = range( 1, node_count + 1 )
+		primary.mcreate( node_ids )
+		primary.mset( [(node_id, "name", "node%i" % node_id) for node_id in node_ids] )
+
+		(replica_server, replica) = _start_server( replica_directory )
+		port = replica.port
+		replica.close()
+		primary.add_replica( "127.0.0.1:%i" % port )
+		(dump_elapsed, dump_sets) = _catch_up( primary, 1 )
+
+		replica_server.kill()
+		replica_server.wait()
+		for offset in xrange( 0, node_count, 1000 ):
+			primary.mset( [(node_id, "name", "again%i" % node_id) for node_id in node_ids[ offset:offset + 1000 ]] )
+
+		(replica_server, replica) = _start_server( replica_directory, {"port": port} )
+		replica.close()
+		(log_elapsed, log_sets) = _catch_up( primary, 1 )
+		replica_server.kill()
+		replica_server.wait()
+	finally:
+		primary.close()
+		primary_server.kill()
+		primary_server.wait()
+		shutil.rmtree( replica_directory )
+		shutil.rmtree( primary_directory )
+
+	print "dump %8.2f s (%i nodes, %i sets answered meanwhile)" % ( dump_elapsed, node_count, dump_sets )
+	print "log  %8.2f s (%i nodes set again, %i sets answered meanwhile)" % ( log_elapsed, node_count, log_sets )
+
+
+BENCHMARKS = {
+	"join": bench_join,
+	"replication": bench_replication,
+	"replay": bench_replay,
+	"durability": bench_durability,
+	"restart": bench_restart,
+	"isolation": bench_isolation,
+	"slicing": bench_slicing,
+	"pipeline": bench_pipeline,
+	"bulk": bench_bulk,
+	"encoder": bench_encoder,
+	"protocol": bench_protocol,
+	"lazy": bench_lazy,
+	"querysets": bench_querysets,
+	"csr": bench_csr,
+	"properties": bench_properties,
+	"connect": bench_connect,
+	"traverse": bench_traverse,
+	}
+
+
+if __name__ == "__main__":
+	names = sys.argv[1:]
+	if not names:
+		names = sorted( BENCHMARKS.keys() )
+
+	for name in names:
+		if name not in BENCHMARKS:
+			print "Unknown benchmark '%s'." % name
+			continue
+		print "== %s ==" % name
+		BENCHMARKS[name]()
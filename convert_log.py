@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+#   Copyright 2013 Markus Gronholm <markus@alshain.fi> / Alshain Oy
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Converts the database of a stopped server to another log format:
+#
+#   convert_log.py config.json [json|binary]
+#
+# The format defaults to database_format of the configuration.
+
+import json, os, sys
+
+from libs.Hawthorn import Graph
+import libs.Storage as Storage
+
+
+class Database( object ):
+	# The part of Hawthorn that AppendLogStorage.load uses.
+	def __init__( self ):
+		self.graphs = {}
+		for i in range( 16 ):
+			self.graphs[i] = Graph()
+		self.upstream = ["", -1]
+
+	def start_query( self, db_id ):
+		return db_id
+
+	def execute( self, qid, command ):
+		if command[0] == "OFFSET":
+			self.upstream = command[1:]
+			return (True, "OK")
+		raise ValueError( "Unknown command '%s' in the log." % command[0] )
+
+	def end_query( self, qid ):
+		pass
+
+
+def _size( filename ):
+	if not os.path.exists( filename ):
+		return 0
+	return os.path.getsize( filename )
+
+
+if len( sys.argv ) not in [2, 3]:
+	print "Usage: %s config.json [%s]" % ( sys.argv[0], "|".join( Storage.LOG_FORMATS ) )
+	sys.exit( 1 )
+
+with open( sys.argv[1], 'r' ) as handle:
+	config = json.load( handle )
+
+log_format = config.get( "database_format", "json" )
+if len( sys.argv ) > 2:
+	log_format = sys.argv[2]
+
+if log_format not in Storage.LOG_FORMATS:
+	print "Unknown log format '%s'." % log_format
+	sys.exit( 1 )
+
+storage = Storage.AppendLogStorage( config["database"] )
+before = _size( storage.filename )
+storage.convert( Database(), log_format )
+
+print "Converted %s to %s: %i -> %i bytes." % ( storage.filename, log_format, before, _size( storage.filename ) )
@@ -21,77 +21,311 @@ import sys
 import gevent
 from gevent.server import StreamServer
 import gevent.socket
+import gevent.event
 
 import collections
+import time
 
 import json
 
 import libs.RedisProtocol as RedisProtocol
 from libs.Hawthorn import (Edge, Node, Graph, QueryEngine)
 import libs.Storage as Storage
-import libs.HawthornProtocol as HawthornProtocol
+
+
+# What ReplicatedStorage does when a replica falls queue_size commands
+# behind:
+#   block   replies to writers are held back until the replica catches up
+#   detach  the queue of the replica is dropped; it catches up from the
+#           log once it has reconnected
+BACKPRESSURE_POLICIES = ["block", "detach"]
+
+# Seconds between attempts to connect to a replica.
+RECONNECT_INTERVAL = 1.0
+
+# Commands of a dump sent per round trip.
+SYNC_BATCH = 16
+
+
+class Replica( object ):
+	# The outbound queue of one replica. On connecting, the replica is
+	# asked for the last change it has applied (OFFSET) and sent what it is
+	# missing: the changes after it from the log, or, if the log no longer
+	# reaches back that far, a dump of the graph. After that a greenlet
+	# sends the queued changes in pipelined batches of up to batch_size
+	# commands, one round trip per batch, each batch ending with an OFFSET
+	# that records how far the replica has got. A replica whose connection
+	# breaks is reconnected and catches up the same way.
+	
+	def __init__( self, addr, queue_size, batch_size, log, db ):
+		self.addr = addr
+		(host, port) = addr.split(":")
+		self.host = host
+		self.port = int( port )
+		
+		self.queue_size = queue_size
+		self.batch_size = batch_size
+		
+		# The AppendLogStorage the changes are read back from, and the
+		# Hawthorn to dump.
+		self.log = log
+		self.db = db
+		
+		# (sequence, op, params, time queued) entries, oldest first.
+		self.queue = collections.deque()
+		self.in_flight = []
+		
+		# connecting, syncing (catching up) or connected; changes are
+		# queued from the start of syncing on.
+		self.state = "connecting"
+		self.conn = None
+		self.redis = None
+		self.removed = False
+		
+		# History of the log and sequence of the last change the replica
+		# has applied.
+		self.history = None
+		self.offset = -1
+		
+		self.sent = 0
+		self.errors = 0
+		self.syncs = 0
+		
+		# queued is set when the queue has commands, drained when it has
+		# room again.
+		self.queued = gevent.event.Event()
+		self.drained = gevent.event.Event()
+		self.drained.set()
+		
+		self.greenlet = gevent.spawn( self.run )
+	
+	def put( self, sequence, op, params ):
+		if self.state == "connecting":
+			return False
+		
+		self.queue.append( (sequence, op, params, time.time()) )
+		self.queued.set()
+		if len( self.queue ) >= self.queue_size:
+			self.drained.clear()
+		return True
+	
+	def full( self ):
+		return len( self.queue ) >= self.queue_size
+	
+	def lag( self ):
+		# Seconds since the oldest command not yet applied by the replica
+		# was queued.
+		if self.in_flight:
+			return time.time() - self.in_flight[0][3]
+		if self.queue:
+			return time.time() - self.queue[0][3]
+		return 0.0
+	
+	def status( self ):
+		return {
+			"addr": self.addr,
+			"state": self.state,
+			"offset": self.offset,
+			"queued": len( self.queue ) + len( self.in_flight ),
+			"lag": "%.3f" % self.lag(),
+			"sent": self.sent,
+			"errors": self.errors,
+			"syncs": self.syncs,
+			}
+	
+	def detach( self, reason ):
+		# Drops the connection and the queue; the replica catches up from
+		# the log when it is reconnected.
+		print "Replica %s detached: %s." % ( self.addr, reason )
+		self.state = "connecting"
+		self.queue.clear()
+		self.in_flight = []
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+		self.drained.set()
+	
+	def remove( self ):
+		self.removed = True
+		self.detach( "removed" )
+		self.queued.set()
+	
+	def _connect( self ):
+		try:
+			self.conn = gevent.socket.create_connection( (self.host, self.port) )
+		except gevent.socket.error:
+			return False
+		
+		self.redis = RedisProtocol.RedisProtocol( self.conn )
+		return True
+	
+	def _send( self, commands, offset = None ):
+		# Sends (op, params) commands pipelined, followed by OFFSET when
+		# offset is given.
+		if offset is not None:
+			commands = commands + [("OFFSET", [self.history, offset])]
+		
+		if self.conn is None:
+			raise IOError( "detached" )
+		
+		pieces = []
+		for (op, params) in commands:
+			pieces.extend( self.redis.pack( [op] + list( params ) ) )
+		self.conn.sendall( "".join( pieces ) )
+		
+		reply = None
+		for command in commands:
+			reply = self.redis.receive()
+			if reply is False:
+				raise IOError( "connection lost" )
+			
+			# Commands that failed on the primary fail here too.
+			if isinstance( reply, str ) and reply.startswith( "-" ):
+				self.errors += 1
+		
+		if offset is not None:
+			self.offset = offset
+		return reply
+	
+	def _sync( self ):
+		# Brings the replica up to the current sequence. Nothing yields
+		# between taking the position and starting to queue, so the queue
+		# continues right where the catch-up ends.
+		reply = self._send( [("UPSTREAM", [])] )
+		if reply != "OK":
+			raise IOError( "not accepted as upstream (%s)" % reply[1:] )
+		
+		reply = self._send( [("OFFSET", [])] )
+		if not isinstance( reply, list ) or len( reply ) != 2:
+			raise IOError( "invalid OFFSET reply (%s)" % reply )
+		(history, offset) = reply
+		
+		(self.history, sequence) = self.log.position()
+		self.state = "syncing"
+		
+		batches = None
+		if history == self.history:
+			batches = self.log.read_after( int( offset ), sequence )
+		
+		if batches is None:
+			# The replica is new, of another history, or further behind than
+			# the log reaches: it is rebuilt from a dump.
+			self.syncs += 1
+			commands = [("RESET", [])] + self.db.graphs[0].dump( self.batch_size )
+			for start in xrange( 0, len( commands ), SYNC_BATCH ):
+				self._send( commands[ start:start + SYNC_BATCH ] )
+			self._send( [], sequence )
+		else:
+			for records in batches:
+				for start in xrange( 0, len( records ), self.batch_size ):
+					batch = records[ start:start + self.batch_size ]
+					self._send( [(op, params) for (number, op, params) in batch], batch[-1][0] )
+			self._send( [], sequence )
+		
+		self.state = "connected"
+	
+	def run( self ):
+		while not self.removed:
+			if self.conn is None:
+				if not self._connect():
+					gevent.sleep( RECONNECT_INTERVAL )
+					continue
+				
+				try:
+					self._sync()
+				except (IOError, gevent.socket.error), e:
+					if self.conn is not None:
+						self.detach( str( e ) or "connection lost" )
+					gevent.sleep( RECONNECT_INTERVAL )
+				continue
+			
+			if not self.queue:
+				self.queued.clear()
+				self.queued.wait()
+				continue
+			
+			count = min( self.batch_size, len( self.queue ) )
+			self.in_flight = [self.queue.popleft() for i in xrange( count )]
+			try:
+				self._send( [(op, params) for (sequence, op, params, queued) in self.in_flight], self.in_flight[-1][0] )
+			except (IOError, gevent.socket.error), e:
+				if self.conn is not None:
+					self.detach( str( e ) or "connection lost" )
+				continue
+			
+			self.sent += len( self.in_flight )
+			self.in_flight = []
+			if not self.full():
+				self.drained.set()
 
 
 class ReplicatedStorage( Storage.HawthornStorage ):
-	def __init__( self, addrs ):
+	# Queues every change for each replica; see Replica. save never blocks,
+	# so the log, the graph and the replicas see changes in the same order;
+	# with the block policy, commit holds replies back instead. log is the
+	# AppendLogStorage that numbers the changes; it has to save each change
+	# before this does.
 	
+	def __init__( self, log, addrs, queue_size = 100000, batch_size = 1000, backpressure = "block" ):
+		if backpressure not in BACKPRESSURE_POLICIES:
+			raise ValueError( "Invalid backpressure policy (%s)." % backpressure )
+		
+		self.log = log
 		self.addrs = addrs
-		self.conns = []
-		for addr in self.addrs:
-			(host, port) = addr.split(":")
-			port = int(port)
-			self.conns.append( HawthornProtocol.HawthornClient( host, port ) )
+		self.queue_size = queue_size
+		self.batch_size = batch_size
+		self.backpressure = backpressure
+		self.replicas = []
+		self.db = None
 		self._suppress = False
 	
 	def suppress( self, value ):
 		self._suppress = value
 	
 	def load( self, db ):
-		pass
+		# Replicas start once the database is loaded.
+		self.db = db
+		for addr in self.addrs:
+			self.add_replica( addr )
 	
-	def save( self, op, params ):	
-		if self._suppress:
-			return
-		
-		if op == "CREATE":
-			node_id = params[0]
-			for conn in self.conns:
-				conn.create( node_id )
-		
-		elif op == "DELETE":
-			node_id = params[0]
-			for conn in self.conns:
-				conn.delete( node_id )
-		
-		elif op == "CONNECT":
-			source = params[0]
-			target = params[1]
-			edge_type = params[2]
-			weight = params[3]
-			for conn in self.conns:
-				conn.connect( source, target, edge_type, weight )
-		
-		elif op == "DISCONNECT":
-			source = params[0]
-			target = params[1]
-			edge_type = params[2]
-			for conn in self.conns:
-				conn.disconnect( source, target, edge_type )
-		
-		elif op == "SET":
-			node_id = params[0]
-			key = params[1]
-			value = params[2]
-			for conn in self.conns:
-				conn.set( node_id, key, value )
+	def add_replica( self, addr ):
+		if addr in [replica.addr for replica in self.replicas]:
+			return (False, "Replica (%s) already exists." % addr )
 		
-		elif op == "UNSET":
-			node_id = params[0]
-			key = params[1]
-			for conn in self.conns:
-				conn.unset( node_id, key )
+		try:
+			replica = Replica( addr, self.queue_size, self.batch_size, self.log, self.db )
+		except ValueError:
+			return (False, "Invalid replica address (%s), should be host:port." % addr )
 		
+		self.replicas.append( replica )
+		return (True, "OK")
+	
+	def remove_replica( self, addr ):
+		for replica in self.replicas:
+			if replica.addr == addr:
+				replica.remove()
+				self.replicas.remove( replica )
+				return (True, "OK")
+		return (False, "Replica (%s) not found." % addr )
+	
+	def save( self, op, params ):
+		if self._suppress or op == "OFFSET":
+			return
 		
+		sequence = self.log.sequence
+		for replica in self.replicas:
+			if replica.put( sequence, op, params ) and replica.full() and self.backpressure == "detach":
+				replica.detach( "%i commands behind" % len( replica.queue ) )
+	
+	def commit( self, changed = True ):
+		# Only replies to a connection that changed something wait for
+		# the replicas.
+		if changed and self.backpressure == "block":
+			for replica in self.replicas:
+				replica.drained.wait()
+	
+	def status( self ):
+		return [replica.status() for replica in self.replicas]
 	
 
 class MultiStorage( Storage.HawthornStorage ):
@@ -109,6 +343,49 @@ class MultiStorage( Storage.HawthornStorage ):
 	def save( self, op, params ):
 		for store in self.storages:
 			store.save( op, params )
+	
+	def snapshot( self, db ):
+		for store in self.storages:
+			store.snapshot( db )
+	
+	def compact( self, db ):
+		for store in self.storages:
+			store.compact( db )
+	
+	def commit( self, changed = True ):
+		for store in self.storages:
+			store.commit( changed )
+	
+	def sync( self ):
+		for store in self.storages:
+			store.sync()
+	
+	def status( self ):
+		status = []
+		for store in self.storages:
+			status.extend( store.status() )
+		return status
+	
+	def position( self ):
+		for store in self.storages:
+			position = store.position()
+			if position is not None:
+				return position
+		return None
+	
+	def add_replica( self, addr ):
+		for store in self.storages:
+			result = store.add_replica( addr )
+			if result is not None:
+				return result
+		return None
+	
+	def remove_replica( self, addr ):
+		for store in self.storages:
+			result = store.remove_replica( addr )
+			if result is not None:
+				return result
+		return None
 
 
 
@@ -142,6 +419,20 @@ def parse_int( value ):
 
 	
 
+# Batch mutations: parameters per item and which of them are node ids.
+BATCH_COMMANDS = {
+	"MCREATE": (1, [0]),
+	"MSET": (3, [0]),
+	"MCONNECT": (4, [0, 1]),
+	"MDISCONNECT": (3, [0, 1]),
+	}
+
+# Commands that change the graph; a read-only server only takes them from
+# its upstream.
+MUTATION_COMMANDS = ["CREATE", "DELETE", "SET", "UNSET", "CONNECT", "DISCONNECT", "INDEX", "RESET"] + BATCH_COMMANDS.keys()
+
+QUERYSET_COMMANDS = ["START", "FIND", "FORWARD", "BACKWARD", "EXPAND", "EXPAND-BACKWARD", "EXPAND-BOTH", "FILTER", "APPEND", "UNION", "INTERSECTION", "DIFFERENCE", "UNIQUE"]
+
 class Hawthorn( object ):
 	def __init__( self, storage, config ):
 		self.graphs = {}
@@ -153,6 +444,29 @@ class Hawthorn( object ):
 		
 		self.storage = storage
 		
+		# Long queryset operations give other connections a turn every
+		# time_slice seconds; see QueryEngine. They wait for gevent.idle(),
+		# as gevent.sleep( 0 ) would resume them before the sockets of the
+		# other connections are polled.
+		self.time_slice = config.get( "scheduling", {} ).get( "time_slice" )
+		
+		# Queryset commands read the graph as of the last START or FIND of
+		# their connection; see Graph.pin().
+		self.snapshot_isolation = config.get( "scheduling", {} ).get( "snapshot_isolation", False )
+		
+		# [history, sequence] of the last change applied from the primary
+		# when this server is a replica; see OFFSET.
+		self.upstream = ["", -1]
+		
+		# Peer host of each connection, and the connections that have
+		# declared themselves the upstream of this server (UPSTREAM).
+		self.peers = {}
+		self.upstream_queries = set()
+		
+		replica = config.get( "replica", {} )
+		self.read_only = replica.get( "read_only", False )
+		self.upstreams = replica.get( "upstreams", [] )
+		
 		self.storage.suppress( True )
 		self.storage.load( self )
 		self.storage.suppress( False )
@@ -162,7 +476,10 @@ class Hawthorn( object ):
 	
 	def start_query( self, db_id ):
 		qid = self.next_query_id
-		self.queries[ qid ] = QueryEngine( self.graphs[ db_id ] )
+		if self.time_slice:
+			self.queries[ qid ] = QueryEngine( self.graphs[ db_id ], gevent.idle, self.time_slice, self.snapshot_isolation )
+		else:
+			self.queries[ qid ] = QueryEngine( self.graphs[ db_id ], isolated = self.snapshot_isolation )
 		
 		self.next_query_id += 1
 		return qid
@@ -170,6 +487,9 @@ class Hawthorn( object ):
 	def end_query( self, qid ):
 		if qid in self.queries:
 			del self.queries[qid]
+		
+		self.peers.pop( qid, None )
+		self.upstream_queries.discard( qid )
 			
 		
 	def execute( self, qid, command ):
@@ -177,11 +497,14 @@ class Hawthorn( object ):
 			return (False, "Invalid query id.")
 		
 		query = self.queries[qid]
+		query.begin()
 		
 		op = command[0]
 		params = command[1:]
 		
-		print op, params
+		if self.read_only and ( op in MUTATION_COMMANDS or ( op == "OFFSET" and params ) ):
+			if qid not in self.upstream_queries:
+				return (False, "Server is read-only.")
 		
 		if op in ["CREATE", "DELETE"]:
 			if len( params ) != 1:
@@ -206,7 +529,7 @@ class Hawthorn( object ):
 				self.storage.save( op, params )
 				return query.graph.remove_node( node_id )
 		
-		if op in ["SET", "UNSET", "CONNECT", "DISCONNECT"]:
+		if op in ["SET", "UNSET", "CONNECT", "DISCONNECT", "INDEX"]:
 		
 			if op == 'SET':
 				if len( params ) != 3:
@@ -275,8 +598,52 @@ class Hawthorn( object ):
 				self.storage.save( op, params )
 				return query.graph.disconnect( source, target, edge_type )
 			
+			elif op == 'INDEX':
+				if len( params ) not in [1, 2]:
+					return (False, "Invalid parameter count (%i), should be %i or %i." % ( len(params), 1, 2 ) )
+				
+				key = params[0]
+				kind = "HASH"
+				if len( params ) > 1:
+					kind = params[1].upper()
+				
+				if kind not in ["HASH", "ORDERED"]:
+					return (False, "Index type (%s) is not defined." % params[1] )
+				
+				self.storage.save( op, params )
+				return query.graph.create_index( key, kind )
+			
+		
+		elif op in ["PATH", "REACHABLE", "WPATH"]:
+			if len( params ) < 4:
+				return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 3 ) )
+			
+			source = parse_int( params[0] )
+			target = parse_int( params[1] )
+			max_depth = parse_int( params[2] )
+			types = params[3:]
+			
+			if not source:
+				return (False, "Invalid source id (%s)." % params[0] )
+			
+			if not target:
+				return (False, "Invalid target id (%s)." % params[1] )
+			
+			if max_depth is False or max_depth < 0:
+				return (False, "Invalid depth (%s)." % params[2] )
+			
+			max_visited = self.config.get( "traversal", {} ).get( "max_visited" )
+			
+			if op == 'WPATH':
+				return query.graph.weighted_path( source, target, types, max_depth, max_visited )
+			
+			(status, path) = query.graph.shortest_path( source, target, types, max_depth, max_visited )
+			if not status or op == 'PATH':
+				return (status, path)
+			
+			return (True, int( len( path ) > 0 ))
 		
-		elif op in ["GET", "FETCH", "EDGES", "CLEAR", "CLEAR-ALL"]:
+		elif op in ["GET", "FETCH", "SCAN", "COUNT", "LAZY", "EDGES", "CLEAR", "CLEAR-ALL"]:
 			
 			if op == 'GET':
 				if len( params ) != 1:
@@ -290,12 +657,63 @@ class Hawthorn( object ):
 				return query.graph.get_node( node_id )
 				
 			elif op == 'FETCH':
+				if len( params ) not in [1, 3]:
+					return (False, "Invalid parameter count (%i), should be %i or %i." % ( len(params), 1, 3 ) )
+				
+				qset = params[0]
+				
+				if len( params ) == 1:
+					return query.fetch( qset )
+				
+				offset = parse_int( params[1] )
+				if offset is False or offset < 0:
+					return (False, "Invalid offset (%s)." % params[1] )
+				
+				count = parse_int( params[2] )
+				if count is False or count < 0:
+					return (False, "Invalid count (%s)." % params[2] )
+				
+				return query.fetch( qset, offset, count )
+			
+			elif op == 'SCAN':
+				if len( params ) not in [2, 4]:
+					return (False, "Invalid parameter count (%i), should be %i or %i." % ( len(params), 2, 4 ) )
+				
+				qset = params[0]
+				
+				cursor = parse_int( params[1] )
+				if cursor is False:
+					return (False, "Invalid cursor (%s)." % params[1] )
+				
+				if len( params ) == 2:
+					return query.scan( qset, cursor )
+				
+				if params[2].upper() != "COUNT":
+					return (False, "Invalid parameter (%s), should be COUNT." % params[2] )
+				
+				count = parse_int( params[3] )
+				if not count or count < 0:
+					return (False, "Invalid count (%s)." % params[3] )
+				
+				return query.scan( qset, cursor, count )
+			
+			elif op == 'COUNT':
 				if len( params ) != 1:
 					return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 1 ) )
 				
 				qset = params[0]
 				
-				return query.fetch( qset )
+				return query.count( qset )
+			
+			elif op == 'LAZY':
+				if len( params ) != 1:
+					return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 1 ) )
+				
+				mode = params[0].upper()
+				if mode not in ["ON", "OFF"]:
+					return (False, "Invalid mode (%s), should be ON or OFF." % params[0] )
+				
+				return query.set_lazy( mode == "ON" )
 
 			elif op == 'EDGES':
 				if len( params ) != 1:
@@ -327,129 +745,417 @@ class Hawthorn( object ):
 				return query.clear( qset )
 				
 		
-		elif op in ["START", "FIND", "FORWARD", "BACKWARD", "FILTER", "APPEND", "UNION", "INTERSECT", "DIFFERENCE"]:
+		elif op in BATCH_COMMANDS:
+			return self.execute_batch( query, op, params )
+		
+		elif op == 'REPLICATION':
+			if len( params ) not in [0, 2]:
+				return (False, "Invalid parameter count (%i), should be %i or %i." % ( len(params), 0, 2 ) )
 			
-			if op == 'START':
-				if len( params ) < 2:
-					return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 1 ) )
-				
-				target = params[0]
-				
-				for param in params[1:]:
-					node_id = parse_int( param )
-					if not node_id:
-						return (False, "Invalid node id (%s)." % param )
-					
-					#query.start( target, node_id )
-				
-				#return (True, len( params ) )
-				return query.start( target, node_id )
-				
-			elif op == 'FIND':
+			if len( params ) == 0:
+				return (True, self.storage.status())
+			
+			action = params[0].upper()
+			if action == "ADD":
+				result = self.storage.add_replica( params[1] )
+			elif action == "REMOVE":
+				result = self.storage.remove_replica( params[1] )
+			else:
+				return (False, "Invalid parameter (%s), should be ADD or REMOVE." % params[0] )
+			
+			if result is None:
+				return (False, "Replication is not enabled.")
+			return result
+		
+		elif op == 'UPSTREAM':
+			if len( params ) != 0:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 0 ) )
+			
+			# A read-only server only takes changes from the hosts listed as
+			# its upstreams, so without any it takes none.
+			peer = self.peers.get( qid )
+			if ( self.upstreams or self.read_only ) and peer not in self.upstreams:
+				return (False, "Host (%s) is not an upstream of this server." % peer )
+			
+			self.upstream_queries.add( qid )
+			return (True, "OK")
+		
+		elif op == 'POSITION':
+			if len( params ) != 0:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 0 ) )
+			
+			position = self.storage.position()
+			if position is None:
+				return (False, "Changes are not logged.")
+			return (True, list( position ))
+		
+		elif op == 'OFFSET':
+			if len( params ) not in [0, 2]:
+				return (False, "Invalid parameter count (%i), should be %i or %i." % ( len(params), 0, 2 ) )
+			
+			if len( params ) == 0:
+				return (True, list( self.upstream ))
+			
+			offset = parse_int( params[1] )
+			if offset is False or offset < 0:
+				return (False, "Invalid offset (%s)." % params[1] )
+			
+			self.upstream = [params[0], offset]
+			self.storage.save( op, self.upstream )
+			return (True, "OK")
+		
+		elif op == 'RESET':
+			if len( params ) != 0:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 0 ) )
+			
+			self.storage.save( op, params )
+			query.graph.clear()
+			return (True, "OK")
+		
+		elif op in ["SNAPSHOT", "COMPACT"]:
+			if len( params ) != 0:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 0 ) )
+			
+			if op == 'SNAPSHOT':
+				self.storage.snapshot( self )
+			else:
+				self.storage.compact( self )
+			return (True, "OK")
+		
+		elif op == 'QUERY':
+			return self.run_script( query, params )
+		
+		elif op in QUERYSET_COMMANDS:
+			(status, step) = self.parse_queryset_command( op, params )
+			if not status:
+				return (status, step)
+			
+			return self.run_queryset_command( query, step )
+		
+		return (False, "Unknown command '%s'." % op )
 
-				if len( params ) != 4:
-					return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 4 ) )
-				
-				target = params[0]
-				key = params[1]
-				value = params[2]
-				operator = params[3]
-				
-				return query.find( key, value, operator, target )
+	def parse_batch( self, graph, op, params ):
+		# Splits the parameters of a batch command into items and checks
+		# every item before any of them is applied. Checks are done a column
+		# at a time.
+		(width, id_columns) = BATCH_COMMANDS[ op ]
+		
+		if len( params ) < width or len( params ) % width != 0:
+			return (False, "Invalid parameter count (%i), should be a multiple of %i." % ( len(params), width ) )
+		
+		columns = [params[ column::width ] for column in range( width )]
+		
+		for column in id_columns:
+			try:
+				node_ids = map( int, columns[ column ] )
+			except ValueError:
+				node_ids = map( parse_int, columns[ column ] )
+			
+			if 0 in node_ids:
+				position = node_ids.index( 0 )
+				return (False, "Invalid node id (%s)." % columns[ column ][ position ] )
+			
+			if op != "MCREATE":
+				missing = set( node_ids ).difference( graph.nodes )
+				if missing:
+					node_id = [node_id for node_id in node_ids if node_id in missing][0]
+					return (False, "Node (%i) not in graph." % node_id )
+			
+			columns[ column ] = node_ids
+		
+		if op == "MDISCONNECT":
+			missing = set( columns[2] ).difference( graph.types )
+			if missing:
+				edge_type = [edge_type for edge_type in columns[2] if edge_type in missing][0]
+				return (False, "Edge type (%s) not defined." % edge_type )
+		
+		return (True, zip( *columns ))
 	
-			elif op == 'FORWARD':
-				if len( params ) < 3:
-					return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 2 ) )
-				
-				target = params[0]
-				source = params[1]
-				types = params[2:]
-				
-				
-				return query.forward( source, target, types )
+	def execute_batch( self, query, op, params ):
+		# The whole batch is validated first, stored as one record and then
+		# applied, so it is either applied in full or not at all.
+		graph = query.graph
+		
+		(status, items) = self.parse_batch( graph, op, params )
+		if not status:
+			return (status, items)
+		
+		self.storage.save( op, params )
+		
+		if op == 'MCREATE':
+			for (node_id,) in items:
+				graph.create( node_id )
+		
+		elif op == 'MSET':
+			for (node_id, key, value) in items:
+				graph.set_property( node_id, key, value )
+		
+		elif op == 'MCONNECT':
+			for (source, target, edge_type, value) in items:
+				graph.connect( source, target, edge_type, value )
+		
+		elif op == 'MDISCONNECT':
+			for (source, target, edge_type) in items:
+				graph.disconnect( source, target, edge_type )
+		
+		return (True, len( items ))
+	
+	def parse_queryset_command( self, op, params ):
+		# Validates a queryset command without running it. Returns
+		# (method, args, target, sources) for run_queryset_command.
+		if op == 'START':
+			if len( params ) < 2:
+				return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 1 ) )
 			
-			elif op == 'BACKWARD':
-				if len( params ) < 3:
-					return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 2 ) )
-				
-				target = params[0]
-				source = params[1]
-				types = params[2:]
-				
-				
-				return query.backward( source, target, types )
+			target = params[0]
+			node_ids = []
 			
-			elif op == 'FILTER':
-				if len( params ) != 5:
-					return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 5 ) )
-				
-				target = params[0]
-				source = params[1]
-				key = params[2]
-				value = params[3]
-				operator = params[4]
+			for param in params[1:]:
+				node_id = parse_int( param )
+				if not node_id:
+					return (False, "Invalid node id (%s)." % param )
 				
-				return query.filter( source, target, key, value, operator )
+				node_ids.append( node_id )
 			
-			elif op == 'APPEND':
-				if len( params ) != 3:
-					return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 3 ) )
-				
-				target = params[0]
-				source0 = params[1]
-				source1 = params[2]
-				
-				return query.append( source0, source1, target )
+			return (True, ("start", (target, node_ids), target, []))
 			
-			elif op == 'UNION':
-				if len( params ) != 3:
-					return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 3 ) )
-				
-				target = params[0]
-				source0 = params[1]
-				source1 = params[2]
-				
-				return query.union( source0, source1, target )
+		elif op == 'FIND':
 
-			elif op == 'INTERSECTION':
-				if len( params ) != 3:
-					return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 3 ) )
-				
-				target = params[0]
-				source0 = params[1]
-				source1 = params[2]
-				
-				return query.intersection( source0, source1, target )
+			if len( params ) not in [4, 5]:
+				return (False, "Invalid parameter count (%i), should be %i or %i." % ( len(params), 4, 5 ) )
+			
+			target = params[0]
+			key = params[1]
+			value = params[2]
+			operator = params[-1]
+			
+			if (operator == "BETWEEN") != (len( params ) == 5):
+				return (False, "Operator BETWEEN takes two values, other operators one." )
+			
+			if operator == "BETWEEN":
+				value = (params[2], params[3])
+			
+			return (True, ("find", (key, value, operator, target), target, []))
 
-			elif op == 'DIFFERENCE':
-				if len( params ) != 3:
-					return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 3 ) )
-				
-				target = params[0]
-				source0 = params[1]
-				source1 = params[2]
-				
-				return query.difference( source0, source1, target )
+		elif op == 'FORWARD':
+			if len( params ) < 3:
+				return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 2 ) )
 			
-		return (False, "Unknown command '%s'." % op )
+			target = params[0]
+			source = params[1]
+			types = params[2:]
+			
+			
+			return (True, ("forward", (source, target, types), target, [source]))
+		
+		elif op == 'BACKWARD':
+			if len( params ) < 3:
+				return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 2 ) )
+			
+			target = params[0]
+			source = params[1]
+			types = params[2:]
+			
+			
+			return (True, ("backward", (source, target, types), target, [source]))
+		
+		elif op in ['EXPAND', 'EXPAND-BACKWARD', 'EXPAND-BOTH']:
+			if len( params ) < 5:
+				return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 4 ) )
+			
+			target = params[0]
+			source = params[1]
+			mindepth = parse_int( params[2] )
+			maxdepth = parse_int( params[3] )
+			types = params[4:]
+			
+			if mindepth is False or mindepth < 0:
+				return (False, "Invalid depth (%s)." % params[2] )
+			
+			if maxdepth is False or maxdepth < mindepth:
+				return (False, "Invalid depth (%s)." % params[3] )
+			
+			limit = None
+			if len( types ) > 2 and types[-2] == "LIMIT":
+				limit = parse_int( types[-1] )
+				if not limit or limit < 0:
+					return (False, "Invalid limit (%s)." % types[-1] )
+				types = types[:-2]
+			
+			direction = "FORWARD"
+			if op != 'EXPAND':
+				direction = op.split( "-" )[1]
+			
+			return (True, ("expand", (source, target, mindepth, maxdepth, types, direction, limit), target, [source]))
+		
+		elif op == 'FILTER':
+			if len( params ) not in [5, 6]:
+				return (False, "Invalid parameter count (%i), should be %i or %i." % ( len(params), 5, 6 ) )
+			
+			target = params[0]
+			source = params[1]
+			key = params[2]
+			value = params[3]
+			operator = params[-1]
+			
+			if (operator == "BETWEEN") != (len( params ) == 6):
+				return (False, "Operator BETWEEN takes two values, other operators one." )
+			
+			if operator == "BETWEEN":
+				value = (params[3], params[4])
+			
+			return (True, ("filter", (source, target, key, value, operator), target, [source]))
+		
+		elif op == 'APPEND':
+			if len( params ) != 3:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 3 ) )
+			
+			target = params[0]
+			source0 = params[1]
+			source1 = params[2]
+			
+			return (True, ("append", (source0, source1, target), target, [source0, source1]))
+		
+		elif op == 'UNION':
+			if len( params ) != 3:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 3 ) )
+			
+			target = params[0]
+			source0 = params[1]
+			source1 = params[2]
+			
+			return (True, ("union", (source0, source1, target), target, [source0, source1]))
+
+		elif op == 'INTERSECTION':
+			if len( params ) != 3:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 3 ) )
+			
+			target = params[0]
+			source0 = params[1]
+			source1 = params[2]
+			
+			return (True, ("intersection", (source0, source1, target), target, [source0, source1]))
 
+		elif op == 'DIFFERENCE':
+			if len( params ) != 3:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 3 ) )
+			
+			target = params[0]
+			source0 = params[1]
+			source1 = params[2]
+			
+			return (True, ("difference", (source0, source1, target), target, [source0, source1]))
+		
+		elif op == 'UNIQUE':
+			if len( params ) != 2:
+				return (False, "Invalid parameter count (%i), should be %i." % ( len(params), 2 ) )
+			
+			target = params[0]
+			source = params[1]
+			
+			return (True, ("unique", (source, target), target, [source]))
+		
+		return (False, "Unknown command '%s'." % op )
+	
+	def run_queryset_command( self, query, step ):
+		(method, args, target, sources) = step
+		return getattr( query, method )( *args )
+	
+	def run_script( self, query, params ):
+		# QUERY resultset0[,resultset1...] command args... ; command args... ; ...
+		if len( params ) < 2:
+			return (False, "Invalid parameter count (%i), should be > %i." % ( len(params), 1 ) )
+		
+		returns = params[0].split( "," )
+		
+		steps = []
+		command = []
+		for param in params[1:] + [";"]:
+			if param != ";":
+				command.append( param )
+				continue
+			
+			if not command:
+				continue
+			
+			if command[0] not in QUERYSET_COMMANDS:
+				return (False, "Step %i: command '%s' is not allowed in a query." % ( len( steps ) + 1, command[0] ) )
+			
+			(status, step) = self.parse_queryset_command( command[0], command[1:] )
+			if not status:
+				return (False, "Step %i: %s" % ( len( steps ) + 1, step ) )
+			
+			steps.append( step )
+			command = []
+		
+		created = set( [step[2] for step in steps] )
+		for name in returns:
+			if name not in created and name not in query.querysets:
+				return (False, "Queryset (%s) not found." % name )
+		
+		# Querysets made by the script that aren't returned are dropped
+		# right after the step that reads them for the last time.
+		last_read = {}
+		for (i, step) in enumerate( steps ):
+			for source in step[3]:
+				last_read[ source ] = i
+		
+		existing = set( query.querysets )
+		for (i, step) in enumerate( steps ):
+			(status, response) = self.run_queryset_command( query, step )
+			if not status:
+				# Only querysets made by the steps that ran are dropped,
+				# the connection's own are left as they are.
+				for name in set( [done[2] for done in steps[:i]] ).difference( existing ):
+					if name in query.querysets:
+						query.clear( name )
+				return (False, "Step %i: %s" % ( i + 1, response ) )
+			
+			for source in step[3]:
+				if last_read[ source ] == i and source in created and source not in returns and source != step[2]:
+					query.clear( source )
+		
+		for name in created.difference( returns ):
+			if name in query.querysets:
+				query.clear( name )
+		
+		out = {}
+		for name in returns:
+			out[ name ] = query.fetch( name )[1]
+		
+		return (True, out)
+	
 	def get_handler( self ):
 		def handler( socket, address ):
 			qid = self.start_query( 0 )
+			self.peers[ qid ] = address[0]
 			#print "Connection accepted"
 			conn = RedisProtocol.RedisProtocol( socket )
+			
+			# Set when the connection has sent a change since its replies
+			# were last flushed.
+			changed = [False]
+			def before_flush():
+				self.storage.commit( changed[0] )
+				changed[0] = False
+			conn.before_flush = before_flush
 			try:
 				while True:
 					data = conn.receive()
 					if not data:
 						break
 					
+					if data[0] in MUTATION_COMMANDS:
+						changed[0] = True
 					(status, response) = self.execute( qid, data )
 					
+					# While more pipelined requests are waiting, replies
+					# are collected and written together.
+					flush = not conn.pending()
 					if status:
-						conn.send_response( response )
+						conn.send_response( response, flush )
 					else:
-						conn.send_error( response )
+						conn.send_error( response, flush )
 					
 					#print status, response
 					
@@ -467,8 +1173,47 @@ class Hawthorn( object ):
 		return handler
 
 
+	def refresh_csr( self, interval ):
+		# Rebuilds the CSR snapshot of a graph once its edges have stopped
+		# changing for a full interval, so bulk loads don't trigger a
+		# rebuild after every batch. The build lets the connections run
+		# between chunks of rows and starts over later if the edges change
+		# meanwhile.
+		seen = {}
+		while True:
+			gevent.sleep( interval )
+			for (db_id, graph) in self.graphs.items():
+				if not graph.nodes or graph.get_csr() is not None:
+					continue
+				
+				if seen.get( db_id ) == graph.edge_version:
+					graph.freeze( gevent.idle )
+				
+				seen[ db_id ] = graph.edge_version
+	
+	def sync_loop( self, interval ):
+		while True:
+			gevent.sleep( interval )
+			self.storage.sync()
+	
+	def snapshot_loop( self, interval ):
+		while True:
+			gevent.sleep( interval )
+			self.storage.snapshot( self )
+	
 	def run( self ):
 		#server = StreamServer( ('127.0.0.1', 7778), self.get_handler() )
+		refresh_interval = self.config.get( "csr", {} ).get( "refresh_interval", 5.0 )
+		if refresh_interval:
+			gevent.spawn( self.refresh_csr, refresh_interval )
+		
+		if "snapshot" in self.config:
+			gevent.spawn( self.snapshot_loop, self.config["snapshot"]["interval"] )
+		
+		durability = self.config.get( "durability", {} )
+		if durability.get( "fsync" ) == "interval":
+			gevent.spawn( self.sync_loop, durability["interval"] )
+		
 		print "Starting H3 Tritium @ %s:%i.." % ( self.config["host"], self.config["port"] )
 		server = StreamServer( (self.config["host"], self.config["port"]), self.get_handler() )
 		try:
@@ -488,9 +1233,16 @@ with open( sys.argv[1], 'r') as handle:
 
 
 
-appendlog = Storage.AppendLogStorage( config["database"] )
+appendlog = Storage.AppendLogStorage( config["database"],
+	config.get( "durability", {} ).get( "fsync", "os" ),
+	config.get( "replay", {} ).get( "workers", 0 ),
+	config.get( "database_format", "json" ) )
 
-replicator = ReplicatedStorage( config["replication"]["hosts"] )
+replication = config["replication"]
+replicator = ReplicatedStorage( appendlog, replication["hosts"],
+	replication.get( "queue_size", 100000 ),
+	replication.get( "batch_size", 1000 ),
+	replication.get( "backpressure", "block" ) )
 
 
 multistore = MultiStorage([ appendlog, replicator ])
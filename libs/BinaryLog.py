@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+#
+#   Copyright 2013 Markus Gronholm <markus@alshain.fi> / Alshain Oy
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Binary append log format. The file starts with MAGIC, followed by
+# records of
+#
+#   varint body length, crc32 of the body (4 bytes, big endian), body
+#
+# The body is an opcode byte and the fields of the command. Counts are
+# varints and node ids zigzag varints, so that ids may be negative. Edge
+# types and property keys are interned: the first time a name is used,
+# an INTERN record gives it an id, and later records refer to the name
+# by that id. The names are numbered per log file. Property values and
+# edge weights are tagged values.
+
+import json, struct, zlib
+
+MAGIC = "H3LOGB01"
+
+CRC = struct.Struct( ">I" )
+
+OP_LOG = 0
+OP_INTERN = 1
+OP_CREATE = 2
+OP_DELETE = 3
+OP_SET = 4
+OP_UNSET = 5
+OP_CONNECT = 6
+OP_DISCONNECT = 7
+OP_INDEX = 8
+OP_MCREATE = 9
+OP_MSET = 10
+OP_MCONNECT = 11
+OP_MDISCONNECT = 12
+OP_COMMAND = 13
+
+# Value tags.
+TAG_STR = 0
+TAG_INT = 1
+TAG_UNICODE = 2
+TAG_JSON = 3
+
+
+def _varint( value ):
+	if value < 0x80:
+		return chr( value )
+	out = []
+	while value >= 0x80:
+		out.append( chr( ( value & 0x7f ) | 0x80 ) )
+		value >>= 7
+	out.append( chr( value ) )
+	return "".join( out )
+
+def _read_varint( data, pos ):
+	byte = ord( data[pos] )
+	if byte < 0x80:
+		return (byte, pos + 1)
+
+	value = byte & 0x7f
+	shift = 7
+	while True:
+		pos += 1
+		byte = ord( data[pos] )
+		value |= ( byte & 0x7f ) << shift
+		if byte < 0x80:
+			return (value, pos + 1)
+		shift += 7
+
+def _zigzag( value ):
+	# Maps signed ints to unsigned ones, so that small negative values
+	# stay short: 0, -1, 1, -2, .. become 0, 1, 2, 3, ..
+	if value < 0:
+		return ( -value << 1 ) - 1
+	return value << 1
+
+def _unzigzag( value ):
+	if value & 1:
+		return -( ( value + 1 ) >> 1 )
+	return value >> 1
+
+def _read_id( data, pos ):
+	# _read_varint() and _unzigzag() in one; node ids make up most of a
+	# log.
+	value = 0
+	shift = 0
+	while True:
+		byte = ord( data[pos] )
+		pos += 1
+		value |= ( byte & 0x7f ) << shift
+		if byte < 0x80:
+			break
+		shift += 7
+
+	if value & 1:
+		return (-( ( value + 1 ) >> 1 ), pos)
+	return (value >> 1, pos)
+
+def _value( value ):
+	if isinstance( value, str ):
+		return chr( TAG_STR ) + _varint( len( value ) ) + value
+
+	if isinstance( value, (int, long) ) and not isinstance( value, bool ):
+		return chr( TAG_INT ) + _varint( _zigzag( value ) )
+
+	if isinstance( value, unicode ):
+		value = value.encode( "utf-8" )
+		return chr( TAG_UNICODE ) + _varint( len( value ) ) + value
+
+	value = json.dumps( value )
+	return chr( TAG_JSON ) + _varint( len( value ) ) + value
+
+def _read_value( data, pos ):
+	tag = ord( data[pos] )
+	(value, pos) = _read_varint( data, pos + 1 )
+
+	if tag == TAG_INT:
+		return (_unzigzag( value ), pos)
+
+	end = pos + value
+	value = data[ pos:end ]
+	if tag == TAG_UNICODE:
+		value = value.decode( "utf-8" )
+	elif tag == TAG_JSON:
+		value = json.loads( value )
+	return (value, end)
+
+def _id( value ):
+	try:
+		node_id = int( value )
+	except ValueError:
+		node_id = int( value, 16 )
+	return _varint( _zigzag( node_id ) )
+
+def record( body ):
+	return _varint( len( body ) ) + CRC.pack( zlib.crc32( body ) & 0xffffffff ) + body
+
+def read_record( data, pos ):
+	# Returns (body, end of the record, checksum ok), or None if data ends
+	# before the record does.
+	try:
+		(length, start) = _read_varint( data, pos )
+	except IndexError:
+		return None
+
+	end = start + 4 + length
+	if end > len( data ):
+		return None
+
+	body = data[ start + 4:end ]
+	ok = CRC.unpack( data[ start:start + 4 ] )[0] == zlib.crc32( body ) & 0xffffffff
+	return (body, end, ok)
+
+
+class Encoder( object ):
+	# Encodes commands (op, params) as records, interning names as it
+	# goes. names: the names of the log so far, in id order.
+
+	def __init__( self, names = () ):
+		self.names = list( names )
+		self.ids = dict( (name, name_id) for (name_id, name) in enumerate( self.names ) )
+
+	def _name( self, name, out ):
+		name_id = self.ids.get( name )
+		if name_id is None:
+			name_id = len( self.names )
+			self.names.append( name )
+			self.ids[ name ] = name_id
+			out.append( record( chr( OP_INTERN ) + _varint( name_id ) + _value( name ) ) )
+		return _varint( name_id )
+
+	def encode( self, op, params ):
+		out = []
+		if op == "LOG":
+			body = [chr( OP_LOG )] + [_value( param ) for param in params]
+
+		elif op in ["CREATE", "DELETE"]:
+			body = [chr( OP_CREATE if op == "CREATE" else OP_DELETE ), _id( params[0] )]
+
+		elif op == "SET":
+			body = [chr( OP_SET ), _id( params[0] ), self._name( params[1], out ), _value( params[2] )]
+
+		elif op == "UNSET":
+			body = [chr( OP_UNSET ), _id( params[0] ), self._name( params[1], out )]
+
+		elif op == "CONNECT":
+			body = [chr( OP_CONNECT ), _id( params[0] ), _id( params[1] ), self._name( params[2], out ), _value( params[3] )]
+
+		elif op == "DISCONNECT":
+			body = [chr( OP_DISCONNECT ), _id( params[0] ), _id( params[1] ), self._name( params[2], out )]
+
+		elif op == "INDEX":
+			kind = "HASH"
+			if len( params ) > 1:
+				kind = params[1]
+			body = [chr( OP_INDEX ), self._name( params[0], out ), _value( kind )]
+
+		elif op == "MCREATE":
+			body = [chr( OP_MCREATE ), _varint( len( params ) )]
+			body.extend( [_id( node_id ) for node_id in params] )
+
+		elif op == "MSET":
+			body = [chr( OP_MSET ), _varint( len( params ) // 3 )]
+			for i in xrange( 0, len( params ), 3 ):
+				body.extend( (_id( params[i] ), self._name( params[i+1], out ), _value( params[i+2] )) )
+
+		elif op == "MCONNECT":
+			body = [chr( OP_MCONNECT ), _varint( len( params ) // 4 )]
+			for i in xrange( 0, len( params ), 4 ):
+				body.extend( (_id( params[i] ), _id( params[i+1] ), self._name( params[i+2], out ), _value( params[i+3] )) )
+
+		elif op == "MDISCONNECT":
+			body = [chr( OP_MDISCONNECT ), _varint( len( params ) // 3 )]
+			for i in xrange( 0, len( params ), 3 ):
+				body.extend( (_id( params[i] ), _id( params[i+1] ), self._name( params[i+2], out )) )
+
+		else:
+			body = [chr( OP_COMMAND ), _value( op ), _varint( len( params ) )]
+			body.extend( [_value( param ) for param in params] )
+
+		out.append( record( "".join( body ) ) )
+		return "".join( out )
+
+
+class Decoder( object ):
+	# Turns record bodies back into (op, params) commands, with node ids
+	# as ints. INTERN records update names and decode to None.
+
+	def __init__( self, names = () ):
+		self.names = list( names )
+
+	def decode( self, body ):
+		op = ord( body[0] )
+		pos = 1
+		names = self.names
+
+		if op == OP_CREATE or op == OP_DELETE:
+			return ("CREATE" if op == OP_CREATE else "DELETE", [_read_id( body, pos )[0]])
+
+		elif op == OP_SET:
+			(node_id, pos) = _read_id( body, pos )
+			(name_id, pos) = _read_varint( body, pos )
+			(value, pos) = _read_value( body, pos )
+			return ("SET", [node_id, names[ name_id ], value])
+
+		elif op == OP_UNSET:
+			(node_id, pos) = _read_id( body, pos )
+			(name_id, pos) = _read_varint( body, pos )
+			return ("UNSET", [node_id, names[ name_id ]])
+
+		elif op == OP_CONNECT or op == OP_DISCONNECT:
+			(source, pos) = _read_id( body, pos )
+			(target, pos) = _read_id( body, pos )
+			(name_id, pos) = _read_varint( body, pos )
+			if op == OP_DISCONNECT:
+				return ("DISCONNECT", [source, target, names[ name_id ]])
+			(value, pos) = _read_value( body, pos )
+			return ("CONNECT", [source, target, names[ name_id ], value])
+
+		elif op == OP_INTERN:
+			(name_id, pos) = _read_varint( body, pos )
+			(name, pos) = _read_value( body, pos )
+			if name_id != len( names ):
+				raise ValueError( "Name id (%i) out of order." % name_id )
+			names.append( name )
+			return None
+
+		elif op == OP_LOG:
+			params = []
+			while pos < len( body ):
+				(value, pos) = _read_value( body, pos )
+				params.append( value )
+			return ("LOG", params)
+
+		elif op == OP_INDEX:
+			(name_id, pos) = _read_varint( body, pos )
+			(kind, pos) = _read_value( body, pos )
+			return ("INDEX", [names[ name_id ], kind])
+
+		params = []
+		if op == OP_COMMAND:
+			(name, pos) = _read_value( body, pos )
+			(count, pos) = _read_varint( body, pos )
+			for i in xrange( count ):
+				(value, pos) = _read_value( body, pos )
+				params.append( value )
+			return (name, params)
+
+		(count, pos) = _read_varint( body, pos )
+
+		if op == OP_MCREATE:
+			for i in xrange( count ):
+				(node_id, pos) = _read_id( body, pos )
+				params.append( node_id )
+			return ("MCREATE", params)
+
+		elif op == OP_MSET:
+			for i in xrange( count ):
+				(node_id, pos) = _read_id( body, pos )
+				(name_id, pos) = _read_varint( body, pos )
+				(value, pos) = _read_value( body, pos )
+				params.extend( (node_id, names[ name_id ], value) )
+			return ("MSET", params)
+
+		elif op == OP_MCONNECT or op == OP_MDISCONNECT:
+			for i in xrange( count ):
+				(source, pos) = _read_id( body, pos )
+				(target, pos) = _read_id( body, pos )
+				(name_id, pos) = _read_varint( body, pos )
+				params.extend( (source, target, names[ name_id ]) )
+				if op == OP_MCONNECT:
+					(value, pos) = _read_value( body, pos )
+					params.append( value )
+			return ("MCONNECT" if op == OP_MCONNECT else "MDISCONNECT", params)
+
+		raise ValueError( "Unknown opcode (%i)." % op )
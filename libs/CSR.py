@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+#
+#   Copyright 2013 Markus Gronholm <markus@alshain.fi> / Alshain Oy
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from array import array
+from bisect import bisect_left
+from itertools import count, izip
+
+# Node ids are packed as signed 64 bit integers so that they come back
+# out of the arrays as ints, not longs.
+ID_TYPECODE = 'l'
+OFFSET_TYPECODE = 'L'
+
+
+# Rows packed between two checkpoints of CSRGraph.build().
+BUILD_CHUNK = 512
+
+
+class Adjacency( object ):
+	# One direction of a compressed sparse row graph, partitioned by edge
+	# type. partitions[t] is (rows, offsets, neighbors). For a type that
+	# at least half of the rows have edges of, rows is None and the edges
+	# of row r are
+	#
+	#   neighbors[ offsets[r]:offsets[r+1] ]
+	#
+	# Otherwise only the rows with edges of the type are kept, in the
+	# sorted array rows, and the edges of rows[i] are
+	#
+	#   neighbors[ offsets[i]:offsets[i+1] ]
+	#
+	# so a type takes space in proportion to its edges, not to the graph.
+
+	def __init__( self, dense_types, weights_index ):
+		self.weights_index = weights_index
+		self.row_count = 0
+		self.partitions = {}
+		for type_id in dense_types:
+			self.partitions[ type_id ] = (None, array( OFFSET_TYPECODE, [0] ), array( ID_TYPECODE ))
+		self.dense = self.partitions.values()
+
+	def append( self, buckets ):
+		# Adds the next row from the { type_id: bucket } buckets of a node,
+		# where bucket[ weights_index ] is { neighbor: weight }.
+		for (type_id, bucket) in buckets.iteritems():
+			partition = self.partitions.get( type_id )
+			if partition is None:
+				partition = (array( OFFSET_TYPECODE ), array( OFFSET_TYPECODE, [0] ), array( ID_TYPECODE ))
+				self.partitions[ type_id ] = partition
+
+			(rows, offsets, neighbors) = partition
+			neighbors.extend( bucket[ self.weights_index ] )
+			if rows is not None:
+				rows.append( self.row_count )
+				offsets.append( len( neighbors ) )
+
+		for (rows, offsets, neighbors) in self.dense:
+			offsets.append( len( neighbors ) )
+		self.row_count += 1
+
+	def _index( self, sparse_rows, rows ):
+		# { row: i } for the rows of a sparse type, or just for the looked
+		# up ones when they are few compared to the rows of the type.
+		if 16 * len( rows ) >= len( sparse_rows ):
+			return dict( izip( sparse_rows, count() ) )
+
+		index = {}
+		for row in rows:
+			if row is None:
+				continue
+			i = bisect_left( sparse_rows, row )
+			if i < len( sparse_rows ) and sparse_rows[i] == row:
+				index[ row ] = i
+		return index
+
+	def extend( self, out, rows, type_ids ):
+		# Same order as the live graph: by source, then by requested type.
+		partitions = []
+		for type_id in type_ids:
+			if type_id in self.partitions:
+				(sparse_rows, offsets, neighbors) = self.partitions[ type_id ]
+				if sparse_rows is not None:
+					sparse_rows = self._index( sparse_rows, rows )
+				partitions.append( (sparse_rows, offsets, neighbors) )
+
+		if len( partitions ) == 1 and partitions[0][0] is None:
+			(unused, offsets, neighbors) = partitions[0]
+			for row in rows:
+				if row is not None:
+					out.extend( neighbors[ offsets[row]:offsets[row + 1] ] )
+			return
+
+		for row in rows:
+			if row is None:
+				continue
+			for (index, offsets, neighbors) in partitions:
+				i = row
+				if index is not None:
+					i = index.get( row )
+					if i is None:
+						continue
+				out.extend( neighbors[ offsets[i]:offsets[i + 1] ] )
+
+	def nbytes( self ):
+		total = 0
+		for partition in self.partitions.itervalues():
+			for packed in partition:
+				if packed is not None:
+					total += packed.itemsize * len( packed )
+		return total
+
+
+class CSRGraph( object ):
+	# Read-only snapshot of the edges of a Graph at a given edge_version.
+
+	def __init__( self, version, rows, forward, backward ):
+		self.version = version
+		self.rows = rows
+		self.forward = forward
+		self.backward = backward
+
+	@staticmethod
+	def _chunks( graph, node_ids, checkpoint ):
+		# Yields (node_id, node) pairs BUILD_CHUNK at a time, or None if
+		# the edges change while checkpoint() runs.
+		version = graph.edge_version
+		for offset in xrange( 0, len( node_ids ), BUILD_CHUNK ):
+			if checkpoint is not None:
+				checkpoint()
+				if graph.edge_version != version:
+					yield None
+					return
+			nodes = graph.nodes
+			yield [(node_id, nodes[ node_id ]) for node_id in node_ids[ offset:offset + BUILD_CHUNK ]]
+
+	@staticmethod
+	def _dense_types( counts, row_count ):
+		return [type_id for (type_id, type_rows) in counts.iteritems() if 2 * type_rows >= row_count]
+
+	@staticmethod
+	def build( graph, forward_index, backward_index, weights_index, checkpoint = None ):
+		# Returns None if the node ids don't fit the packed arrays. With
+		# checkpoint given, it is called every BUILD_CHUNK rows, e.g. to let
+		# other greenlets run, and the build gives up (returns None) if
+		# the edges have changed in the meantime.
+		version = graph.edge_version
+		node_ids = graph.nodes.keys()
+
+		# The first pass numbers the rows and counts the rows with edges of
+		# each type.
+		rows = {}
+		forward_counts = {}
+		backward_counts = {}
+		for chunk in CSRGraph._chunks( graph, node_ids, checkpoint ):
+			if chunk is None:
+				return None
+			for (node_id, node) in chunk:
+				rows[ node_id ] = len( rows )
+				for type_id in node[ forward_index ]:
+					forward_counts[ type_id ] = forward_counts.get( type_id, 0 ) + 1
+				for type_id in node[ backward_index ]:
+					backward_counts[ type_id ] = backward_counts.get( type_id, 0 ) + 1
+
+		forward = Adjacency( CSRGraph._dense_types( forward_counts, len( node_ids ) ), weights_index )
+		backward = Adjacency( CSRGraph._dense_types( backward_counts, len( node_ids ) ), weights_index )
+		try:
+			for chunk in CSRGraph._chunks( graph, node_ids, checkpoint ):
+				if chunk is None:
+					return None
+				for (node_id, node) in chunk:
+					forward.append( node[ forward_index ] )
+					backward.append( node[ backward_index ] )
+		except OverflowError:
+			return None
+
+		return CSRGraph( version, rows, forward, backward )
+
+	def _traverse( self, adjacency, node_ids, type_ids ):
+		out = []
+		rows = map( self.rows.get, node_ids )
+		adjacency.extend( out, rows, type_ids )
+		return out
+
+	def get_forward_targets( self, node_ids, type_ids ):
+		return self._traverse( self.forward, node_ids, type_ids )
+
+	def get_backward_sources( self, node_ids, type_ids ):
+		return self._traverse( self.backward, node_ids, type_ids )
+
+	def nbytes( self ):
+		return self.forward.nbytes() + self.backward.nbytes()
@@ -15,6 +15,15 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from bisect import bisect_left, bisect_right, insort
+from heapq import heappush, heappop
+import time
+import weakref
+
+from array import array
+
+from CSR import CSRGraph, ID_TYPECODE
+import QuerySet
 
 
 class Edge:
@@ -28,103 +37,314 @@ class Edge:
 		return [source, target, edge_type, weight]
 
 
+class Bucket:
+	# The edges of one type on one side of a node: { neighbor: weight }
+	# and, for EDGES, the neighbors in the order their edges were made.
+	# Removing an edge only drops it from the weights, so the order may
+	# also hold gone neighbors and, for an edge made again, earlier copies
+	# of the neighbor; see ordered(). The order is an id array, which the
+	# cyclic garbage collector doesn't track, or a list if an id doesn't
+	# fit one.
+	WEIGHTS = 0
+	ORDER = 1
+	
+	@staticmethod
+	def create( neighbor, weight ):
+		try:
+			order = array( ID_TYPECODE, [neighbor] )
+		except OverflowError:
+			order = [neighbor]
+		return ({neighbor: weight}, order)
+	
+	@staticmethod
+	def copy( bucket ):
+		return (dict( bucket[ Bucket.WEIGHTS ] ), bucket[ Bucket.ORDER ][:])
+	
+	@staticmethod
+	def ordered( bucket ):
+		# Every neighbor in the weights is in the order, so the order holds
+		# nothing else if the lengths match. Otherwise it is compacted, and
+		# the last copy of each neighbor is the one from when its edge was
+		# made.
+		(weights, order) = bucket
+		if len( order ) == len( weights ):
+			return order
+		
+		seen = set()
+		kept = []
+		for neighbor in reversed( order ):
+			if neighbor in weights and neighbor not in seen:
+				seen.add( neighbor )
+				kept.append( neighbor )
+		kept.reverse()
+		
+		del order[:]
+		order.extend( kept )
+		return order
+
+
 class Node:
 	ID = 0
-	PROPERTIES = 1
-	FORWARD_EDGES = 2
-	BACKWARD_EDGES = 3
+	FORWARD_EDGES = 1
+	BACKWARD_EDGES = 2
 	
-	@staticmethod
-	def create( id, props, forward, backward ):
-		return [id, props, forward, backward]
+	# Graph.epoch at which this version of the node was made; see
+	# Graph._node_for_write().
+	EPOCH = 3
+	
+	# Properties are not stored on the node, see Graph.columns.
 	
 	@staticmethod
-	def get_property( node, key ):
-		props = node[ Node.PROPERTIES ]
-		for entry in props:
-			if entry[0] == key:
-				return entry[1]
-		return None
+	def create( id, forward, backward, epoch = 0 ):
+		return [id, forward, backward, epoch]
 	
 	@staticmethod
-	def set_property( node, key, value ):
-		props = node[ Node.PROPERTIES ]
-		for i in range( len( props ) ):
-			if props[i][0] == key:
-				props[i] = (props[i][0], value)
-				return False
+	def copy( node, epoch ):
+		forward = {}
+		for (type_id, bucket) in node[ Node.FORWARD_EDGES ].iteritems():
+			forward[ type_id ] = Bucket.copy( bucket )
 		
-		props.append( (key, value) )
-		return True
+		backward = {}
+		for (type_id, bucket) in node[ Node.BACKWARD_EDGES ].iteritems():
+			backward[ type_id ] = Bucket.copy( bucket )
+		
+		return Node.create( node[ Node.ID ], forward, backward, epoch )
 	
 	@staticmethod
-	def remove_property( node, key ):
-		props = node[ Node.PROPERTIES ]
-		for i in range in props:
-			if props[i][0] == key:
-				del props[i]
-				return None
-		return None
+	def _add_edge( buckets, type_id, neighbor, weight ):
+		bucket = buckets.get( type_id )
+		if bucket is None:
+			buckets[ type_id ] = Bucket.create( neighbor, weight )
+			return True
+		
+		(weights, order) = bucket
+		created = neighbor not in weights
+		weights[ neighbor ] = weight
+		if created:
+			try:
+				order.append( neighbor )
+			except OverflowError:
+				buckets[ type_id ] = (weights, list( order ) + [neighbor])
+				return True
+			
+			# Bounds the gone neighbors when edges are made and removed
+			# over and over without EDGES being asked for.
+			if len( order ) > 2 * len( weights ) + 8:
+				Bucket.ordered( bucket )
+		return created
 	
+	@staticmethod
+	def _remove_edge( buckets, type_id, neighbor ):
+		bucket = buckets.get( type_id )
+		if bucket is None or neighbor not in bucket[ Bucket.WEIGHTS ]:
+			return False
+		
+		weights = bucket[ Bucket.WEIGHTS ]
+		del weights[ neighbor ]
+		if not weights:
+			del buckets[ type_id ]
+		return True
+	
+	@staticmethod
+	def _neighbors( buckets, type_ids ):
+		out = []
+		for type_id in type_ids:
+			bucket = buckets.get( type_id )
+			if bucket is not None:
+				out.extend( bucket[ Bucket.WEIGHTS ] )
+		return out
 	
 	@staticmethod
 	def add_forward_edge( node, edge ):
-		edges = node[ Node.FORWARD_EDGES ]
-		for i in range( len( edges ) ):
-			if edges[i][0] == edge[0]:
-				if edges[i][1] == edge[1]:
-					if edges[i][2] == edge[2]:
-						edges[i] = edge
-						return False
-		
-		edges.append( edge )
-		return True
+		return Node._add_edge( node[ Node.FORWARD_EDGES ], edge[ Edge.TYPE ], edge[ Edge.TARGET ], edge[ Edge.WEIGHT ] )
 		
 	@staticmethod
 	def add_backward_edge( node, edge ):
-		edges = node[ Node.BACKWARD_EDGES]
-		for i in range( len( edges ) ):
-			if edges[i][0] == edge[0]:
-				if edges[i][1] == edge[1]:
-					if edges[i][2] == edge[2]:
-						edges[i] = edge
-						return False
-		
-		edges.append( edge )
-		return True
+		return Node._add_edge( node[ Node.BACKWARD_EDGES ], edge[ Edge.TYPE ], edge[ Edge.SOURCE ], edge[ Edge.WEIGHT ] )
 			
 	@staticmethod
 	def remove_forward_edge( node, edge ):
-		edges = node[ Node.FORWARD_EDGES ]
-		for i in range( len( edges ) ):
-			if edges[i][0] == edge[0]:
-				if edges[i][1] == edge[1]:
-					if edges[i][2] == edge[2]:
-						del edges[i]
-						return True
-		return False
-		
+		return Node._remove_edge( node[ Node.FORWARD_EDGES ], edge[ Edge.TYPE ], edge[ Edge.TARGET ] )
 
 	@staticmethod
 	def remove_backward_edge( node, edge ):
-		edges = node[ Node.BACKWARD_EDGES ]
-		for i in range( len( edges ) ):
-			if edges[i][0] == edge[0]:
-				if edges[i][1] == edge[1]:
-					if edges[i][2] == edge[2]:
-						del edges[i]
-						return True
-		return False
+		return Node._remove_edge( node[ Node.BACKWARD_EDGES ], edge[ Edge.TYPE ], edge[ Edge.SOURCE ] )
 		
 	@staticmethod
 	def get_forward( node ):
-		edges = node[ Node.FORWARD_EDGES ]
-		return edges
+		buckets = node[ Node.FORWARD_EDGES ]
+		source = node[ Node.ID ]
+		out = []
+		for type_id in sorted( buckets.keys() ):
+			weights = buckets[ type_id ][ Bucket.WEIGHTS ]
+			for target in Bucket.ordered( buckets[ type_id ] ):
+				out.append( Edge.create( source, target, type_id, weights[ target ] ) )
+		return out
 
 	@staticmethod
 	def get_backward( node ):
-		edges = node[ Node.BACKWARD_EDGES ]
-		return edges
+		buckets = node[ Node.BACKWARD_EDGES ]
+		target = node[ Node.ID ]
+		out = []
+		for type_id in sorted( buckets.keys() ):
+			weights = buckets[ type_id ][ Bucket.WEIGHTS ]
+			for source in Bucket.ordered( buckets[ type_id ] ):
+				out.append( Edge.create( source, target, type_id, weights[ source ] ) )
+		return out
+	
+	@staticmethod
+	def get_forward_targets( node, type_ids ):
+		return Node._neighbors( node[ Node.FORWARD_EDGES ], type_ids )
+
+	@staticmethod
+	def get_backward_sources( node, type_ids ):
+		return Node._neighbors( node[ Node.BACKWARD_EDGES ], type_ids )
+
+
+_INFINITY = float( "inf" )
+
+# Characters a numeric string can start with; see sort_key().
+_NUMERIC_START = "0123456789+-. \t\r\n"
+
+def sort_key( value ):
+	# Orders numeric strings by their value and everything else
+	# lexicographically after the numbers.
+	try:
+		number = float( value )
+	except (TypeError, ValueError, OverflowError):
+		return (1, value)
+	
+	if number != number or abs( number ) == _INFINITY:
+		return (1, value)
+	return (0, number)
+
+
+def _between( value, bounds ):
+	# Like OrderedIndex.find(), a value with the same sort key as an end
+	# of the range, but not equal to it, is outside.
+	(low, high) = bounds
+	key = sort_key( value )
+	(low_key, high_key) = (sort_key( low ), sort_key( high ))
+	if not low_key <= key <= high_key:
+		return False
+	return ( key != low_key or value == low ) and ( key != high_key or value == high )
+
+
+class HashIndex( object ):
+	KIND = "HASH"
+	
+	def __init__( self ):
+		self.entries = {}
+	
+	def add( self, value, node_id ):
+		if value not in self.entries:
+			self.entries[ value ] = set()
+		self.entries[ value ].add( node_id )
+	
+	def remove( self, value, node_id ):
+		if value not in self.entries:
+			return
+		
+		nodes = self.entries[ value ]
+		nodes.discard( node_id )
+		if not nodes:
+			del self.entries[ value ]
+	
+	def find( self, operator, value, column ):
+		if operator != '=':
+			return None
+		return list( self.entries.get( value, () ) )
+
+
+class OrderedIndex( object ):
+	KIND = "ORDERED"
+	
+	def __init__( self ):
+		# Sorted list of ( sort_key( value ), node_id ).
+		self.entries = []
+	
+	def add( self, value, node_id ):
+		insort( self.entries, (sort_key( value ), node_id) )
+	
+	def remove( self, value, node_id ):
+		entry = (sort_key( value ), node_id)
+		i = bisect_left( self.entries, entry )
+		if i < len( self.entries ) and self.entries[i] == entry:
+			del self.entries[i]
+	
+	def _before( self, value ):
+		return bisect_left( self.entries, (sort_key( value ),) )
+	
+	def _after( self, value ):
+		return bisect_left( self.entries, (sort_key( value ), _INFINITY) )
+	
+	def _ids( self, start, end ):
+		return [entry[1] for entry in self.entries[ start:end ]]
+	
+	def _exact( self, start, end, value, column ):
+		# Values with the same sort key, such as "5" and "5.0", are next to
+		# each other; '=' and the ends of BETWEEN only match value itself.
+		return [node_id for (key, node_id) in self.entries[ start:end ] if column.get( node_id ) == value]
+	
+	def find( self, operator, value, column ):
+		# column: the { node_id: value } column of the indexed property.
+		if operator == '=':
+			return self._exact( self._before( value ), self._after( value ), value, column )
+		
+		elif operator == '<':
+			return self._ids( 0, self._before( value ) )
+		
+		elif operator == '<=':
+			return self._ids( 0, self._after( value ) )
+		
+		elif operator == '>':
+			return self._ids( self._after( value ), None )
+		
+		elif operator == '>=':
+			return self._ids( self._before( value ), None )
+		
+		elif operator == 'BETWEEN':
+			(low, high) = value
+			(low_start, low_end) = (self._before( low ), self._after( low ))
+			(high_start, high_end) = (self._before( high ), self._after( high ))
+			if low_end > high_start:
+				# low and high have the same sort key, or low comes after high.
+				return [node_id for node_id in self._exact( low_start, low_end, low, column ) if column.get( node_id ) == high]
+			
+			result = self._exact( low_start, low_end, low, column )
+			result.extend( self._ids( low_end, high_start ) )
+			result.extend( self._exact( high_start, high_end, high, column ) )
+			return result
+		
+		elif operator == 'PREFIX':
+			# Numbers are ordered by value, not by their string form, so a
+			# prefix that could start a number can't be answered by bisect.
+			if value[:1] in _NUMERIC_START:
+				return None
+			
+			entries = self.entries
+			result = []
+			i = bisect_left( entries, ((1, value),) )
+			while i < len( entries ) and entries[i][0][1].startswith( value ):
+				result.append( entries[i][1] )
+				i += 1
+			return result
+		
+		return None
+
+
+def _pack_ids( ids ):
+	try:
+		return array( ID_TYPECODE, ids ).tostring()
+	except OverflowError:
+		return list( ids )
+
+def _unpack_ids( packed ):
+	if isinstance( packed, str ):
+		ids = array( ID_TYPECODE )
+		ids.fromstring( packed )
+		return ids
+	return packed
 
 
 class Graph(object):
@@ -140,10 +360,38 @@ class Graph(object):
 		self.next_type_id = 1
 		self.next_prop_id = 1
 		
+		# key_id -> { node_id: value }
+		self.columns = {}
+		
+		# key_id -> HashIndex or OrderedIndex
+		self.indexes = {}
+		
+		# Bumped on every change to nodes or edges; a CSR snapshot is only
+		# used while its version matches.
+		self.edge_version = 0
+		self.csr = None
+		
+		# Write epoch and weak references to the versions pinned for
+		# queries; see pin(). A version is dropped from the list as soon as
+		# no query refers to it.
+		self.epoch = 0
+		self.pinned = -1
+		self.versions = []
+		self.latest = None
 		
 	
 	def create( self, id ):
-		self.nodes[id] = Node.create( id, [], [], [] )
+		# Creating a node that exists replaces it with an empty one, so
+		# its edges go from its neighbors too.
+		if id in self.nodes:
+			self._disconnect_all( id )
+			self._clear_properties( id )
+		
+		if self._versioned():
+			self._keep_node( id, self.nodes.get( id ) )
+		
+		self.nodes[id] = Node.create( id, {}, {}, self.epoch )
+		self.edge_version += 1
 	
 	def connect( self, source, target, edge_type, value ):
 		type_id = self.next_type_id
@@ -163,8 +411,9 @@ class Graph(object):
 		
 		edge = Edge.create( source, target, type_id, value )
 		
-		Node.add_forward_edge( self.nodes[ source ], edge )
-		Node.add_backward_edge( self.nodes[ target ], edge )
+		Node.add_forward_edge( self._node_for_write( source ), edge )
+		Node.add_backward_edge( self._node_for_write( target ), edge )
+		self.edge_version += 1
 		
 		
 		return (True, {"source": edge[ Edge.SOURCE ], "target": edge[ Edge.TARGET ], "type": edge_type, "weight": edge[ Edge.WEIGHT ] })
@@ -183,26 +432,35 @@ class Graph(object):
 		
 		edge = Edge.create( source, target, edge_id, 0 )
 		
-		Node.remove_forward_edge( self.nodes[ source ], edge )
-		Node.remove_backward_edge( self.nodes[ target ], edge )
+		Node.remove_forward_edge( self._node_for_write( source ), edge )
+		Node.remove_backward_edge( self._node_for_write( target ), edge )
+		self.edge_version += 1
 		
 		return (True, {"source": edge[ Edge.SOURCE ], "target": edge[ Edge.TARGET ], "type": edge_type, "weight": edge[ Edge.WEIGHT ] })
 	
-	def remove_node( self, node_id ):
-		
-		if node_id not in self.nodes:
-			return (False, "Node (%i) not in graph." % node_id )
-		
-		forwards = self.nodes[node_id][ Node.FORWARD_EDGES ]
-		backwards = self.nodes[node_id][ Node.BACKWARD_EDGES ]
+	def _disconnect_all( self, node_id ):
+		forwards = Node.get_forward( self.nodes[node_id] )
+		backwards = Node.get_backward( self.nodes[node_id] )
 		
 		for edge in forwards:
 			self.disconnect( edge[Edge.SOURCE], edge[Edge.TARGET], self.reverse_types[ edge[Edge.TYPE] ] )
 			
 		for edge in backwards:
 			self.disconnect( edge[Edge.SOURCE], edge[Edge.TARGET], self.reverse_types[ edge[Edge.TYPE] ] )
+	
+	def remove_node( self, node_id ):
+		
+		if node_id not in self.nodes:
+			return (False, "Node (%i) not in graph." % node_id )
+		
+		self._disconnect_all( node_id )
+		self._clear_properties( node_id )
+		
+		if self._versioned():
+			self._keep_node( node_id, self.nodes[ node_id ] )
 		
 		del self.nodes[ node_id ]	
+		self.edge_version += 1
 		
 		return (True, "OK")
 		
@@ -211,43 +469,196 @@ class Graph(object):
 		if node_id not in self.nodes:
 			return (False, "Node (%i) not in graph." % node_id )
 		
-		key_id = self.next_prop_id 
+		key_id = self._get_key_id( key )
+		
+		column = self.columns[ key_id ]
+		old_value = column.get( node_id )
+		
+		if self._versioned():
+			self._keep_value( key_id, node_id, old_value )
+		
+		if key_id in self.indexes:
+			index = self.indexes[ key_id ]
+			if old_value is not None:
+				index.remove( old_value, node_id )
+			index.add( value, node_id )
+		
+		column[ node_id ] = value
+		
+		return (True, "OK")
+	
+	def remove_property( self, node_id, key ):
+		if node_id not in self.nodes:
+			return (False, "Node (%i) not in graph." % node_id )
+		
+		if key not in self.props:
+			return (True, "OK")
+		
+		key_id = self.props[key]
+		old_value = self.columns[ key_id ].pop( node_id, None )
+		if old_value is None:
+			return (True, "OK")
+		
+		if self._versioned():
+			self._keep_value( key_id, node_id, old_value )
+		
+		if key_id in self.indexes:
+			self.indexes[ key_id ].remove( old_value, node_id )
+		
+		return (True, "OK")
+	
+	def _clear_properties( self, node_id ):
+		for (key_id, column) in self.columns.iteritems():
+			old_value = column.pop( node_id, None )
+			if old_value is None:
+				continue
+			
+			if self._versioned():
+				self._keep_value( key_id, node_id, old_value )
+			
+			if key_id in self.indexes:
+				self.indexes[ key_id ].remove( old_value, node_id )
+	
+	def pin( self ):
+		# Returns a GraphVersion that keeps reading the graph as it is now,
+		# whatever is written later. Versions pinned with no write in
+		# between are shared.
+		latest = None
+		if self.latest is not None:
+			latest = self.latest()
+		if latest is not None and latest.epoch == self.epoch:
+			return latest
+		
+		version = GraphVersion( self )
+		self.latest = weakref.ref( version, self._unpin )
+		self.versions.append( self.latest )
+		self.pinned = self.epoch
+		return version
+	
+	def _unpin( self, ref ):
+		# clear() and restore() start a new list.
+		if ref in self.versions:
+			self.versions.remove( ref )
+	
+	def _versioned( self ):
+		# True if a pinned version may still read what is about to change.
+		# The first write after a pin starts a new epoch, so nodes copied
+		# from then on are never shared with a pinned version.
+		if not self.versions:
+			return False
+		
+		if self.pinned == self.epoch:
+			self.epoch += 1
+		return True
+	
+	def _keep_node( self, node_id, node ):
+		# Hands node, the current version of node_id or None, to the pinned
+		# versions that haven't kept one since they were pinned. Returns
+		# True if any did.
+		kept = False
+		for ref in self.versions:
+			version = ref()
+			if version is not None and node_id not in version.saved_nodes:
+				version.saved_nodes[ node_id ] = node
+				kept = True
+		return kept
+	
+	def _keep_value( self, key_id, node_id, value ):
+		for ref in self.versions:
+			version = ref()
+			if version is None:
+				continue
+			
+			saved = version.saved_values.get( key_id )
+			if saved is None:
+				saved = {}
+				version.saved_values[ key_id ] = saved
+			if node_id not in saved:
+				saved[ node_id ] = value
+	
+	def _node_for_write( self, node_id ):
+		# Returns the node to change in place: copy-on-write, if a pinned
+		# version still reads the node as it was before this epoch.
+		node = self.nodes[ node_id ]
+		if not self._versioned() or node[ Node.EPOCH ] == self.epoch:
+			return node
+		
+		if self._keep_node( node_id, node ):
+			node = Node.copy( node, self.epoch )
+			self.nodes[ node_id ] = node
+		else:
+			node[ Node.EPOCH ] = self.epoch
+		return node
+	
+	def _get_key_id( self, key ):
 		if key in self.props:
-			key_id = self.props[key]
+			return self.props[key]
+		
+		key_id = self.next_prop_id
+		self.props[key] = key_id
+		self.reverse_props[ key_id ] = key
+		self.columns[ key_id ] = {}
+		self.next_prop_id += 1
+		return key_id
+	
+	def create_index( self, key, kind = "HASH" ):
+		if kind == "HASH":
+			index = HashIndex()
+		elif kind == "ORDERED":
+			index = OrderedIndex()
 		else:
-			self.props[key] = self.next_prop_id
-			self.reverse_props[ self.next_prop_id ] = key
-			self.next_prop_id += 1
+			return (False, "Index type (%s) is not defined." % kind )
 		
-		node = self.nodes[ node_id ]
-		Node.set_property( node, key_id, value )
+		key_id = self._get_key_id( key )
+		if isinstance( self.indexes.get( key_id ), index.__class__ ):
+			return (True, "OK")
+		
+		for (node_id, value) in self.columns[ key_id ].iteritems():
+			index.add( value, node_id )
+		
+		self.indexes[ key_id ] = index
 		
 		return (True, "OK")
 	
+	# Returns None when the key has no index that can answer the operator.
+	def find_indexed( self, key, operator, value ):
+		key_id = self.props.get( key )
+		if key_id is None or key_id not in self.indexes:
+			return None
+		
+		return self.indexes[ key_id ].find( operator, value, self.columns[ key_id ] )
+	
 	def get_property( self, node_id, key ):
 		if node_id not in self.nodes:
 			return (False, "Node (%i) not in graph." % node_id )
 
 		key_id = self.props[key]
-		node = self.nodes[ node_id ]
-		return Node.get_property( node, key_id )
+		return self.columns[ key_id ].get( node_id )
+	
+	# Returns the { node_id: value } column of a property, empty if the
+	# property has never been set.
+	def get_column( self, key ):
+		key_id = self.props.get( key )
+		if key_id is None:
+			return {}
+		return self.columns[ key_id ]
+	
+	def has_node( self, node_id ):
+		return node_id in self.nodes
 	
 	def get_node( self, node_id ):
 		if node_id not in self.nodes:
 			return (False, "Node (%i) not in graph." % node_id )
 		
-		node = self.nodes[node_id]
-		
 		out = {}
 		out["id"] = node_id
 		
 		out["properties"] = {}
 		
-		for entry in node[ Node.PROPERTIES ]:
-			key = self.reverse_props[ entry[0] ]
-			value = entry[1]
-			
-			out["properties"][key] = value
+		for (key_id, column) in self.columns.iteritems():
+			if node_id in column:
+				key = self.reverse_props[ key_id ]
+				out["properties"][key] = column[ node_id ]
 		
 		return (True, out)
 	
@@ -255,7 +666,7 @@ class Graph(object):
 		if node_id not in self.nodes:
 			return (False, "Node (%i) not in graph." % node_id )
 
-		edges = self.nodes[node_id][ Node.FORWARD_EDGES ]
+		edges = Node.get_forward( self.nodes[node_id] )
 		
 		out = []
 		
@@ -270,7 +681,7 @@ class Graph(object):
 		if node_id not in self.nodes:
 			return (False, "Node (%i) not in graph." % node_id )
 
-		edges = self.nodes[node_id][ Node.BACKWARD_EDGES ]
+		edges = Node.get_backward( self.nodes[node_id] )
 		
 		out = []
 		
@@ -281,64 +692,645 @@ class Graph(object):
 		
 		return (True, out)
 	
+	def get_type_ids( self, types ):
+		out = []
+		for edge_type in types:
+			type_id = self.types.get( edge_type )
+			if type_id is not None and type_id not in out:
+				out.append( type_id )
+		return out
+	
+	def freeze( self, checkpoint = None ):
+		# See CSRGraph.build() for checkpoint. A build that gives up leaves
+		# the old snapshot, which is out of date, in place.
+		csr = CSRGraph.build( self, Node.FORWARD_EDGES, Node.BACKWARD_EDGES, Bucket.WEIGHTS, checkpoint )
+		if csr is not None:
+			self.csr = csr
+		return (True, "OK")
+	
+	def snapshot( self ):
+		# The whole graph as plain data (ints, strings, lists and dicts)
+		# for Storage to serialize; see restore(). Id lists are packed
+		# into array strings when the ids fit.
+		edges = {}
+		for type_id in self.reverse_types:
+			edges[ type_id ] = ([], [], [])
+		
+		for node in self.nodes.itervalues():
+			source = node[ Node.ID ]
+			for (type_id, bucket) in node[ Node.FORWARD_EDGES ].iteritems():
+				(sources, targets, weights) = edges[ type_id ]
+				order = Bucket.ordered( bucket )
+				sources.extend( [source] * len( order ) )
+				targets.extend( order )
+				weights.extend( map( bucket[ Bucket.WEIGHTS ].__getitem__, order ) )
+		
+		for (type_id, (sources, targets, weights)) in edges.items():
+			edges[ type_id ] = (_pack_ids( sources ), _pack_ids( targets ), weights)
+		
+		columns = {}
+		for (key_id, column) in self.columns.iteritems():
+			columns[ key_id ] = (_pack_ids( column.keys() ), column.values())
+		
+		indexes = {}
+		for (key_id, index) in self.indexes.iteritems():
+			indexes[ key_id ] = index.KIND
+		
+		return {
+			"nodes": _pack_ids( self.nodes.keys() ),
+			"types": self.types,
+			"props": self.props,
+			"next_type_id": self.next_type_id,
+			"next_prop_id": self.next_prop_id,
+			"edges": edges,
+			"columns": columns,
+			"indexes": indexes,
+			}
+	
+	def restore( self, state ):
+		# Replaces the contents of the graph with a snapshot() state.
+		self.__init__()
+		
+		nodes = self.nodes
+		for node_id in _unpack_ids( state["nodes"] ):
+			nodes[ node_id ] = Node.create( node_id, {}, {} )
+		
+		self.types = dict( state["types"] )
+		self.props = dict( state["props"] )
+		for (name, type_id) in self.types.iteritems():
+			self.reverse_types[ type_id ] = name
+		for (key, key_id) in self.props.iteritems():
+			self.reverse_props[ key_id ] = key
+		self.next_type_id = state["next_type_id"]
+		self.next_prop_id = state["next_prop_id"]
+		
+		# Snapshots taken before CREATE dropped the edges of the node it
+		# replaced can hold edges to nodes that are gone; those are left out.
+		add_edge = Node._add_edge
+		for (type_id, (sources, targets, weights)) in state["edges"].iteritems():
+			for (source, target, weight) in zip( _unpack_ids( sources ), _unpack_ids( targets ), weights ):
+				if source not in nodes or target not in nodes:
+					continue
+				add_edge( nodes[ source ][ Node.FORWARD_EDGES ], type_id, target, weight )
+				add_edge( nodes[ target ][ Node.BACKWARD_EDGES ], type_id, source, weight )
+		
+		for (key_id, (node_ids, values)) in state["columns"].iteritems():
+			self.columns[ key_id ] = dict( zip( _unpack_ids( node_ids ), values ) )
+		
+		for (key_id, kind) in state["indexes"].iteritems():
+			self.create_index( self.reverse_props[ key_id ], kind )
+		
+		self.edge_version += 1
+	
+	def clear( self ):
+		# Removes everything from the graph.
+		version = self.edge_version
+		self.__init__()
+		self.edge_version = version + 1
+	
+	def dump( self, batch_size ):
+		# The graph as a list of (op, params) commands that rebuild it, with
+		# up to batch_size items per batch command; used to bring a replica
+		# up to date when the log no longer reaches back far enough.
+		commands = []
+		
+		def add( op, width, params ):
+			step = width * batch_size
+			for offset in xrange( 0, len( params ), step ):
+				commands.append( (op, params[ offset:offset + step ]) )
+		
+		add( "MCREATE", 1, self.nodes.keys() )
+		
+		for (key_id, column) in self.columns.iteritems():
+			key = self.reverse_props[ key_id ]
+			params = []
+			for (node_id, value) in column.iteritems():
+				params.extend( (node_id, key, value) )
+			add( "MSET", 3, params )
+		
+		# An edge to a node that is gone would make the replica refuse the
+		# whole batch; see restore().
+		nodes = self.nodes
+		params = []
+		for node in nodes.itervalues():
+			source = node[ Node.ID ]
+			for (type_id, bucket) in node[ Node.FORWARD_EDGES ].iteritems():
+				edge_type = self.reverse_types[ type_id ]
+				weights = bucket[ Bucket.WEIGHTS ]
+				for target in Bucket.ordered( bucket ):
+					if target in nodes:
+						params.extend( (source, target, edge_type, weights[ target ]) )
+		add( "MCONNECT", 4, params )
+		
+		for (key_id, index) in self.indexes.iteritems():
+			commands.append( ("INDEX", [self.reverse_props[ key_id ], index.KIND]) )
+		
+		return commands
 
+	def get_csr( self ):
+		csr = self.csr
+		if csr is not None and csr.version == self.edge_version:
+			return csr
+		return None
+	
+	def get_forward_targets( self, node_ids, types ):
+		type_ids = self.get_type_ids( types )
+		out = []
+		if not type_ids:
+			return out
+		
+		csr = self.get_csr()
+		if csr is not None:
+			return csr.get_forward_targets( node_ids, type_ids )
+		
+		nodes = self.nodes
+		for node_id in node_ids:
+			node = nodes.get( node_id )
+			if node is not None:
+				out.extend( Node.get_forward_targets( node, type_ids ) )
+		return out
 
-class QueryEngine( object ):
+	def get_backward_sources( self, node_ids, types ):
+		type_ids = self.get_type_ids( types )
+		out = []
+		if not type_ids:
+			return out
+		
+		csr = self.get_csr()
+		if csr is not None:
+			return csr.get_backward_sources( node_ids, type_ids )
+		
+		nodes = self.nodes
+		for node_id in node_ids:
+			node = nodes.get( node_id )
+			if node is not None:
+				out.extend( Node.get_backward_sources( node, type_ids ) )
+		return out
+
+
+
+	def _search_level( self, frontier, type_ids, direction, depths, parents, other_depths ):
+		# Expands one BFS level. Returns the next frontier and the node where
+		# the two searches meet with the shortest total path, if any.
+		next_frontier = []
+		meet = None
+		depth = depths[ frontier[0] ] + 1
+		
+		for node_id in frontier:
+			buckets = self.nodes[ node_id ][ direction ]
+			for type_id in type_ids:
+				bucket = buckets.get( type_id )
+				if bucket is None:
+					continue
+				
+				for neighbor in bucket[ Bucket.WEIGHTS ]:
+					if neighbor in depths:
+						continue
+					
+					depths[ neighbor ] = depth
+					parents[ neighbor ] = node_id
+					next_frontier.append( neighbor )
+					
+					if neighbor in other_depths:
+						if meet is None or other_depths[ neighbor ] < other_depths[ meet ]:
+							meet = neighbor
+		
+		return (next_frontier, meet)
+	
+	def shortest_path( self, source, target, types, max_depth, max_visited = None ):
+		# Bidirectional BFS: forward edges from the source, backward edges
+		# from the target, always growing the smaller frontier.
+		if source not in self.nodes:
+			return (False, "Source node (%i) not in graph." % source )
+		
+		if target not in self.nodes:
+			return (False, "Target node (%i) not in graph." % target )
+		
+		if source == target:
+			return (True, [source])
+		
+		type_ids = self.get_type_ids( types )
+		
+		forward_depths = {source: 0}
+		forward_parents = {}
+		forward_frontier = [source]
+		
+		backward_depths = {target: 0}
+		backward_parents = {}
+		backward_frontier = [target]
+		
+		depth = 0
+		while forward_frontier and backward_frontier and depth < max_depth:
+			depth += 1
+			
+			if len( forward_frontier ) <= len( backward_frontier ):
+				(forward_frontier, meet) = self._search_level( forward_frontier, type_ids, Node.FORWARD_EDGES, forward_depths, forward_parents, backward_depths )
+			else:
+				(backward_frontier, meet) = self._search_level( backward_frontier, type_ids, Node.BACKWARD_EDGES, backward_depths, backward_parents, forward_depths )
+			
+			if meet is not None:
+				path = [meet]
+				while path[0] != source:
+					path.insert( 0, forward_parents[ path[0] ] )
+				while path[-1] != target:
+					path.append( backward_parents[ path[-1] ] )
+				return (True, path)
+			
+			if max_visited is not None and len( forward_depths ) + len( backward_depths ) > max_visited:
+				return (False, "Visited node limit (%i) exceeded." % max_visited )
+		
+		return (True, [])
+	
+	def weighted_path( self, source, target, types, max_depth, max_visited = None ):
+		# Dijkstra over forward edges using the numeric edge weights. A node
+		# reached again is only expanded if it was reached with fewer hops,
+		# so cheaper paths longer than max_depth edges don't hide shorter ones.
+		if source not in self.nodes:
+			return (False, "Source node (%i) not in graph." % source )
+		
+		if target not in self.nodes:
+			return (False, "Target node (%i) not in graph." % target )
+		
+		type_ids = self.get_type_ids( types )
+		
+		heap = [(0.0, 0, source, None)]
+		settled = {}
+		
+		while heap:
+			(cost, hops, node_id, trail) = heappop( heap )
+			if settled.get( node_id, max_depth + 1 ) <= hops:
+				continue
+			
+			settled[ node_id ] = hops
+			trail = (node_id, trail)
+			
+			if node_id == target:
+				path = []
+				while trail is not None:
+					path.insert( 0, trail[0] )
+					trail = trail[1]
+				# Whole costs without a fraction, others at full precision.
+				if cost.is_integer():
+					return (True, {"cost": "%i" % cost, "path": path})
+				return (True, {"cost": repr( cost ), "path": path})
+			
+			if max_visited is not None and len( settled ) > max_visited:
+				return (False, "Visited node limit (%i) exceeded." % max_visited )
+			
+			if hops >= max_depth:
+				continue
+			
+			buckets = self.nodes[ node_id ][ Node.FORWARD_EDGES ]
+			for type_id in type_ids:
+				bucket = buckets.get( type_id )
+				if bucket is None:
+					continue
+				
+				for (neighbor, weight) in bucket[ Bucket.WEIGHTS ].iteritems():
+					try:
+						weight = float( weight )
+					except (TypeError, ValueError):
+						return (False, "Edge weight (%s) is not numeric." % weight )
+					
+					if not weight >= 0:
+						return (False, "Edge weight (%s) must be non-negative." % weight )
+					
+					heappush( heap, (cost + weight, hops + 1, neighbor, trail) )
+		
+		return (True, {"cost": "", "path": []})
+
+
+class ColumnVersion( object ):
+	# A property column as a GraphVersion reads it: the values saved for
+	# the version, or the live column where nothing was saved.
+	def __init__( self, column, saved ):
+		self.column = column
+		self.saved = saved
+	
+	def get( self, node_id ):
+		if node_id in self.saved:
+			return self.saved[ node_id ]
+		return self.column.get( node_id )
+	
+	def keys( self ):
+		saved = self.saved
+		ids = [node_id for node_id in self.column if node_id not in saved]
+		ids.extend( [node_id for (node_id, value) in saved.iteritems() if value is not None] )
+		return ids
+
+
+class GraphVersion( object ):
+	# The nodes, edges and properties of a Graph as they were when
+	# Graph.pin() returned this. Writes made while it is referenced save
+	# the node versions and property values it reads into saved_nodes and
+	# saved_values (None if there was none); everything else is read from
+	# the graph. Nothing here is ever changed in place, so the saved
+	# versions go away with the last query that refers to it.
+	
 	def __init__( self, graph ):
+		self.epoch = graph.epoch
+		
+		# clear() and restore() replace these instead of changing them.
+		self.nodes = graph.nodes
+		self.columns = graph.columns
+		self.types = graph.types
+		self.props = graph.props
+		
+		self.csr = graph.get_csr()
+		
+		self.saved_nodes = {}
+		self.saved_values = {}
+	
+	def _node( self, node_id ):
+		if node_id in self.saved_nodes:
+			return self.saved_nodes[ node_id ]
+		return self.nodes.get( node_id )
+	
+	def has_node( self, node_id ):
+		return self._node( node_id ) is not None
+	
+	def get_column( self, key ):
+		key_id = self.props.get( key )
+		if key_id is None:
+			return {}
+		
+		saved = self.saved_values.get( key_id )
+		if saved is None:
+			saved = {}
+			self.saved_values[ key_id ] = saved
+		return ColumnVersion( self.columns[ key_id ], saved )
+	
+	def get_type_ids( self, types ):
+		out = []
+		for edge_type in types:
+			type_id = self.types.get( edge_type )
+			if type_id is not None and type_id not in out:
+				out.append( type_id )
+		return out
+	
+	def _collect( self, node_ids, type_ids, direction ):
+		out = []
+		for node_id in node_ids:
+			node = self._node( node_id )
+			if node is not None:
+				out.extend( Node._neighbors( node[ direction ], type_ids ) )
+		return out
+	
+	def get_forward_targets( self, node_ids, types ):
+		type_ids = self.get_type_ids( types )
+		if not type_ids:
+			return []
+		
+		if self.csr is not None:
+			return self.csr.get_forward_targets( node_ids, type_ids )
+		return self._collect( node_ids, type_ids, Node.FORWARD_EDGES )
+	
+	def get_backward_sources( self, node_ids, types ):
+		type_ids = self.get_type_ids( types )
+		if not type_ids:
+			return []
+		
+		if self.csr is not None:
+			return self.csr.get_backward_sources( node_ids, type_ids )
+		return self._collect( node_ids, type_ids, Node.BACKWARD_EDGES )
+
+
+# Number of ids a SCAN returns when no COUNT is given.
+SCAN_COUNT = 1000
+
+# Seconds a command may run before its long operations pause; see
+# QueryEngine.begin().
+TIME_SLICE = 0.005
+
+def _neighbors( view, nodes, types, direction ):
+	# view is a Graph or a GraphVersion.
+	if direction == "FORWARD":
+		return view.get_forward_targets( nodes, types )
+	elif direction == "BACKWARD":
+		return view.get_backward_sources( nodes, types )
+	
+	out = view.get_forward_targets( nodes, types )
+	out.extend( view.get_backward_sources( nodes, types ) )
+	return out
+
+def _property_test( view, key, value, predicate ):
+	# Returns test( node_id ) for a FILTER/FIND on the column of key as it
+	# is now in view. "id" matches the hex id of nodes that have no "id"
+	# property.
+	column = view.get_column( key )
+	
+	def test( node_id ):
+		node_value = column.get( node_id )
+		
+		if node_value is None:
+			if key != "id" or not view.has_node( node_id ):
+				return False
+			node_value = "%x" % node_id
+		
+		return predicate( node_value, value )
+	
+	return test
+
+class QueryEngine( object ):
+	def __init__( self, graph, pause = None, time_slice = TIME_SLICE, isolated = False ):
 		self.graph = graph
 		self.querysets = {}
 		
-		self.results = []
+		# With isolated set, START and FIND pin a version of the graph (see
+		# Graph.pin()) and the queryset commands after them read that
+		# version, whatever is written in between. Otherwise view is the
+		# live graph.
+		self.isolated = isolated
+		self.view = graph
+		
+		# With pause given, FIND, FILTER, FORWARD, BACKWARD, EXPAND and lazy
+		# querysets work through their ids QuerySet.CHUNK_SIZE at a time,
+		# and call pause() between chunks once the command has run for
+		# time_slice seconds, e.g. to let other greenlets run. Unless the
+		# engine is isolated, the graph may change during a pause and each
+		# chunk sees the graph as it is then.
+		self.pause = pause
+		self.time_slice = time_slice
+		self.deadline = 0.0
+		
+		# Querysets that may hold duplicates (APPEND results).
+		self.multisets = set()
+		
+		# In lazy mode FORWARD, BACKWARD, FILTER, INTERSECTION and DIFFERENCE
+		# store a QuerySet.Plan that is evaluated when the result is needed.
+		self.lazy = False
 		
 		self.predicates = {
 			'=' : lambda v0, v1: v0 == v1,
 			'!=': lambda v0, v1: v0 != v1,
+			'<' : lambda v0, v1: sort_key( v0 ) < sort_key( v1 ),
+			'<=': lambda v0, v1: sort_key( v0 ) <= sort_key( v1 ),
+			'>' : lambda v0, v1: sort_key( v0 ) > sort_key( v1 ),
+			'>=': lambda v0, v1: sort_key( v0 ) >= sort_key( v1 ),
+			'BETWEEN': _between,
+			'PREFIX': lambda v0, v1: isinstance( v0, basestring ) and v0.startswith( v1 ),
 			}
 	
+	def begin( self ):
+		# Starts the time slice of a command.
+		self.deadline = time.time() + self.time_slice
+	
+	def _checkpoint( self ):
+		if time.time() >= self.deadline:
+			self.pause()
+			self.begin()
+	
+	def _chunked( self, ids ):
+		# Without pause ids are a single chunk; otherwise they come in
+		# chunks with checkpoints in between.
+		if self.pause is None or len( ids ) <= QuerySet.CHUNK_SIZE:
+			return [ids]
+		return self._chunks( ids )
+	
+	def _chunks( self, ids ):
+		for offset in xrange( 0, len( ids ), QuerySet.CHUNK_SIZE ):
+			if offset:
+				self._checkpoint()
+			yield ids[ offset:offset + QuerySet.CHUNK_SIZE ]
+	
+	def _pin( self ):
+		if self.isolated:
+			self.view = self.graph.pin()
+	
+	def _store( self, target, result, multiset = False ):
+		self.querysets[ target ] = result
+		if multiset:
+			self.multisets.add( target )
+		else:
+			self.multisets.discard( target )
+		
+		if isinstance( result, QuerySet.Plan ):
+			return (True, "QUEUED")
+		return (True, len( result ))
+	
+	def _get( self, source ):
+		nodes = self.querysets[ source ]
+		if isinstance( nodes, QuerySet.Plan ):
+			checkpoint = None
+			if self.pause is not None:
+				checkpoint = self._checkpoint
+			nodes = nodes.materialize( checkpoint )
+			self.querysets[ source ] = nodes
+		return nodes
+	
+	def _as_set( self, source ):
+		nodes = self._get( source )
+		if source in self.multisets:
+			return QuerySet.unique( nodes )
+		return nodes
+	
+	def _plan( self, source ):
+		nodes = self.querysets[ source ]
+		if isinstance( nodes, QuerySet.Plan ):
+			return nodes
+		return QuerySet.Plan( nodes, source in self.multisets )
+	
+	def _traversal( self, types, direction ):
+		# Streaming FORWARD/BACKWARD stage. The result is a set, so ids that
+		# an earlier chunk already produced are dropped before any later
+		# stage sees them. Chunks are passed on sorted, like stored querysets.
+		# The stage must not refer to the engine, which would keep the
+		# engine, and so its pinned version, alive until the cyclic
+		# garbage collector runs.
+		view = self.view
+		
+		def stage( chunks ):
+			seen = set()
+			for chunk in chunks:
+				reached = set( _neighbors( view, chunk, types, direction ) ) - seen
+				seen.update( reached )
+				yield sorted( reached )
+		
+		return stage
+	
+	def set_lazy( self, lazy ):
+		self.lazy = lazy
+		return (True, "OK")
+	
+	def count( self, source ):
+		if source not in self.querysets:
+			return (False, "Queryset (%s) not found." % source )
+		
+		return (True, len( self._get( source ) ))
+	
 	def start( self, qset, node_id ):
 		nodes = node_id
 		if isinstance(node_id, int):
 			nodes = [node_id]
 		
-		self.querysets[ qset ] = nodes
-		
-		return (True ,len( self.querysets[ qset ] ) )
+		self._pin()
+		return self._store( qset, QuerySet.from_ids( nodes ) )
 		
 	
 	def forward( self, source, target, types ):
 		if source not in self.querysets:
 			return (False, "Queryset (%s) not found." % source )
-
-		source_nodes = self.querysets[ source ]
 		
+		if self.lazy:
+			return self._store( target, self._plan( source ).then( "map", self._traversal( types, "FORWARD" ), False ) )
+
 		result = []
-		for node in source_nodes:
-			status, edges = self.graph.get_forward_edges( node )
-			for edge in edges:
-				if edge["type"] in types:
-					result.append( edge["target"] )
-		
-		self.querysets[ target ] = result
+		for chunk in self._chunked( self._as_set( source ) ):
+			result.extend( self.view.get_forward_targets( chunk, types ) )
 		
-		return (True, len( result ) )
+		return self._store( target, QuerySet.from_ids( result ) )
 	
 	def backward( self, source, target, types ):
 		if source not in self.querysets:
 			return (False, "Queryset (%s) not found." % source )
+		
+		if self.lazy:
+			return self._store( target, self._plan( source ).then( "map", self._traversal( types, "BACKWARD" ), False ) )
 
-		source_nodes = self.querysets[ source ]
+		result = []
+		for chunk in self._chunked( self._as_set( source ) ):
+			result.extend( self.view.get_backward_sources( chunk, types ) )
+		
+		return self._store( target, QuerySet.from_ids( result ) )
+	
+	
+	def expand( self, source, target, mindepth, maxdepth, types, direction = "FORWARD", limit = None ):
+		# Breadth first search from the source set. Stores the nodes whose
+		# distance from the source set is between mindepth and maxdepth,
+		# nearest first if the result is capped by limit.
+		if source not in self.querysets:
+			return (False, "Queryset (%s) not found." % source )
+		
+		if direction not in ["FORWARD", "BACKWARD", "BOTH"]:
+			return (False, "Direction (%s) is not defined." % direction )
+		
+		frontier = self._as_set( source )
+		visited = set( frontier )
 		
 		result = []
-		for node in source_nodes:
-			status, edges = self.graph.get_backward_edges( node )
-			for edge in edges:
-				if edge["type"] in types:
-					result.append( edge["source"] )
+		if mindepth == 0:
+			result.extend( frontier )
 		
-		self.querysets[ target ] = result
+		depth = 0
+		while frontier and depth < maxdepth:
+			if limit is not None and len( result ) >= limit:
+				break
+			
+			depth += 1
+			reached = set()
+			for chunk in self._chunked( frontier ):
+				reached.update( _neighbors( self.view, chunk, types, direction ) )
+			reached.difference_update( visited )
+			visited.update( reached )
+			
+			frontier = sorted( reached )
+			if depth >= mindepth:
+				result.extend( frontier )
 		
-		return (True, len( result ) )
-	
+		if limit is not None:
+			result = result[ :limit ]
+		
+		return self._store( target, QuerySet.from_ids( result ) )
 	
 	def filter( self, source, target, key, value, operator ):
 		if source not in self.querysets:
@@ -348,35 +1340,23 @@ class QueryEngine( object ):
 			return (False, "Operator (%s) is not defined." % operator )
 
 		
-		predicate = self.predicates[ operator ]
+		multiset = source in self.multisets
 		
-		source_nodes = self.querysets[ source ]
-		result = []
+		if self.lazy:
+			return self._store( target, self._plan( source ).then( "map", self._select( key, value, operator ), multiset ), multiset )
 		
-		for node_id in source_nodes:
-			status, node = self.graph.get_node( node_id )
-			if predicate( node[key], value ):
-				result.append( node_id )
+		source_nodes = self._get( source )
 		
-		self.querysets[ target ] = result
+		result = self._scan( source_nodes, key, value, operator )
 		
-		return (True, len( result ))
+		return self._store( target, QuerySet.from_sorted( result ), multiset )
 
 	def unique( self, source, target ):
 		
 		if source not in self.querysets:
 			return (False, "Queryset (%s) not found." % source )
 
-		
-		source_nodes = self.querysets[ source ]
-		result = []
-		for node in source_nodes:
-			if node not in result:
-				result.append( node )
-		
-		self.querysets[ target ] = result
-		
-		return (True, len( result ) )
+		return self._store( target, self._as_set( source ) )
 
 	def append( self, source0, source1, target ):
 		
@@ -386,18 +1366,12 @@ class QueryEngine( object ):
 		if source1 not in self.querysets:
 			return (False, "Queryset (%s) not found." % source1 )
 
+		source_nodes0 = self._get( source0 )
+		source_nodes1 = self._get( source1 )
 		
+		result = QuerySet.append( source_nodes0, source_nodes1 )
 		
-		source_nodes0 = self.querysets[ source0 ]
-		source_nodes1 = self.querysets[ source1 ]
-		result = []
-		
-		result.extend( source_nodes0 )
-		result.extend( source_nodes1 )
-		
-		self.querysets[ target ] = result
-		
-		return (True, len( result ))
+		return self._store( target, result, True )
 
 	
 	def union( self, source0, source1, target ):
@@ -407,18 +1381,9 @@ class QueryEngine( object ):
 		if source1 not in self.querysets:
 			return (False, "Queryset (%s) not found." % source1 )
 
-		source_nodes0 = self.querysets[ source0 ]
-		source_nodes1 = self.querysets[ source1 ]
-		result = []
-		
-		set0 = set( source_nodes0 )
-		set1 = set( source_nodes1 )
+		result = QuerySet.union( self._as_set( source0 ), self._as_set( source1 ) )
 		
-		result = list( set0.union( set1 ) )
-		
-		self.querysets[ target ] = result
-		
-		return (True, len( result ))
+		return self._store( target, result )
 
 	def intersection( self, source0, source1, target ):
 		if source0 not in self.querysets:
@@ -427,18 +1392,13 @@ class QueryEngine( object ):
 		if source1 not in self.querysets:
 			return (False, "Queryset (%s) not found." % source1 )
 
-		source_nodes0 = self.querysets[ source0 ]
-		source_nodes1 = self.querysets[ source1 ]
-		result = []
+		if self.lazy:
+			lookup = set( self._get( source1 ) )
+			return self._store( target, self._plan( source0 ).then( "select", lookup.__contains__, False ) )
 		
-		set0 = set( source_nodes0 )
-		set1 = set( source_nodes1 )
+		result = QuerySet.intersection( self._as_set( source0 ), self._as_set( source1 ) )
 		
-		result = list( set0.intersection( set1 ) )
-		
-		self.querysets[ target ] = result
-		
-		return (True, len( result ))
+		return self._store( target, result )
 
 	def difference( self, source0, source1, target ):
 		if source0 not in self.querysets:
@@ -447,54 +1407,112 @@ class QueryEngine( object ):
 		if source1 not in self.querysets:
 			return (False, "Queryset (%s) not found." % source1 )
 
-		source_nodes0 = self.querysets[ source0 ]
-		source_nodes1 = self.querysets[ source1 ]
-		result = []
+		if self.lazy:
+			lookup = set( self._get( source1 ) )
+			return self._store( target, self._plan( source0 ).then( "select", lambda node_id: node_id not in lookup, False ) )
 		
-		set0 = set( source_nodes0 )
-		set1 = set( source_nodes1 )
+		result = QuerySet.difference( self._as_set( source0 ), self._as_set( source1 ) )
 		
-		result = list( set0.difference( set1 ) )
-		
-		self.querysets[ target ] = result
-		
-		return (True, len( result ))
+		return self._store( target, result )
 
 
 	def find( self, key, value, operator, target ):
 		if operator not in self.predicates:
 			return (False, "Operator (%s) is not defined." % operator )
 		
+		# Until something is written, the live graph is the version pinned
+		# here, so the index lookup and the scan without pauses read it.
+		self._pin()
+		
+		if key != "id":
+			result = self.graph.find_indexed( key, operator, value )
+			if result is not None:
+				return self._store( target, QuerySet.from_ids( result ) )
+		
+		if key == "id":
+			result = self._scan( self.graph.nodes.keys(), key, value, operator )
+		elif self.pause is None:
+			predicate = self.predicates[ operator ]
+			column = self.graph.get_column( key )
+			result = [node_id for (node_id, node_value) in column.iteritems() if predicate( node_value, value )]
+		else:
+			# The column may change between chunks, so it is scanned by a
+			# copy of its ids.
+			result = self._scan( self.view.get_column( key ).keys(), key, value, operator )
+
+		return self._store( target, QuerySet.from_ids( result ) )
+	
+	def _test( self, key, value, operator ):
+		return _property_test( self.view, key, value, self.predicates[ operator ] )
+	
+	def _select( self, key, value, operator ):
+		# Streaming FILTER stage. The column is looked up for every chunk as
+		# it runs, not when the plan is built, since the property may not
+		# exist yet then. Like _traversal(), the stage must not refer to the
+		# engine.
+		view = self.view
 		predicate = self.predicates[ operator ]
 		
-		result = []
+		def stage( chunks ):
+			for chunk in chunks:
+				yield filter( _property_test( view, key, value, predicate ), chunk )
 		
-		for node_id in self.graph.nodes.keys():
-			status, node = self.graph.get_node( node_id )
-			if key in node["properties"]:
-				if predicate( node["properties"][key], value):
-					result.append( node_id )
-			else:
-				if key == "id":
-					if predicate( hex(node["id"])[2:], value ):
-						result.append( node_id )
-				
-
-		self.querysets[ target ] = result
-		return (True, len( result ))
+		return stage
 	
+	def _scan( self, node_ids, key, value, operator ):
+		test = self._test( key, value, operator )
+		result = []
+		for chunk in self._chunked( node_ids ):
+			result.extend( filter( test, chunk ) )
+		return result
+	
+	
+	def fetch( self, source, offset = 0, count = None ):
+		if source not in self.querysets:
+			return (False, "Queryset (%s) not found." % source )
+		
+		nodes = self._get( source )
+		if offset == 0 and count is None:
+			return (True, nodes)
+		
+		if count is None:
+			return (True, nodes[ offset: ])
+		return (True, nodes[ offset:offset + count ])
 	
-	def fetch( self, source ):
+	def scan( self, source, cursor, count = SCAN_COUNT ):
+		# Returns [next cursor, ids]. The cursor is the first id of the next
+		# page, or 0 after the last one. Since querysets are sorted, a scan
+		# returns every id that stays in the set for its whole duration even
+		# if the set is rebuilt in between. Duplicates of an id are never
+		# split between pages.
 		if source not in self.querysets:
 			return (False, "Queryset (%s) not found." % source )
-		self.results.append( self.querysets[ source ] )
-		#return (True, len( self.querysets[ source ] ) )
-		return (True, self.querysets[ source ] )
+		
+		nodes = self._get( source )
+		
+		start = 0
+		if cursor != 0:
+			start = bisect_left( nodes, cursor )
+		
+		end = start + count
+		if end >= len( nodes ):
+			return (True, [0, nodes[ start: ]])
+		
+		end = bisect_right( nodes, nodes[ end - 1 ], end )
+		if end >= len( nodes ):
+			return (True, [0, nodes[ start: ]])
+		
+		return (True, [nodes[ end ], nodes[ start:end ]])
 
 	def clear( self, source ):
 		if source not in self.querysets:
 			return (False, "Queryset (%s) not found." % source )
 
-		del self.queryset[ source ]
+		del self.querysets[ source ]
+		self.multisets.discard( source )
+		
+		# Drops the pinned version once no queryset is left.
+		if not self.querysets:
+			self.view = self.graph
 		
 		return (True, "OK")
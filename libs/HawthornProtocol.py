@@ -17,7 +17,7 @@
 
 import RedisProtocol
 
-import socket
+import itertools, socket, time
 
 def _encode_as_dict( entries ):
 	out = {}
@@ -44,6 +44,10 @@ def _encode_as_two_deep_dict( entries ):
 	return out	
 
 
+def _encode_as_dict_list( entries ):
+	return [_encode_as_dict( entry ) for entry in entries]
+
+
 class HawthornClient( object ):
 	def __init__( self, host, port ):
 		self.host = host
@@ -61,6 +65,13 @@ class HawthornClient( object ):
 	def close( self ):
 		self.conn.close()
 	
+	def _execute( self, command, encoder = None ):
+		self.redis.send_response( command )
+		return self._parse_result( self.redis.receive(), encoder )
+	
+	def pipeline( self ):
+		return HawthornPipeline( self )
+	
 	def _parse_result( self, response, encoder = None ):
 		#print "DEBUG", response
 		if isinstance( response, str ) and response.startswith( "-" ):
@@ -74,80 +85,428 @@ class HawthornClient( object ):
 	
 	
 	def get( self, node_id ):
-		self.redis.send_response( ["GET", node_id] )
-		return self._parse_result( self.redis.receive(), _encode_as_two_deep_dict )
+		return self._execute( ["GET", node_id], _encode_as_two_deep_dict )
 
 	def edges( self, node_id ):
-		self.redis.send_response( ["EDGES", node_id] )
-		return self._parse_result( self.redis.receive(), _encode_as_two_deep_dict )
+		return self._execute( ["EDGES", node_id], _encode_as_two_deep_dict )
 
 		
 	def set( self, node_id, key, value ):
-		self.redis.send_response( ["SET", node_id, key, value] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["SET", node_id, key, value] )
 
 	def unset( self, node_id, key ):
-		self.redis.send_response( ["UNSET", node_id, key] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["UNSET", node_id, key] )
 		
+	def index( self, key, kind = "HASH" ):
+		return self._execute( ["INDEX", key, kind] )
+	
 	def create( self, node_id ):
-		self.redis.send_response( ["CREATE", node_id] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["CREATE", node_id] )
 
 	def delete( self, node_id ):
-		self.redis.send_response( ["DELETE", node_id] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["DELETE", node_id] )
 		
-	def fetch( self, queryset ):
-		self.redis.send_response( ["FETCH", queryset] )
-		return self._parse_result( self.redis.receive() )
+	def fetch( self, queryset, offset = None, count = None ):
+		if offset is None:
+			return self._execute( ["FETCH", queryset] )
+		return self._execute( ["FETCH", queryset, offset, count] )
+	
+	def scan( self, queryset, cursor = 0, count = None ):
+		if count is None:
+			return self._execute( ["SCAN", queryset, cursor] )
+		return self._execute( ["SCAN", queryset, cursor, "COUNT", count] )
+	
+	def scan_iter( self, queryset, count = None ):
+		# Yields the ids of a queryset a page at a time.
+		cursor = 0
+		while True:
+			response = self.scan( queryset, cursor, count )
+			if response is False:
+				return
+			(cursor, nodes) = response
+			for node_id in nodes:
+				yield node_id
+			if cursor == 0:
+				return
+	
+	def count( self, queryset ):
+		return self._execute( ["COUNT", queryset] )
+	
+	def lazy( self, enabled ):
+		mode = "OFF"
+		if enabled:
+			mode = "ON"
+		return self._execute( ["LAZY", mode] )
 	
 	def clear( self, queryset ):
-		self.redis.send_response( ["CLEAR", queryset] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["CLEAR", queryset] )
+	
+	def snapshot( self ):
+		return self._execute( ["SNAPSHOT"] )
+	
+	def compact( self ):
+		return self._execute( ["COMPACT"] )
+	
+	def replication( self ):
+		return self._execute( ["REPLICATION"], _encode_as_dict_list )
+	
+	def add_replica( self, addr ):
+		return self._execute( ["REPLICATION", "ADD", addr] )
+	
+	def remove_replica( self, addr ):
+		return self._execute( ["REPLICATION", "REMOVE", addr] )
+	
+	def position( self ):
+		return self._execute( ["POSITION"] )
+	
+	def offset( self ):
+		return self._execute( ["OFFSET"] )
 	
 	def connect( self, source, target, edge_type, weight ):
-		self.redis.send_response( ["CONNECT", source, target, edge_type, weight] )
-		return self._parse_result( self.redis.receive(), _encode_as_dict )
+		return self._execute( ["CONNECT", source, target, edge_type, weight], _encode_as_dict )
 	
 	def disconnect( self, source, target, edge_type ):
-		self.redis.send_response( ["DISCONNECT", source, target, edge_type] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["DISCONNECT", source, target, edge_type] )
+
+	def _batch( self, op, items ):
+		# Everything is sent as strings, which both ends encode and parse
+		# a run at a time.
+		command = [op]
+		for item in items:
+			command.extend( map( str, item ) )
+		return self._execute( command )
+	
+	def mcreate( self, node_ids ):
+		return self._execute( ["MCREATE"] + map( str, node_ids ) )
+	
+	def mset( self, items ):
+		# items: (node_id, key, value) tuples
+		return self._batch( "MSET", items )
+	
+	def mconnect( self, edges ):
+		# edges: (source, target, edge_type, weight) tuples
+		return self._batch( "MCONNECT", edges )
+	
+	def mdisconnect( self, edges ):
+		# edges: (source, target, edge_type) tuples
+		return self._batch( "MDISCONNECT", edges )
 
 	def start( self, queryset, nodes ):
-		self.redis.send_response( ["START", queryset] + nodes )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["START", queryset] + nodes )
 	
 	def find( self, resultset, key, value, operator ):
-		self.redis.send_response( ["FIND", resultset, key, value, operator] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["FIND", resultset, key, value, operator] )
+	
+	def find_between( self, resultset, key, low, high ):
+		return self._execute( ["FIND", resultset, key, low, high, "BETWEEN"] )
 		
 	def forward( self, target, source, types ):
-		self.redis.send_response( ["FORWARD", target, source] + types )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["FORWARD", target, source] + types )
 
 	def backward( self, target, source, types ):
-		self.redis.send_response( ["BACKWARD", target, source] + types )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["BACKWARD", target, source] + types )
+
+	def expand( self, target, source, mindepth, maxdepth, types, direction = "FORWARD", limit = None ):
+		op = "EXPAND"
+		if direction != "FORWARD":
+			op = "EXPAND-%s" % direction
+		
+		command = [op, target, source, mindepth, maxdepth] + types
+		if limit is not None:
+			command.extend( ["LIMIT", limit] )
+		
+		return self._execute( command )
+
+	def path( self, source, target, max_depth, types ):
+		return self._execute( ["PATH", source, target, max_depth] + types )
+
+	def reachable( self, source, target, max_depth, types ):
+		return self._execute( ["REACHABLE", source, target, max_depth] + types )
+
+	def weighted_path( self, source, target, max_depth, types ):
+		return self._execute( ["WPATH", source, target, max_depth] + types, _encode_as_dict )
+
+	def query( self, resultsets, steps ):
+		# steps is a list of queryset commands, e.g. [["START", "a", 1], ["FORWARD", "b", "a", "knows"]]
+		command = ["QUERY", ",".join( resultsets )]
+		for step in steps:
+			command.extend( step )
+			command.append( ";" )
+		
+		return self._execute( command, _encode_as_dict )
 
 	def filter( self, target, source, key, value, operator ):
-		self.redis.send_response( ["FILTER", target, source, key, value, operator] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["FILTER", target, source, key, value, operator] )
+	
+	def filter_between( self, target, source, key, low, high ):
+		return self._execute( ["FILTER", target, source, key, low, high, "BETWEEN"] )
 
 	def append( self, target, source0, source1 ):
-		self.redis.send_response( ["APPEND", target, source0, source1] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["APPEND", target, source0, source1] )
 
 	def union( self, target, source0, source1 ):
-		self.redis.send_response( ["UNION", target, source0, source1] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["UNION", target, source0, source1] )
 
 	def intersection( self, target, source0, source1 ):
-		self.redis.send_response( ["INTERSECTION", target, source0, source1] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["INTERSECTION", target, source0, source1] )
 
 	def difference( self, target, source0, source1 ):
-		self.redis.send_response( ["DIFFERENCE", target, source0, source1] )
-		return self._parse_result( self.redis.receive() )
+		return self._execute( ["DIFFERENCE", target, source0, source1] )
+
+	def unique( self, target, source ):
+		return self._execute( ["UNIQUE", target, source] )
 
 
+class HawthornPipeline( HawthornClient ):
+	# Queues commands instead of running them. execute() sends the queue
+	# and returns the replies in order, each decoded as the single call
+	# would decode it; failed commands reply False. Used as a context
+	# manager, anything still queued is executed when the block exits.
+	#
+	#   with client.pipeline() as pipe:
+	#       pipe.create( 1 )
+	#       pipe.get( 1 )
+	#   (created, node) = pipe.results
+	
+	def __init__( self, client ):
+		self.host = client.host
+		self.port = client.port
+		self.conn = client.conn
+		self.redis = client.redis
+		
+		self._error = ""
+		
+		self.commands = []
+		self.results = []
+	
+	def __enter__( self ):
+		return self
+	
+	def __exit__( self, exc_type, exc_value, traceback ):
+		if exc_type is None and self.commands:
+			self.execute()
+		return False
+	
+	def _execute( self, command, encoder = None ):
+		self.commands.append( (command, encoder) )
+		return self
+	
+	def _read( self, encoders ):
+		for encoder in encoders:
+			self.results.append( self._parse_result( self.redis.receive(), encoder ) )
+	
+	def execute( self ):
+		# Commands are written about SEND_CHUNK bytes at a time. The
+		# replies to a write are read after the next write has gone out,
+		# so the server always has work queued, but no more than two
+		# writes are ever in flight; that keeps both sides from blocking on
+		# full socket buffers when a pipeline is larger than they are.
+		(commands, self.commands) = (self.commands, [])
+		self.results = []
+		
+		pieces = []
+		size = 0
+		encoders = []
+		in_flight = []
+		for (command, encoder) in commands:
+			for piece in self.redis.pack( command ):
+				pieces.append( piece )
+				size += len( piece )
+			encoders.append( encoder )
+			
+			if size >= RedisProtocol.SEND_CHUNK:
+				self.conn.sendall( "".join( pieces ) )
+				self._read( in_flight )
+				in_flight = encoders
+				pieces = []
+				size = 0
+				encoders = []
+		
+		if pieces:
+			self.conn.sendall( "".join( pieces ) )
+		self._read( in_flight )
+		self._read( encoders )
+		
+		return self.results
+
+
+# How HawthornRouter picks a replica for a read:
+#   round-robin  each replica in turn
+#   load         the replica that has been answering fastest
+ROUTING_POLICIES = ["round-robin", "load"]
+
+# Reads that don't depend on querysets of the connection.
+LOOKUP_COMMANDS = set( ["GET", "EDGES", "PATH", "REACHABLE", "WPATH"] )
+
+# Commands that make a queryset named by their first parameter, and
+# commands that read querysets.
+QUERYSET_MAKERS = set( ["START", "FIND", "FORWARD", "BACKWARD", "EXPAND", "EXPAND-BACKWARD", "EXPAND-BOTH", "FILTER", "APPEND", "UNION", "INTERSECTION", "DIFFERENCE", "UNIQUE"] )
+QUERYSET_READERS = set( ["FETCH", "SCAN", "COUNT", "CLEAR", "QUERY"] )
+
+# Seconds a read waits for a replica holding querysets to catch up with
+# the writes of the router, and between checks meanwhile.
+CATCH_UP_TIMEOUT = 5.0
+CATCH_UP_POLL = 0.005
+
+# Weight of the latest response time in the load estimate of a replica,
+# and how much the estimates of the replicas not picked are lowered, so
+# that a replica that was slow once gets tried again.
+LOAD_WEIGHT = 0.2
+LOAD_DECAY = 0.95
+
+
+class HawthornRouter( HawthornClient ):
+	# Sends changes to the primary and reads to read-only replicas of it.
+	# Lookups go to a replica picked by policy. Querysets live on the
+	# connection that made them, so all querysets of a router are made on
+	# one server, picked when the router has none.
+	#
+	# With read_your_writes, a read after a change only goes to a replica
+	# that has applied the change, checked with POSITION on the primary
+	# and OFFSET on the replica; a lookup otherwise goes to the primary,
+	# and a queryset command waits for its replica to catch up.
+	#
+	#   router = HawthornRouter( ("db0", 7778), [("db1", 7778), ("db2", 7778)] )
+	
+	def __init__( self, primary, replicas, policy = "round-robin", read_your_writes = False ):
+		if policy not in ROUTING_POLICIES:
+			raise ValueError( "Invalid routing policy (%s)." % policy )
+		
+		self.primary = HawthornClient( *primary )
+		self.host = self.primary.host
+		self.port = self.primary.port
+		self.conn = self.primary.conn
+		self.redis = self.primary.redis
+		
+		self.replicas = [HawthornClient( *addr ) for addr in replicas]
+		self.policy = policy
+		self.read_your_writes = read_your_writes
+		self.turns = itertools.count()
+		
+		# Estimated response time of each replica.
+		self.load = dict( (replica, 0.0) for replica in self.replicas )
+		
+		# Server holding the querysets of the router, and their names.
+		self.queryset_client = None
+		self.querysets = set()
+		
+		# Whether a change has been made since the last POSITION, the
+		# [history, sequence] a replica must have reached, and the last
+		# OFFSET seen from each replica.
+		self.written = False
+		self.required = None
+		self.offsets = {}
+		
+		self._error = ""
+	
+	def close( self ):
+		for client in [self.primary] + self.replicas:
+			client.close()
+	
+	def pipeline( self ):
+		# Pipelines run on the primary.
+		return self.primary.pipeline()
+	
+	def _caught_up( self, client ):
+		if client is self.primary or self.required is None:
+			return True
+		
+		(history, sequence) = self.required
+		offset = self.offsets.get( client )
+		if offset is None or offset[0] != history or offset[1] < sequence:
+			offset = client.offset()
+			self.offsets[ client ] = offset
+		
+		return offset is not False and offset[0] == history and offset[1] >= sequence
+	
+	def _requirements( self ):
+		if self.read_your_writes and self.written:
+			self.written = False
+			position = self.primary.position()
+			if position is not False:
+				self.required = position
+	
+	def _drop( self, client ):
+		# The replica is gone; later reads go to the others.
+		self.replicas.remove( client )
+		del self.load[ client ]
+	
+	def _pick( self ):
+		while self.replicas:
+			if self.policy == "round-robin":
+				client = self.replicas[ self.turns.next() % len( self.replicas ) ]
+			else:
+				client = min( self.replicas, key = self.load.get )
+			
+			try:
+				if self._caught_up( client ):
+					return client
+				return self.primary
+			except (socket.error, IOError):
+				self._drop( client )
+		
+		return self.primary
+	
+	def _wait( self, client ):
+		deadline = time.time() + CATCH_UP_TIMEOUT
+		while not self._caught_up( client ):
+			if time.time() > deadline:
+				return False
+			time.sleep( CATCH_UP_POLL )
+		return True
+	
+	def _run( self, client, command, encoder ):
+		started = time.time()
+		result = client._execute( command, encoder )
+		self._error = client._error
+		
+		if client in self.load:
+			elapsed = time.time() - started
+			for replica in self.replicas:
+				if replica is not client:
+					self.load[ replica ] *= LOAD_DECAY
+			self.load[ client ] += LOAD_WEIGHT * ( elapsed - self.load[ client ] )
+		return result
+	
+	def _execute( self, command, encoder = None ):
+		op = command[0]
+		
+		if op == "LAZY":
+			for client in [self.primary] + self.replicas:
+				result = self._run( client, command, encoder )
+			return result
+		
+		if op in LOOKUP_COMMANDS:
+			self._requirements()
+			while True:
+				client = self._pick()
+				try:
+					return self._run( client, command, encoder )
+				except (socket.error, IOError):
+					if client is self.primary:
+						raise
+					self._drop( client )
+		
+		if op in QUERYSET_MAKERS or op in QUERYSET_READERS:
+			self._requirements()
+			client = self.queryset_client
+			if client is None:
+				client = self._pick()
+			elif not self._wait( client ):
+				self._error = "Replica (%s:%i) has not caught up." % ( client.host, client.port )
+				return False
+			
+			result = self._run( client, command, encoder )
+			if result is not False:
+				if op in QUERYSET_MAKERS:
+					self.querysets.add( command[1] )
+				elif op == "QUERY":
+					self.querysets.update( command[1].split( "," ) )
+				elif op == "CLEAR":
+					self.querysets.discard( command[1] )
+			
+			self.queryset_client = client if self.querysets else None
+			return result
+		
+		self.written = True
+		return self._run( self.primary, command, encoder )
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+#
+#   Copyright 2013 Markus Gronholm <markus@alshain.fi> / Alshain Oy
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+#
+# Querysets are sorted arrays of node ids. A set has no duplicates; a
+# multiset (the result of APPEND) is sorted but may repeat ids.
+#
+
+from array import array
+from itertools import groupby
+
+from CSR import ID_TYPECODE
+
+# Number of ids a lazy Plan passes through its stages at a time.
+CHUNK_SIZE = 4096
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def from_sorted( ids ):
+	# ids must already be sorted. Ids that don't fit a signed 64 bit
+	# integer are kept in a plain list, which every function here accepts.
+	try:
+		return array( ID_TYPECODE, ids )
+	except OverflowError:
+		return list( ids )
+
+def _dedupe( ids ):
+	return [key for (key, group) in groupby( ids )]
+
+def _to_numpy( ids ):
+	if numpy is None or not isinstance( ids, array ):
+		return None
+	return numpy.frombuffer( ids, dtype = numpy.int64 )
+
+def _from_numpy( values ):
+	out = array( ID_TYPECODE )
+	out.fromstring( values.astype( numpy.int64 ).tostring() )
+	return out
+
+
+def empty():
+	return array( ID_TYPECODE )
+
+def from_ids( ids ):
+	return from_sorted( sorted( set( ids ) ) )
+
+def multiset_from_ids( ids ):
+	return from_sorted( sorted( ids ) )
+
+def unique( ids ):
+	# ids is sorted, so duplicates are adjacent.
+	return from_sorted( _dedupe( ids ) )
+
+def append( ids0, ids1 ):
+	# Both inputs are sorted runs, which timsort merges in linear time.
+	merged = list( ids0 )
+	merged.extend( ids1 )
+	merged.sort()
+	return from_sorted( merged )
+
+def union( ids0, ids1 ):
+	np0 = _to_numpy( ids0 )
+	np1 = _to_numpy( ids1 )
+	if np0 is not None and np1 is not None:
+		return _from_numpy( numpy.union1d( np0, np1 ) )
+
+	return unique( append( ids0, ids1 ) )
+
+def intersection( ids0, ids1 ):
+	np0 = _to_numpy( ids0 )
+	np1 = _to_numpy( ids1 )
+	if np0 is not None and np1 is not None:
+		return _from_numpy( numpy.intersect1d( np0, np1, assume_unique = True ) )
+
+	if len( ids1 ) < len( ids0 ):
+		(ids0, ids1) = (ids1, ids0)
+
+	# Walking the smaller side keeps the result sorted.
+	lookup = set( ids1 )
+	return from_sorted( [node_id for node_id in ids0 if node_id in lookup] )
+
+def difference( ids0, ids1 ):
+	np0 = _to_numpy( ids0 )
+	np1 = _to_numpy( ids1 )
+	if np0 is not None and np1 is not None:
+		return _from_numpy( numpy.setdiff1d( np0, np1, assume_unique = True ) )
+
+	lookup = set( ids1 )
+	return from_sorted( [node_id for node_id in ids0 if node_id not in lookup] )
+
+
+def _conjunction( tests ):
+	def test( node_id ):
+		for single in tests:
+			if not single( node_id ):
+				return False
+		return True
+	return test
+
+
+class Plan( object ):
+	# A deferred queryset: a source (an id array or another Plan) and a
+	# chain of stages that are run as one streaming pipeline when the result
+	# is needed. Ids flow through the pipeline in chunks (lists). A stage is
+	# either
+	#
+	#   ("map", fn)         fn( chunks ) -> iterator of chunks
+	#   ("select", tests)   keeps the ids for which every test( id ) is true
+	#
+	# Adjacent selects are fused into one pass.
+
+	def __init__( self, source, multiset = False ):
+		self.source = source
+		self.stages = []
+		self.multiset = multiset
+		self.result = None
+
+	def then( self, kind, work, multiset ):
+		if self.result is not None:
+			plan = Plan( self.result, multiset )
+		else:
+			plan = Plan( self.source, multiset )
+			plan.stages = list( self.stages )
+
+		if kind == "select":
+			if plan.stages and plan.stages[-1][0] == "select":
+				plan.stages[-1] = ("select", plan.stages[-1][1] + [work])
+			else:
+				plan.stages.append( ("select", [work]) )
+		else:
+			plan.stages.append( (kind, work) )
+
+		return plan
+
+	def _chunks( self, ids ):
+		for offset in xrange( 0, len( ids ), CHUNK_SIZE ):
+			yield ids[ offset:offset + CHUNK_SIZE ]
+
+	def _run( self, chunks, kind, work ):
+		if kind == "map":
+			return work( chunks )
+
+		if len( work ) == 1:
+			test = work[0]
+		else:
+			test = _conjunction( work )
+		return ( filter( test, chunk ) for chunk in chunks )
+
+	def stream( self ):
+		# Returns an iterator over lists of ids.
+		if self.result is not None:
+			return self._chunks( self.result )
+
+		if isinstance( self.source, Plan ):
+			chunks = self.source.stream()
+		else:
+			chunks = self._chunks( self.source )
+
+		for (kind, work) in self.stages:
+			chunks = self._run( chunks, kind, work )
+
+		return chunks
+
+	def materialize( self, checkpoint = None ):
+		# checkpoint, if given, is called after every chunk.
+		if self.result is None:
+			ids = []
+			for chunk in self.stream():
+				ids.extend( chunk )
+				if checkpoint is not None:
+					checkpoint()
+			if self.multiset:
+				self.result = multiset_from_ids( ids )
+			else:
+				self.result = from_ids( ids )
+			self.source = None
+			self.stages = []
+		return self.result
@@ -15,175 +15,320 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from array import array
+
+# Initial size of the receive buffer. It grows to fit large requests and
+# is shrunk back once it is empty if it has grown past RECV_BUFFER_MAX.
+RECV_BUFFER_MIN = 16384
+RECV_BUFFER_MAX = 1048576
+
+# Replies are sent in pieces of at least SEND_CHUNK bytes; lists are
+# encoded PACK_RUN entries at a time.
+SEND_CHUNK = 65536
+PACK_RUN = 4096
+
+# Smallest multibulk worth splitting in one go; see _split_bulks.
+SPLIT_MIN = 16
+
+# Lists whose entries are all of these types take the fast paths.
+INTEGER_TYPES = set( [int] )
+STRING_TYPES = set( [str] )
+
+# Returned by _parse when the buffer doesn't hold a complete reply yet.
+INCOMPLETE = object()
+
+STRING = ord( "+" )
+ERROR = ord( "-" )
+INTEGER = ord( ":" )
+BULK = ord( "$" )
+MULTIBULK = ord( "*" )
+
 
 class RedisProtocol(object):
 	def __init__( self, conn ):
 		self.conn = conn
-		self.buf = ""
+		
+		# Received data is buf[start:end]; everything before start has
+		# already been parsed.
+		self.buf = bytearray( RECV_BUFFER_MIN )
+		self.start = 0
+		self.end = 0
+		
+		# Multibulks whose elements have not all arrived yet, outermost
+		# first, as [elements, remaining count, split] entries. split is
+		# cleared once a multibulk turns out not to be all bulk strings.
+		self.stack = []
+		
+		# Encoded replies not written yet, see _send.
+		self.out = []
+		self.out_size = 0
+		
+		# Called before buffered replies are written, e.g. to hold them
+		# back until the changes they report are durable.
+		self.before_flush = None
 
-	def _pack_list( self, data ):	
-		#print "packing list", data
-		out = "*%i\r\n" % len( data )
-		for entry in data:
-			if isinstance( entry, int ):
-				out += ":%i\r\n" % entry
-			elif isinstance( entry, list ):
-				out += self._pack_list( entry )
-			elif isinstance( entry, dict ):
-				out += self._pack_dict( entry )
-			else:
-				out += "$%i\r\n" % len( str(entry) ) 
-				out += "%s\r\n" % str( entry )
-		return out
+	def _pack_value( self, value ):
+		if isinstance( value, int ):
+			yield ":%i\r\n" % value
+		elif isinstance( value, (list, array) ):
+			for piece in self._pack_list( value ):
+				yield piece
+		elif isinstance( value, dict ):
+			for piece in self._pack_dict( value ):
+				yield piece
+		else:
+			value = str( value )
+			yield "$%i\r\n%s\r\n" % ( len( value ), value )
+	
+	def _pack_list( self, data ):
+		# Yields the encoding in pieces. Runs of plain ints or of strings
+		# are encoded with one join.
+		yield "*%i\r\n" % len( data )
 		
-	def _pack_dict( self, data ):
-		#print "packing dict", data
-		out = "*%i\r\n" % (len( data ) * 2)
-		for (key, value) in data.items():
-			out += "$%i\r\n" % len( key )
-			out += "%s\r\n" % key
-			if isinstance( value, int ):
-				out += ":%i\r\n" % value
-			elif isinstance( value, list ):
-				out += self._pack_list( value )
-			elif isinstance( value, dict ):
-				out += self._pack_dict( value )
+		for offset in xrange( 0, len( data ), PACK_RUN ):
+			run = data[ offset:offset + PACK_RUN ]
+			if isinstance( run, array ):
+				types = INTEGER_TYPES
+			else:
+				types = set( map( type, run ) )
+			
+			if types <= INTEGER_TYPES:
+				yield ":%s\r\n" % "\r\n:".join( map( str, run ) )
+			elif types <= STRING_TYPES:
+				yield "".join( ["$%i\r\n%s\r\n" % ( len( entry ), entry ) for entry in run] )
 			else:
-				out += "$%i\r\n" % len( value )
-				out += "%s\r\n" % value
-		return out
+				for entry in run:
+					for piece in self._pack_value( entry ):
+						yield piece
+	
+	def _pack_dict( self, data ):
+		yield "*%i\r\n" % ( len( data ) * 2 )
+		for (key, value) in data.iteritems():
+			key = str( key )
+			yield "$%i\r\n%s\r\n" % ( len( key ), key )
+			for piece in self._pack_value( value ):
+				yield piece
+	
+	def _send( self, pieces, flush = True ):
+		# Replies are written as they are encoded, SEND_CHUNK bytes at a
+		# time. With flush False the tail is held back so that replies to
+		# pipelined requests share writes; it goes out with the next
+		# flush, at the latest before the next blocking read.
+		out = self.out
+		for piece in pieces:
+			out.append( piece )
+			self.out_size += len( piece )
+			if self.out_size >= SEND_CHUNK:
+				self.flush()
+		
+		if flush:
+			self.flush()
+	
+	def flush( self ):
+		if self.out:
+			if self.before_flush is not None:
+				self.before_flush()
+			data = "".join( self.out )
+			del self.out[:]
+			self.out_size = 0
+			self.conn.sendall( data )
+	
+	def pending( self ):
+		# True if the receive buffer holds data that hasn't been parsed yet,
+		# e.g. the next request of a pipeline.
+		return self.start < self.end
 
-	def send_response( self, message ):
+	def pack( self, message ):
+		# Yields the encoding of a reply (or a request) in pieces.
 		if isinstance( message, str ):
-			self.conn.send( "+%s\r\n" % repr(message)[1:-1])
-		elif isinstance( message, list ):
-			self.conn.send( self._pack_list( message ) )
+			yield "+%s\r\n" % repr(message)[1:-1]
+		elif isinstance( message, (list, array) ):
+			for piece in self._pack_list( message ):
+				yield piece
 		elif isinstance( message, dict ):
-			self.conn.send( self._pack_dict( message ) )
+			for piece in self._pack_dict( message ):
+				yield piece
 		elif isinstance( message, int ):
-			self.conn.send(":%i\r\n" % message )
-	
-	def send_error( self, message ):
-		self.conn.send( '-%s\r\n' % repr(message)[1:-1] )
+			yield ":%i\r\n" % message
 
+	def send_response( self, message, flush = True ):
+		self._send( self.pack( message ), flush )
+	
+	def send_error( self, message, flush = True ):
+		self._send( ['-%s\r\n' % repr(message)[1:-1]], flush )
 
 
-	def recv_bulk( self ):
-		#print "bulk"
-		while '\r\n' not in self.buf:
-			self._recv()
+	def _make_room( self ):
+		unread = self.end - self.start
+		if self.start > 0:
+			self.buf[ :unread ] = self.buf[ self.start:self.end ]
+			self.start = 0
+			self.end = unread
 		
-		if not self.buf.startswith( "$" ):
-			return False
-		
-		(line, rest) = self.buf.split( "\r\n", 1 )
-		next_bytes = int( line[1:] )
-		self.buf = rest
-		while len( self.buf ) < next_bytes + 2:
-			self._recv()
-		
-		(line, rest) = self.buf.split( "\r\n", 1 )
-		
-		self.buf = rest
-		
-		return line
+		# Grow when the pending data fills over half of the buffer, so a
+		# large request is read in ever larger pieces.
+		if unread * 2 > len( self.buf ):
+			self.buf.extend( bytearray( len( self.buf ) ) )
 	
-	def recv_string( self ):
-		#print "string"
-		while '\r\n' not in self.buf:
-			self._recv()
+	def _recv( self ):
+		self.flush()
 		
-		if not self.buf.startswith( "+" ):
-			return False
+		if self.end == len( self.buf ):
+			self._make_room()
 		
-		(line, rest) = self.buf.split( "\r\n", 1 )
-		self.buf = rest
+		view = memoryview( self.buf )
+		count = self.conn.recv_into( view[ self.end: ] )
+		del view
 		
-		return line[1:]
+		if count < 1:
+			raise IOError
+		self.end += count
 	
-	def recv_error( self ):
-		while '\r\n' not in self.buf:
-			self._recv()
+	def _split_bulks( self, top, start ):
+		# Splits a run of complete bulk strings in one go. The run is only
+		# taken up to the first part whose length doesn't match its header,
+		# e.g. a value containing "\r\n" or an element of another type,
+		# and the rest of the multibulk is parsed element by element.
+		buf = self.buf
+		line_end = buf.find( "\r\n", start, self.end )
+		if line_end < 0:
+			return start
 		
-		if not self.buf.startswith( "-" ):
-			return False
+		# Don't copy the buffer while waiting for the rest of a large value.
+		if line_end + 4 + int( buf[ start + 1:line_end ] ) > self.end:
+			return start
 		
-		(line, rest) = self.buf.split( "\r\n", 1 )
-		self.buf = rest
+		parts = str( buf[ start:self.end ] ).split( "\r\n", 2 * top[1] )
+		count = ( len( parts ) - 1 ) / 2
+		headers = parts[ 0:2 * count:2 ]
+		values = parts[ 1:2 * count:2 ]
 		
-		return line
-	
-	
-	def recv_integer( self ):
-		#print "integer"
-		while '\r\n' not in self.buf:
-			self._recv()
+		expected = ["$%i" % len( value ) for value in values]
+		if headers != expected:
+			top[2] = False
+			count = 0
+			while headers[ count ] == expected[ count ]:
+				count += 1
+			values = values[ :count ]
 		
-		if not self.buf.startswith( ":" ):
-			return False
+		top[0].extend( values )
+		top[1] -= count
+		return start + sum( map( len, parts[ :2 * count ] ) ) + 4 * count
+	
+	def _parse_bulks( self, top, start ):
+		# Fast path for the bulk strings of a multibulk, which is what
+		# requests are made of. Returns the offset of the first element it
+		# didn't parse.
+		if top[2] and top[1] >= SPLIT_MIN and start < self.end and self.buf[ start ] == BULK:
+			start = self._split_bulks( top, start )
 		
-		(line, rest) = self.buf.split( "\r\n", 1 )
-		self.buf = rest
+		buf = self.buf
+		find = buf.find
+		end = self.end
+		append = top[0].append
+		remaining = top[1]
 		
-		return int(line[1:])
-			
-	def recv_multibulk( self ):
-		#print "multibulk"
-		while '\r\n' not in self.buf:
-			self._recv()
+		while remaining and start < end and buf[ start ] == BULK:
+			line_end = find( "\r\n", start, end )
+			if line_end < 0:
+				break
+			data_start = line_end + 2
+			length = int( buf[ start + 1:line_end ] )
+			if length < 0 or data_start + length + 2 > end:
+				break
+			append( str( buf[ data_start:data_start + length ] ) )
+			start = data_start + length + 2
+			remaining -= 1
 		
-		if not self.buf.startswith( "*" ):
-			return False
+		top[1] = remaining
+		return start
+	
+	def _parse( self ):
+		# Parses as far as the received data allows and returns the next
+		# complete reply, or INCOMPLETE. Elements of a partially received
+		# multibulk are kept on self.stack, so they are not parsed again.
+		buf = self.buf
+		find = buf.find
+		end = self.end
+		stack = self.stack
 		
-		(line, rest) = self.buf.split( "\r\n", 1 )
-		self.buf = rest
-		N = int( line[1:] )
-		#print "Nparams", N
-		out = []
-		for i in range( N ):
-			while len( self.buf ) < 1:
-				self._recv()
-			#print "multibulk selector", self.buf[0]
-			if self.buf.startswith( "+" ):
-				out.append( self.recv_string() )
-			elif self.buf.startswith( "-" ):
-				out.append( self.recv_error() )
-			elif self.buf.startswith( ":" ):
-				out.append( self.recv_integer() )
-			elif self.buf.startswith( "$" ):
-				out.append( self.recv_bulk() )
-			else:
-				out.append( self.recv_multibulk() )
-		return out
+		start = self.start
+		try:
+			while True:
+				if stack:
+					start = self._parse_bulks( stack[-1], start )
+					if stack[-1][1] == 0:
+						value = stack.pop()[0]
+						if stack:
+							stack[-1][0].append( value )
+							stack[-1][1] -= 1
+							continue
+						return value
 				
-	
-	def _recv( self ):
-		chunk = self.conn.recv(1024)
-		if len( chunk ) < 1:
-			raise IOError
-		self.buf += chunk
-		#print self.buf
+				line_end = find( "\r\n", start, end )
+				if line_end < 0:
+					return INCOMPLETE
+				
+				kind = buf[ start ]
+				if kind == BULK:
+					length = int( buf[ start + 1:line_end ] )
+					if length < 0:
+						value = None
+						start = line_end + 2
+					else:
+						data_end = line_end + 2 + length
+						if data_end + 2 > end:
+							return INCOMPLETE
+						value = str( buf[ line_end + 2:data_end ] )
+						start = data_end + 2
+				
+				elif kind == MULTIBULK:
+					count = int( buf[ start + 1:line_end ] )
+					start = line_end + 2
+					if count > 0:
+						stack.append( [[], count, True] )
+						continue
+					elif count < 0:
+						value = None
+					else:
+						value = []
+				
+				elif kind == INTEGER:
+					value = int( buf[ start + 1:line_end ] )
+					start = line_end + 2
+				
+				elif kind == STRING:
+					value = str( buf[ start + 1:line_end ] )
+					start = line_end + 2
+				
+				elif kind == ERROR:
+					value = str( buf[ start:line_end ] )
+					start = line_end + 2
+				
+				else:
+					raise IOError( "Unknown reply type (%s)." % chr( kind ) )
+				
+				if not stack:
+					return value
+				stack[-1][0].append( value )
+				stack[-1][1] -= 1
+		finally:
+			self.start = start
 	
 	def receive(self):
 		try:
-			while len( self.buf ) < 1:
+			while True:
+				value = self._parse()
+				if value is not INCOMPLETE:
+					break
 				self._recv()
-			
-			if self.buf.startswith( "+" ):
-				return self.recv_string()
-
-			elif self.buf.startswith( "-" ):
-				return self.recv_error()
-			
-			elif self.buf.startswith( ":" ):
-				return self.recv_integer()
-
-			elif self.buf.startswith( "$" ):
-				return self.recv_bulk()
-
-			elif self.buf.startswith( "*" ):
-				return self.recv_multibulk()
-		except IOError:
+		except (IOError, ValueError):
 			return False
-
-
+		
+		if self.start == self.end:
+			self.start = 0
+			self.end = 0
+			if len( self.buf ) > RECV_BUFFER_MAX:
+				self.buf = bytearray( RECV_BUFFER_MIN )
+		
+		return value
@@ -13,7 +13,118 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import json, os
+import gc, json, os, marshal, struct, time, zlib
+import multiprocessing
+from collections import deque
+
+import gevent
+from gevent.event import Event
+
+import BinaryLog
+
+# Snapshot file: MAGIC, then crc32 and length of the payload, then the
+# payload, a marshal dump of
+#
+#   {"log_id": ..., "offset": ..., "history": ..., "sequence": ...,
+#    "upstream": ..., "graphs": {db_id: Graph.snapshot()}}
+#
+# where offset is the size of the log the snapshot covers and sequence the
+# number of changes in it; upstream is Hawthorn.upstream.
+SNAPSHOT_MAGIC = "H3SNAP01"
+SNAPSHOT_HEADER = ">IQ"
+
+# When AppendLogStorage fsyncs the log:
+#   always    before replying to a change (group commit)
+#   interval  every durability.interval seconds, see Hawthorn.sync_loop
+#   os        never, the OS writes the log back when it sees fit
+FSYNC_POLICIES = ["always", "interval", "os"]
+
+# Formats of the append log: JSON lines or BinaryLog records.
+LOG_FORMATS = ["json", "binary"]
+
+
+def _fsync_directory( filename ):
+	directory = os.path.dirname( os.path.abspath( filename ) )
+	fd = os.open( directory, os.O_RDONLY )
+	try:
+		os.fsync( fd )
+	finally:
+		os.close( fd )
+
+def _replace( filename, data ):
+	# Writes data to filename so that after a crash the file holds either
+	# its old contents or data in full.
+	tmp_filename = filename + ".tmp"
+	with open( tmp_filename, 'wb' ) as handle:
+		handle.write( data )
+		handle.flush()
+		os.fsync( handle.fileno() )
+	os.rename( tmp_filename, filename )
+	_fsync_directory( filename )
+
+
+# Log records are replayed REPLAY_CHUNK bytes at a time, with progress
+# reported every REPLAY_REPORT_INTERVAL seconds.
+REPLAY_CHUNK = 1 << 22
+REPLAY_REPORT_INTERVAL = 5.0
+
+
+def _decode_records( chunk ):
+	# One json.loads for a whole chunk of records.
+	records = json.loads( "[%s]" % ",".join( chunk.splitlines() ) )
+	return [(data["op"], data["params"]) for data in records]
+
+def _pack_records( chunk ):
+	# Runs in a replay worker; marshal is much faster to load than JSON.
+	return marshal.dumps( _decode_records( chunk ) )
+
+def _node_id( value ):
+	try:
+		return int( value )
+	except ValueError:
+		return int( value, 16 )
+
+def _group( params, width ):
+	return zip( *[iter( params )] * width )
+
+def _replay_index( graph, params ):
+	kind = "HASH"
+	if len( params ) > 1:
+		kind = params[1].upper()
+	graph.create_index( params[0], kind )
+
+def _replay_mcreate( graph, params ):
+	for node_id in params:
+		graph.create( _node_id( node_id ) )
+
+def _replay_mset( graph, params ):
+	for (node_id, key, value) in _group( params, 3 ):
+		graph.set_property( _node_id( node_id ), key, value )
+
+def _replay_mconnect( graph, params ):
+	for (source, target, edge_type, value) in _group( params, 4 ):
+		graph.connect( _node_id( source ), _node_id( target ), edge_type, value )
+
+def _replay_mdisconnect( graph, params ):
+	for (source, target, edge_type) in _group( params, 3 ):
+		graph.disconnect( _node_id( source ), _node_id( target ), edge_type )
+
+# How each logged command is applied to a Graph on replay.
+REPLAY_COMMANDS = {
+	"CREATE": lambda graph, params: graph.create( _node_id( params[0] ) ),
+	"DELETE": lambda graph, params: graph.remove_node( _node_id( params[0] ) ),
+	"SET": lambda graph, params: graph.set_property( _node_id( params[0] ), params[1], params[2] ),
+	"UNSET": lambda graph, params: graph.remove_property( _node_id( params[0] ), params[1] ),
+	"CONNECT": lambda graph, params: graph.connect( _node_id( params[0] ), _node_id( params[1] ), params[2], params[3] ),
+	"DISCONNECT": lambda graph, params: graph.disconnect( _node_id( params[0] ), _node_id( params[1] ), params[2] ),
+	"INDEX": _replay_index,
+	"MCREATE": _replay_mcreate,
+	"MSET": _replay_mset,
+	"MCONNECT": _replay_mconnect,
+	"MDISCONNECT": _replay_mdisconnect,
+	"RESET": lambda graph, params: graph.clear(),
+	}
+
 
 class HawthornStorage( object ):
 	def __init__( self ):
@@ -27,32 +138,432 @@ class HawthornStorage( object ):
 	
 	def save( self, op, params ):
 		pass
+	
+	def snapshot( self, db ):
+		pass
+	
+	def compact( self, db ):
+		pass
+	
+	def commit( self, changed = True ):
+		pass
+	
+	def sync( self ):
+		pass
+	
+	def status( self ):
+		return []
+	
+	def position( self ):
+		# (history, sequence) of the last change, from a storage that
+		# numbers them; None from others.
+		return None
+	
+	def add_replica( self, addr ):
+		# (status, response) from a storage that replicates, None from
+		# others.
+		return None
+	
+	def remove_replica( self, addr ):
+		return None
 
 
 
 class AppendLogStorage( HawthornStorage ):
-	def __init__( self, filename ):
+	# A log of JSON lines or of BinaryLog records. A snapshot of every graph can be written next to
+	# it (filename.snapshot); loading then restores the snapshot and only
+	# replays the log written after it. COMPACT writes a snapshot and starts
+	# the log over, with a LOG record naming the log as its first record.
+	# The snapshot always names the log it was taken from, so a log left
+	# behind by an interrupted compaction is recognized and ignored.
+	#
+	# Every change gets a sequence number, counting on across compactions,
+	# within a history that starts with the first log of the database. The
+	# LOG record holds the history and the sequence the log starts from;
+	# replicas use these to ask for the changes they are missing, see
+	# read_after.
+	
+	def __init__( self, filename, fsync = "os", replay_workers = 0, log_format = "json" ):
+		if fsync not in FSYNC_POLICIES:
+			raise ValueError( "Invalid fsync policy (%s)." % fsync )
+		
+		if log_format not in LOG_FORMATS:
+			raise ValueError( "Invalid log format (%s)." % log_format )
+		
 		self.filename = filename
+		self.snapshot_filename = filename + ".snapshot"
 		self.handle = None
 		self._suppress = False
+		
+		self.fsync = fsync
+		self.replay_workers = replay_workers
+		
+		# Binary logs intern names per log; the encoder holds the names of
+		# the current log.
+		self.log_format = log_format
+		self.encoder = BinaryLog.Encoder()
+		
+		# Records saved and records known to be on disk.
+		self.written = 0
+		self.synced = 0
+		
+		# Set when the sync in progress finishes, None when there is none.
+		self.syncing = None
+		
+		# Id from the LOG record heading the log, None if there is none.
+		self.log_id = None
+		
+		# Size of the log covered by the last snapshot.
+		self.snapshot_offset = None
+		
+		# Id of the history, "" for logs written before histories; changes
+		# logged so far and before the current log.
+		self.history = None
+		self.sequence = 0
+		self.base = 0
 	
 	def suppress( self, value ):
 		self._suppress = value
 	
-	def load( self, db ):
+	def _encode( self, op, params ):
+		if self.log_format == "binary":
+			return self.encoder.encode( op, params )
+		return json.dumps( {"op": op, "params": params } ) + "\r\n"
+	
+	def _header( self, log_id ):
+		# The contents of a new log, starting after the current sequence.
+		params = [log_id, self.history, self.sequence]
+		if self.log_format == "binary":
+			return BinaryLog.MAGIC + BinaryLog.Encoder().encode( "LOG", params )
+		return self._encode( "LOG", params )
+	
+	def _read_snapshot( self ):
+		if not os.path.exists( self.snapshot_filename ):
+			return None
+		
+		with open( self.snapshot_filename, 'rb' ) as handle:
+			data = handle.read()
+		
+		start = len( SNAPSHOT_MAGIC ) + struct.calcsize( SNAPSHOT_HEADER )
+		if not data.startswith( SNAPSHOT_MAGIC ) or len( data ) < start:
+			raise IOError( "Snapshot (%s) is not valid." % self.snapshot_filename )
+		
+		(crc, length) = struct.unpack( SNAPSHOT_HEADER, data[ len( SNAPSHOT_MAGIC ):start ] )
+		payload = data[ start: ]
+		if len( payload ) != length or zlib.crc32( payload ) & 0xffffffff != crc:
+			raise IOError( "Snapshot (%s) is corrupt." % self.snapshot_filename )
+		
+		return marshal.loads( payload )
+	
+	def _write_snapshot( self, db, log_id, offset, names ):
+		# names: the names interned by a binary log up to offset.
+		graphs = {}
+		for (db_id, graph) in db.graphs.iteritems():
+			if graph.nodes or graph.types or graph.props:
+				graphs[ db_id ] = graph.snapshot()
+		
+		payload = marshal.dumps( {"log_id": log_id, "offset": offset, "names": names,
+			"history": self.history, "sequence": self.sequence, "upstream": db.upstream, "graphs": graphs} )
+		header = struct.pack( SNAPSHOT_HEADER, zlib.crc32( payload ) & 0xffffffff, len( payload ) )
+		_replace( self.snapshot_filename, SNAPSHOT_MAGIC + header + payload )
+		
+		self.snapshot_offset = offset
+	
+	def _read_header( self ):
+		# Returns (format, header, end of the LOG record) for the log, with
+		# None for the format of an empty log. header is [log id, history,
+		# sequence] from the LOG record, [None, "", 0] for a log that
+		# doesn't start with one; LOG records written before histories only
+		# hold the id.
+		header = [None, "", 0]
+		with open( self.filename, 'rb' ) as handle:
+			data = handle.read( len( BinaryLog.MAGIC ) )
+			if not data:
+				return (None, header, 0)
+			
+			if data == BinaryLog.MAGIC:
+				result = BinaryLog.read_record( data + handle.read( 4096 ), len( data ) )
+				if result is not None and result[2]:
+					(op, params) = BinaryLog.Decoder().decode( result[0] )
+					if op == "LOG":
+						return ("binary", params + header[ len( params ): ], result[1])
+				return ("binary", header, len( data ))
+			
+			handle.seek( 0 )
+			line = handle.readline()
+		
+		try:
+			data = json.loads( line )
+		except ValueError:
+			return ("json", header, 0)
+		
+		if data["op"] != "LOG":
+			return ("json", header, 0)
+		
+		params = data["params"]
+		return ("json", params + header[ len( params ): ], len( line ))
+	
+	def _fsync( self ):
+		# The fsync runs in the thread pool of the hub so that other
+		# greenlets can save records meanwhile; the next sync covers them.
+		fd = os.dup( self.handle.fileno() )
+		try:
+			gevent.get_hub().threadpool.apply( os.fsync, (fd,) )
+		finally:
+			os.close( fd )
+	
+	def sync( self ):
+		# Group commit: a single flush and fsync covers every record saved
+		# before it started. Callers arriving while one is running wait for
+		# it and start the next one if it didn't cover their records.
+		target = self.written
+		while self.synced < target:
+			if self.syncing is not None:
+				self.syncing.wait()
+				continue
+			
+			self.syncing = Event()
+			try:
+				written = self.written
+				self.handle.flush()
+				self._fsync()
+				self.synced = max( self.synced, written )
+			finally:
+				(event, self.syncing) = (self.syncing, None)
+				event.set()
+	
+	def commit( self, changed = True ):
+		# Called before replies are sent: makes the records saved so far
+		# as durable as the fsync policy promises.
+		if self.synced == self.written:
+			return
+		
+		if self.fsync == "always":
+			self.sync()
+		else:
+			self.handle.flush()
+	
+	def _log_size( self ):
+		# Flushing after the sync, with no switch in between, makes the size
+		# match the sequence.
+		self.sync()
+		if self.handle:
+			self.handle.flush()
 		if not os.path.exists( self.filename ):
+			return 0
+		return os.path.getsize( self.filename )
+	
+	def _start_log( self, log_id ):
+		if self.handle:
+			self.handle.close()
+			self.handle = None
+		
+		_replace( self.filename, self._header( log_id ) )
+		self.encoder = BinaryLog.Encoder()
+		self.log_id = log_id
+		self.base = self.sequence
+		self.synced = self.written
+	
+	def _read_chunks( self, handle, offset, repair = True ):
+		# Yields (chunk, end offset) for the JSON log from offset on, about
+		# REPLAY_CHUNK bytes of complete records at a time. A record cut
+		# short by a crash at the end of the log is dropped, so that new
+		# records don't get appended to it; without repair it is only
+		# skipped, as in a log still being written.
+		handle.seek( offset )
+		tail = ""
+		while True:
+			data = handle.read( REPLAY_CHUNK )
+			if not data:
+				break
+			
+			data = tail + data
+			end = data.rfind( "\n" ) + 1
+			tail = data[ end: ]
+			if end:
+				offset += end
+				yield (data[ :end ], offset)
+		
+		if tail and repair:
+			handle.truncate( offset )
+	
+	def _decode( self, chunks ):
+		# Yields (records, end offset) for the JSON log. With workers the
+		# chunks are decoded in worker processes, a few chunks ahead of the
+		# caller.
+		if not self.replay_workers:
+			for (chunk, offset) in chunks:
+				yield (_decode_records( chunk ), offset)
 			return
 		
-		qid = db.start_query( 0 )
+		pool = multiprocessing.Pool( self.replay_workers )
+		try:
+			pending = deque()
+			for (chunk, offset) in chunks:
+				pending.append( (pool.apply_async( _pack_records, (chunk,) ), offset) )
+				if len( pending ) > 2 * self.replay_workers:
+					(result, end) = pending.popleft()
+					yield (marshal.loads( result.get() ), end)
+			
+			while pending:
+				(result, end) = pending.popleft()
+				yield (marshal.loads( result.get() ), end)
+		finally:
+			pool.terminate()
+			pool.join()
+	
+	def _decode_binary( self, handle, offset, decoder, repair = True ):
+		# Yields (records, end offset) for the binary log from offset on,
+		# REPLAY_CHUNK bytes at a time. Names are interned in order, so
+		# binary logs are always decoded here, not in workers. As with JSON,
+		# a record cut short at the end of the log is dropped.
+		handle.seek( offset )
+		tail = ""
+		while True:
+			chunk = handle.read( REPLAY_CHUNK )
+			data = tail + chunk
+			records = []
+			pos = 0
+			while True:
+				result = BinaryLog.read_record( data, pos )
+				if result is None:
+					break
+				
+				(body, end, ok) = result
+				if not ok:
+					# Only the last record of the log may be damaged.
+					if end != len( data ):
+						raise IOError( "Log (%s) is corrupt at %i." % ( self.filename, offset + pos ) )
+					break
+				
+				command = decoder.decode( body )
+				if command is not None:
+					records.append( command )
+				pos = end
+			
+			offset += pos
+			tail = data[ pos: ]
+			if records:
+				yield (records, offset)
+			
+			if not chunk:
+				break
 		
-		with open( self.filename, 'rb' ) as handle:
-			for line in handle:
-				data = json.loads(line)
-				cmd = [data["op"]]
-				cmd.extend( data["params"] )
-				db.execute( qid, cmd )
+		if tail and repair:
+			handle.truncate( offset )
+	
+	def _read_records( self, handle, offset, names ):
+		# Yields (records, end offset) with records as (op, params).
+		if self.log_format == "binary":
+			decoder = BinaryLog.Decoder( names )
+			self.encoder = BinaryLog.Encoder( decoder.names )
+			for chunk in self._decode_binary( handle, offset, decoder ):
+				yield chunk
+			self.encoder = BinaryLog.Encoder( decoder.names )
+		else:
+			for chunk in self._decode( self._read_chunks( handle, offset ) ):
+				yield chunk
+	
+	def _replay( self, db, offset, names ):
+		# Applies the records to graph 0 directly instead of going through
+		# Hawthorn.execute; they were checked when they were saved. OFFSET
+		# is set here too, as a read-only server would refuse it.
+		graph = db.graphs[0]
+		qid = None
+		
+		started = time.time()
+		reported = started
+		count = 0
+		
+		with open( self.filename, 'rb+' ) as handle:
+			for (records, offset) in self._read_records( handle, offset, names ):
+				for (op, params) in records:
+					apply = REPLAY_COMMANDS.get( op )
+					if apply is not None:
+						apply( graph, params )
+					elif op == "OFFSET":
+						db.upstream = list( params )
+					elif op != "LOG":
+						if qid is None:
+							qid = db.start_query( 0 )
+						db.execute( qid, [op] + params )
+					
+					if op != "LOG":
+						self.sequence += 1
+				
+				count += len( records )
+				now = time.time()
+				if now - reported >= REPLAY_REPORT_INTERVAL:
+					print "Replaying %s: %i records (%.0f records/s).." % ( self.filename, count, count / ( now - started ) )
+					reported = now
+		
+		if qid is not None:
+			db.end_query( qid )
+		
+		if count:
+			elapsed = max( time.time() - started, 1e-6 )
+			print "Replayed %s: %i records in %.1f s (%.0f records/s)." % ( self.filename, count, elapsed, count / elapsed )
+	
+	def load( self, db ):
+		# Loading creates millions of objects and frees none; the cyclic
+		# garbage collector would keep rescanning all of them.
+		enabled = gc.isenabled()
+		gc.disable()
+		try:
+			self._load( db )
+		finally:
+			if enabled:
+				gc.enable()
 	
-		db.end_query( qid )
+	def _load( self, db ):
+		state = self._read_snapshot()
+		if state is not None:
+			for (db_id, graph_state) in state["graphs"].iteritems():
+				db.graphs[ db_id ].restore( graph_state )
+			self.snapshot_offset = state["offset"]
+			self.history = state.get( "history", "" )
+			self.sequence = state.get( "sequence", 0 )
+			db.upstream = state.get( "upstream", db.upstream )
+		
+		if not os.path.exists( self.filename ):
+			if state is not None:
+				self._start_log( state["log_id"] )
+			else:
+				# A new database starts a new history.
+				self.history = os.urandom( 8 ).encode( "hex" )
+			return
+		
+		(log_format, header, offset) = self._read_header()
+		if log_format is None:
+			os.remove( self.filename )
+			log_format = self.log_format
+			header = [None, None, 0]
+		
+		if log_format != self.log_format:
+			raise IOError( "Log (%s) is in %s format, not %s; convert it with convert_log.py." % ( self.filename, log_format, self.log_format ) )
+		
+		(log_id, history, base) = header[ :3 ]
+		
+		names = ()
+		if state is not None:
+			if log_id != state["log_id"]:
+				# A compaction stopped after writing its snapshot; everything
+				# in this log is already in the snapshot.
+				self._start_log( state["log_id"] )
+				return
+			offset = state["offset"]
+			names = state.get( "names", () )
+		else:
+			self.history = history
+			self.sequence = base
+		
+		if self.history is None:
+			self.history = os.urandom( 8 ).encode( "hex" )
+		
+		self.log_id = log_id
+		self.base = base
+		if os.path.exists( self.filename ):
+			self._replay( db, offset, names )
 	
 	def save( self, op, params ):
 		
@@ -60,7 +571,107 @@ class AppendLogStorage( HawthornStorage ):
 			return
 		
 		if not self.handle:
-			self.handle = open( self.filename, 'a' )
+			if not os.path.exists( self.filename ):
+				self._start_log( os.urandom( 8 ).encode( "hex" ) )
+			self.handle = open( self.filename, 'ab' )
 		
-		data = json.dumps( {"op": op, "params": params } )
-		self.handle.write( data  + "\r\n" )
+		self.handle.write( self._encode( op, params ) )
+		self.written += 1
+		self.sequence += 1
+	
+	def position( self ):
+		# Returns (history, sequence) with every change up to sequence
+		# written to the log file, so that read_after can find them.
+		if self.handle:
+			self.handle.flush()
+		return (self.history, self.sequence)
+	
+	def read_after( self, sequence, end ):
+		# Returns the changes after sequence up to end, see position(), as
+		# lists of (sequence, op, params), or None if the log no longer
+		# holds all of them. The log is read through a handle of its own;
+		# a compaction meanwhile replaces the file but not what the handle
+		# reads.
+		if not self.base <= sequence <= end or not os.path.exists( self.filename ):
+			return None
+		
+		offset = self._read_header()[2]
+		return self._read_after( open( self.filename, 'rb' ), offset, self.base, sequence, end )
+	
+	def _read_after( self, handle, offset, current, sequence, end ):
+		with handle:
+			if self.log_format == "binary":
+				chunks = self._decode_binary( handle, offset, BinaryLog.Decoder(), False )
+			else:
+				chunks = ((_decode_records( chunk ), end_offset) for (chunk, end_offset) in self._read_chunks( handle, offset, False ))
+			
+			for (records, end_offset) in chunks:
+				out = []
+				for (op, params) in records:
+					if op == "LOG":
+						continue
+					
+					current += 1
+					if current > end:
+						break
+					if current > sequence:
+						out.append( (current, op, params) )
+				
+				if out:
+					yield out
+				if current >= end:
+					return
+	
+	def snapshot( self, db ):
+		# The snapshot names the log it covers, so before the first change
+		# the log is started here rather than by save(), which would give
+		# it an id the snapshot doesn't know.
+		if not os.path.exists( self.filename ):
+			self._start_log( os.urandom( 8 ).encode( "hex" ) )
+		
+		offset = self._log_size()
+		if offset != self.snapshot_offset:
+			self._write_snapshot( db, self.log_id, offset, list( self.encoder.names ) )
+	
+	def convert( self, db, log_format ):
+		# Rewrites the log in log_format, see convert_log.py; the server
+		# must not be running. With a snapshot this is a compaction into
+		# the new format. Otherwise the records are rewritten one by one
+		# into a new file that then replaces the log.
+		if os.path.exists( self.snapshot_filename ):
+			if os.path.exists( self.filename ):
+				self.log_format = self._read_header()[0] or self.log_format
+			self.load( db )
+			self.log_format = log_format
+			self.compact( db )
+			return
+		
+		if not os.path.exists( self.filename ):
+			return
+		
+		(self.log_format, header, offset) = self._read_header()
+		if self.log_format is None:
+			return
+		
+		target = AppendLogStorage( self.filename, log_format = log_format )
+		(log_id, target.history, target.sequence) = header[ :3 ]
+		tmp_filename = self.filename + ".tmp"
+		with open( tmp_filename, 'wb' ) as out:
+			out.write( target._header( log_id or os.urandom( 8 ).encode( "hex" ) ) )
+			with open( self.filename, 'rb+' ) as handle:
+				for (records, end) in self._read_records( handle, offset, () ):
+					out.write( "".join( [target._encode( op, params ) for (op, params) in records if op != "LOG"] ) )
+			out.flush()
+			os.fsync( out.fileno() )
+		
+		os.rename( tmp_filename, self.filename )
+		_fsync_directory( self.filename )
+		self.log_format = log_format
+	
+	def compact( self, db ):
+		# The snapshot goes first: once it names the new log, the old log
+		# is ignored even if the new one never gets written.
+		log_id = os.urandom( 8 ).encode( "hex" )
+		self.sync()
+		self._write_snapshot( db, log_id, len( self._header( log_id ) ), [] )
+		self._start_log( log_id )
@@ -0,0 +1,724 @@
+#!/usr/bin/env python
+
+#
+#   Copyright 2013 Markus Gronholm <markus@alshain.fi> / Alshain Oy
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+#
+# Regression and behaviour tests.
+#
+# Usage: python -m unittest tests
+#
+
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from bench import _start_server
+from libs.HawthornProtocol import HawthornClient
+import libs.BinaryLog as BinaryLog
+import libs.RedisProtocol as RedisProtocol
+from libs.Hawthorn import (Graph, QueryEngine)
+
+
+class PropertyTests( unittest.TestCase ):
+	def test_prefix_with_mixed_types( self ):
+		# Integers reach the columns from RESP integers and log replay.
+		graph = Graph()
+		for node_id in [1, 2, 3]:
+			graph.create( node_id )
+		graph.set_property( 1, "code", 5 )
+		graph.set_property( 2, "code", "abc" )
+		graph.set_property( 3, "code", "xyz" )
+		
+		query = QueryEngine( graph )
+		self.assertEqual( query.find( "code", "a", "PREFIX", "found" ), (True, 1) )
+		self.assertEqual( list( query.querysets["found"] ), [2] )
+		
+		query.start( "all", [1, 2, 3] )
+		self.assertEqual( query.filter( "all", "filtered", "code", "a", "PREFIX" ), (True, 1) )
+		self.assertEqual( list( query.querysets["filtered"] ), [2] )
+		
+		graph.create_index( "code", "ORDERED" )
+		query.find( "code", "a", "PREFIX", "indexed" )
+		self.assertEqual( list( query.querysets["indexed"] ), [2] )
+	
+	def _equal_forms( self ):
+		graph = Graph()
+		for (node_id, value) in enumerate( ["5", "5.0", "05", " 5", "7", "9", "9.0"] ):
+			graph.create( node_id + 1 )
+			graph.set_property( node_id + 1, "v", value )
+		return graph
+	
+	def _find( self, graph, value, operator ):
+		query = QueryEngine( graph )
+		query.find( "v", value, operator, "found" )
+		return list( query.querysets["found"] )
+	
+	def test_index_agrees_with_scan( self ):
+		graph = self._equal_forms()
+		cases = [("5", "="), ("9.0", "="), (("5", "9"), "BETWEEN"), (("5.0", "9.0"), "BETWEEN"), (("5", "5.0"), "BETWEEN"), ("5", "<="), ("7", ">")]
+		scanned = [self._find( graph, value, operator ) for (value, operator) in cases]
+		self.assertEqual( scanned[0], [1] )
+		self.assertEqual( scanned[2], [1, 5, 6] )
+		
+		for kind in ["ORDERED", "HASH"]:
+			graph = self._equal_forms()
+			graph.create_index( "v", kind )
+			self.assertEqual( [self._find( graph, value, operator ) for (value, operator) in cases], scanned )
+	
+	def test_huge_numbers_in_ordered_index( self ):
+		graph = Graph()
+		graph.create( 1 )
+		graph.create_index( "v", "ORDERED" )
+		graph.set_property( 1, "v", 10 ** 400 )
+		self.assertEqual( self._find( graph, 10 ** 400, "=" ), [1] )
+	
+	def test_lazy_filter_on_new_property( self ):
+		# The property is set after the FILTER is planned but before the
+		# result is fetched.
+		graph = Graph()
+		for node_id in [1, 2, 3]:
+			graph.create( node_id )
+		
+		query = QueryEngine( graph )
+		query.set_lazy( True )
+		query.start( "all", [1, 2, 3] )
+		query.filter( "all", "filtered", "color", "red", "=" )
+		
+		graph.set_property( 2, "color", "red" )
+		self.assertEqual( list( query.fetch( "filtered" )[1] ), [2] )
+
+
+class EdgeTests( unittest.TestCase ):
+	def _targets( self, graph, node_id ):
+		return [edge["target"] for edge in graph.get_forward_edges( node_id )[1]]
+	
+	def test_edges_in_insertion_order( self ):
+		graph = Graph()
+		for node_id in range( 1, 101 ):
+			graph.create( node_id )
+		
+		targets = [50, 3, 99, 7, 20]
+		for target in targets:
+			graph.connect( 1, target, "link", "" )
+		
+		# Connecting again keeps the position, reconnecting moves to the end.
+		graph.connect( 1, 3, "link", "w" )
+		graph.disconnect( 1, 99, "link" )
+		graph.connect( 1, 99, "link", "" )
+		self.assertEqual( self._targets( graph, 1 ), [50, 3, 7, 20, 99] )
+		
+		for i in range( 1000 ):
+			graph.connect( 1, 7, "link", "" )
+			graph.disconnect( 1, 7, "link" )
+		self.assertEqual( self._targets( graph, 1 ), [50, 3, 20, 99] )
+		
+		version = graph.pin()
+		graph.connect( 1, 60, "link", "" )
+		clone = Graph()
+		clone.restore( graph.snapshot() )
+		self.assertEqual( self._targets( clone, 1 ), [50, 3, 20, 99, 60] )
+		self.assertEqual( sorted( version.get_forward_targets( [1], ["link"] ) ), [3, 20, 50, 99] )
+	
+	def test_weighted_path_cost( self ):
+		graph = Graph()
+		for node_id in [1, 2, 3]:
+			graph.create( node_id )
+		graph.connect( 1, 2, "road", "1234567" )
+		graph.connect( 2, 3, "road", "0.5" )
+		
+		self.assertEqual( graph.weighted_path( 1, 2, ["road"], 5 )[1]["cost"], "1234567" )
+		self.assertEqual( graph.weighted_path( 1, 3, ["road"], 5 )[1], {"cost": "1234567.5", "path": [1, 2, 3]} )
+	
+	def test_ids_beyond_array_range( self ):
+		graph = Graph()
+		big = 2 ** 64
+		for node_id in [1, 2, big]:
+			graph.create( node_id )
+		graph.connect( 1, 2, "link", "" )
+		graph.connect( 1, big, "link", "" )
+		graph.connect( big, 1, "link", "" )
+		self.assertEqual( self._targets( graph, 1 ), [2, big] )
+		self.assertEqual( self._targets( graph, big ), [1] )
+
+
+	def test_create_replaces_edges( self ):
+		graph = Graph()
+		for node_id in [1, 2]:
+			graph.create( node_id )
+		graph.connect( 1, 2, "a", "" )
+		graph.connect( 2, 1, "a", "" )
+		
+		graph.create( 2 )
+		self.assertEqual( graph.get_forward_edges( 1 ), (True, []) )
+		self.assertEqual( graph.get_backward_edges( 1 ), (True, []) )
+	
+	def test_restore_skips_edges_to_missing_nodes( self ):
+		graph = Graph()
+		for node_id in [1, 2, 3]:
+			graph.create( node_id )
+		graph.connect( 1, 2, "a", "" )
+		graph.connect( 1, 3, "a", "" )
+		
+		# As left behind by CREATE before it dropped the old edges.
+		state = graph.snapshot()
+		state["nodes"] = [1, 3]
+		
+		clone = Graph()
+		clone.restore( state )
+		self.assertEqual( self._targets( clone, 1 ), [3] )
+
+
+class QuerySetTests( unittest.TestCase ):
+	def _graph( self ):
+		random.seed( 5 )
+		graph = Graph()
+		for node_id in range( 1, 201 ):
+			graph.create( node_id )
+			graph.set_property( node_id, "color", random.choice( ["red", "green", "blue"] ) )
+		for i in range( 600 ):
+			graph.connect( random.randint( 1, 200 ), random.randint( 1, 200 ), random.choice( ["a", "b"] ), "" )
+		return graph
+	
+	def _fetch( self, query, name ):
+		return list( query.fetch( name )[1] )
+	
+	def test_set_operations( self ):
+		query = QueryEngine( Graph() )
+		query.start( "x", [9, 3, 7, 3, 1] )
+		query.start( "y", [7, 2, 9, 12] )
+		self.assertEqual( self._fetch( query, "x" ), [1, 3, 7, 9] )
+		
+		query.union( "x", "y", "union" )
+		query.intersection( "x", "y", "intersection" )
+		query.difference( "x", "y", "difference" )
+		query.append( "x", "y", "append" )
+		query.unique( "append", "unique" )
+		self.assertEqual( self._fetch( query, "union" ), [1, 2, 3, 7, 9, 12] )
+		self.assertEqual( self._fetch( query, "intersection" ), [7, 9] )
+		self.assertEqual( self._fetch( query, "difference" ), [1, 3] )
+		self.assertEqual( self._fetch( query, "append" ), [1, 2, 3, 7, 7, 9, 9, 12] )
+		self.assertEqual( self._fetch( query, "unique" ), [1, 2, 3, 7, 9, 12] )
+		self.assertEqual( query.count( "append" ), (True, 8) )
+	
+	def test_scan_pages( self ):
+		# Duplicates of an id stay on one page.
+		query = QueryEngine( Graph() )
+		query.start( "x", range( 1, 101 ) )
+		query.start( "y", range( 1, 101, 2 ) )
+		query.append( "x", "y", "both" )
+		
+		pages = []
+		cursor = 0
+		while True:
+			(cursor, page) = query.scan( "both", cursor, 7 )[1]
+			pages.append( list( page ) )
+			if cursor == 0:
+				break
+		self.assertEqual( sum( pages, [] ), self._fetch( query, "both" ) )
+		for (page, following) in zip( pages, pages[1:] ):
+			self.assertTrue( page[-1] < following[0] )
+	
+	def test_lazy_matches_eager( self ):
+		results = []
+		for lazy in [False, True]:
+			query = QueryEngine( self._graph() )
+			query.set_lazy( lazy )
+			query.start( "start", range( 1, 21 ) )
+			query.forward( "start", "near", ["a"] )
+			query.backward( "near", "back", ["a", "b"] )
+			query.filter( "back", "red", "color", "red", "=" )
+			query.intersection( "red", "start", "both" )
+			query.difference( "red", "start", "only" )
+			results.append( [self._fetch( query, name ) for name in ["near", "back", "red", "both", "only"]] )
+		self.assertEqual( results[0], results[1] )
+		self.assertTrue( results[0][2] )
+	
+	def test_pinned_version( self ):
+		graph = self._graph()
+		graph.connect( 1, 2, "c", "" )
+		graph.set_property( 2, "color", "red" )
+		graph.set_property( 3, "color", "blue" )
+		
+		query = QueryEngine( graph, isolated = True )
+		query.start( "one", [1] )
+		
+		# Writes made after the START are not visible until the next one.
+		graph.connect( 1, 3, "c", "" )
+		graph.set_property( 2, "color", "green" )
+		query.forward( "one", "next", ["c"] )
+		query.filter( "next", "red", "color", "red", "=" )
+		self.assertEqual( self._fetch( query, "next" ), [2] )
+		self.assertEqual( self._fetch( query, "red" ), [2] )
+		
+		query.start( "one", [1] )
+		query.forward( "one", "next", ["c"] )
+		query.filter( "next", "red", "color", "red", "=" )
+		self.assertEqual( self._fetch( query, "next" ), [2, 3] )
+		self.assertEqual( self._fetch( query, "red" ), [] )
+
+
+class CSRTests( unittest.TestCase ):
+	def _graph( self ):
+		# "common" edges start from every node, the other types from a few.
+		random.seed( 3 )
+		graph = Graph()
+		for node_id in range( 1, 301 ):
+			graph.create( node_id )
+		for node_id in range( 1, 301 ):
+			graph.connect( node_id, random.randint( 1, 300 ), "common", "" )
+		for i in range( 200 ):
+			graph.connect( random.randint( 1, 300 ), random.randint( 1, 300 ), "rare%i" % ( i % 7 ), "" )
+		return graph
+	
+	def test_matches_live_graph( self ):
+		graph = self._graph()
+		types = [["common"], ["rare1"], ["rare2", "common", "rare5"], ["missing"]]
+		sources = [range( 1, 301 ), [5, 17, 250], [999]]
+		
+		expected = []
+		for node_ids in sources:
+			for edge_types in types:
+				expected.append( graph.get_forward_targets( node_ids, edge_types ) )
+				expected.append( graph.get_backward_sources( node_ids, edge_types ) )
+		
+		graph.freeze()
+		self.assertTrue( graph.get_csr() is not None )
+		
+		result = []
+		for node_ids in sources:
+			for edge_types in types:
+				result.append( graph.get_forward_targets( node_ids, edge_types ) )
+				result.append( graph.get_backward_sources( node_ids, edge_types ) )
+		self.assertEqual( result, expected )
+	
+	def test_build_gives_up_when_edges_change( self ):
+		graph = self._graph()
+		for node_id in range( 301, 2001 ):
+			graph.create( node_id )
+		
+		graph.freeze( lambda: graph.connect( 1, 2, "late", "" ) )
+		self.assertTrue( graph.get_csr() is None )
+		
+		graph.freeze( lambda: None )
+		self.assertTrue( graph.get_csr() is not None )
+
+
+class BinaryLogTests( unittest.TestCase ):
+	def test_signed_and_huge_ids( self ):
+		ids = [0, 63, 64, -1, -64, -65, 2 ** 63 + 1, 2 ** 70, -2 ** 63, -2 ** 70]
+		commands = [
+			("CREATE", [-5]),
+			("MCREATE", ids),
+			("SET", [-1, "name", -7]),
+			("CONNECT", [-1, 2 ** 64, "link", "w"]),
+			("MCONNECT", [-2 ** 63, 2 ** 63, "link", "", 5, -5, "other", 3]),
+			("MDISCONNECT", [2 ** 70, -2 ** 70, "link"]),
+			]
+		
+		encoder = BinaryLog.Encoder()
+		data = "".join( [encoder.encode( op, params ) for (op, params) in commands] )
+		
+		decoder = BinaryLog.Decoder()
+		decoded = []
+		pos = 0
+		while pos < len( data ):
+			(body, pos, ok) = BinaryLog.read_record( data, pos )
+			self.assertTrue( ok )
+			command = decoder.decode( body )
+			if command is not None:
+				decoded.append( command )
+		self.assertEqual( decoded, commands )
+
+
+class PieceSocket( object ):
+	# Hands out data in pieces of the given sizes, in turn, and keeps what
+	# is sent.
+	def __init__( self, data, sizes ):
+		self.data = data
+		self.sizes = sizes
+		self.received = 0
+		self.reads = 0
+		self.sent = []
+	
+	def recv_into( self, view ):
+		size = min( self.sizes[ self.reads % len( self.sizes ) ], len( view ) )
+		piece = self.data[ self.received:self.received + size ]
+		view[ :len( piece ) ] = piece
+		self.received += len( piece )
+		self.reads += 1
+		return len( piece )
+	
+	def sendall( self, data ):
+		self.sent.append( data )
+
+
+class ProtocolTests( unittest.TestCase ):
+	def test_requests_split_anywhere( self ):
+		requests = [
+			["GET", "1"],
+			["SET", "1", "name", "two\r\nlines"],
+			["MCREATE"] + map( str, range( 100 ) ),
+			["MSET", "1", "a", "$3\r\nabc", "2", "b", "x" * 100000] + ["v"] * 40,
+			["START", "q", 1, 2, 3],
+			[["nested", 1], [], "end"],
+			[],
+			]
+		encoder = RedisProtocol.RedisProtocol( None )
+		data = "".join( ["".join( encoder.pack( request ) ) for request in requests] )
+		
+		for sizes in [[1], [7, 1, 3], [4096], [len( data )]]:
+			protocol = RedisProtocol.RedisProtocol( PieceSocket( data, sizes ) )
+			self.assertEqual( [protocol.receive() for request in requests], requests )
+			self.assertFalse( protocol.pending() )
+			self.assertEqual( protocol.receive(), False )
+	
+	def test_replies_held_until_flush( self ):
+		conn = PieceSocket( "", [1] )
+		protocol = RedisProtocol.RedisProtocol( conn )
+		protocol.send_response( [1, "a"], False )
+		protocol.send_error( "Failed.", False )
+		self.assertEqual( conn.sent, [] )
+		
+		protocol.send_response( "OK" )
+		self.assertEqual( conn.sent, ["*2\r\n:1\r\n$1\r\na\r\n-Failed.\r\n+OK\r\n"] )
+
+
+class RestartTests( unittest.TestCase ):
+	# Runs hawthorn.py with its log in a temporary directory.
+	def setUp( self ):
+		self.directory = tempfile.mkdtemp()
+		self.server = None
+	
+	def tearDown( self ):
+		self._stop()
+		shutil.rmtree( self.directory )
+	
+	def _start( self, settings = {} ):
+		(self.server, self.client) = _start_server( self.directory, settings )
+		return self.client
+	
+	def _stop( self ):
+		if self.server is not None:
+			self.client.close()
+			self.server.kill()
+			self.server.wait()
+			self.server = None
+	
+	def test_snapshot_before_first_write( self ):
+		client = self._start()
+		self.assertEqual( client.snapshot(), "OK" )
+		self.assertEqual( client.create( 1 ), "OK" )
+		self._stop()
+		
+		client = self._start()
+		self.assertEqual( client.get( 1 )["id"], 1 )
+	
+	def test_snapshot_after_node_replaced( self ):
+		client = self._start()
+		client.create( 1 )
+		client.create( 2 )
+		client.connect( 1, 2, "a", "" )
+		client.create( 2 )
+		self.assertEqual( client.delete( 2 ), "OK" )
+		self.assertEqual( client.snapshot(), "OK" )
+		self._stop()
+		
+		client = self._start()
+		self.assertEqual( client.get( 1 )["id"], 1 )
+		self.assertEqual( client.edges( 1 ), {"forward": [], "backward": []} )
+	
+	def _write( self, client, first ):
+		node_ids = range( first, first + 20 )
+		client.mcreate( node_ids )
+		client.mset( [(node_id, "name", "node%i" % node_id) for node_id in node_ids] )
+		client.mconnect( [(node_id, node_id + 1, "next", node_id) for node_id in node_ids[ :-1 ]] )
+		client.connect( first, first + 5, "skip", "" )
+		client.mdisconnect( [(first + 2, first + 3, "next")] )
+		client.unset( first + 4, "name" )
+		client.delete( first + 6 )
+		client.create( first + 7 )
+		client.set( first + 8, "name", "two\r\nlines" )
+	
+	def _state( self, client ):
+		return [(client.get( node_id ), client.edges( node_id )) for node_id in range( 1, 64 )] + [client.count( "named" )]
+	
+	def _round_trip( self, log_format ):
+		# The log is replayed on its own, after a snapshot, and after a
+		# compaction.
+		settings = {"database_format": log_format}
+		client = self._start( settings )
+		client.index( "name", "HASH" )
+		self._write( client, 1 )
+		
+		for (step, first) in [("SNAPSHOT", 21), ("COMPACT", 41), (None, None)]:
+			client.find( "named", "name", "node1", "=" )
+			state = self._state( client )
+			self._stop()
+			
+			client = self._start( settings )
+			client.find( "named", "name", "node1", "=" )
+			self.assertEqual( self._state( client ), state )
+			
+			if step is not None:
+				self.assertEqual( client._execute( [step] ), "OK" )
+				self._write( client, first )
+		
+		self.assertEqual( client.get( 47 ), False )
+		self.assertEqual( client.get( 49 )["properties"], {"name": "two\r\nlines"} )
+		self.assertEqual( len( client.edges( 41 )["forward"] ), 2 )
+	
+	def test_json_log_round_trip( self ):
+		self._round_trip( "json" )
+	
+	def test_binary_log_round_trip( self ):
+		self._round_trip( "binary" )
+	
+	def test_read_only_replica_refuses_clients( self ):
+		client = self._start( {"replica": {"read_only": True}} )
+		self.assertEqual( client._execute( ["UPSTREAM"] ), False )
+		self.assertEqual( client.create( 5000 ), False )
+		self._stop()
+		
+		client = self._start( {"replica": {"read_only": True, "upstreams": ["10.0.0.1"]}} )
+		self.assertEqual( client._execute( ["UPSTREAM"] ), False )
+		self.assertEqual( client.create( 5000 ), False )
+		self.assertEqual( client.get( 5000 ), False )
+	
+	def test_read_only_replica_keeps_offset( self ):
+		# Stands in for the primary, the way ReplicatedStorage does.
+		settings = {"replica": {"read_only": True, "upstreams": ["127.0.0.1"]}}
+		client = self._start( settings )
+		self.assertEqual( client._execute( ["UPSTREAM"] ), "OK" )
+		self.assertEqual( client.create( 1 ), "OK" )
+		self.assertEqual( client._execute( ["OFFSET", "history", 7] ), "OK" )
+		self._stop()
+		
+		client = self._start( settings )
+		self.assertEqual( client.offset(), ["history", 7] )
+		self.assertEqual( client.get( 1 )["id"], 1 )
+
+
+class CommandTests( unittest.TestCase ):
+	# Commands sent to hawthorn.py running with its log in a temporary
+	# directory.
+	def setUp( self ):
+		self.directory = tempfile.mkdtemp()
+		(self.server, self.client) = _start_server( self.directory )
+	
+	def tearDown( self ):
+		self.client.close()
+		self.server.kill()
+		self.server.wait()
+		shutil.rmtree( self.directory )
+	
+	def test_pipeline( self ):
+		client = self.client
+		with client.pipeline() as pipe:
+			for node_id in range( 1, 3001 ):
+				pipe.create( node_id )
+				pipe.set( node_id, "name", "x" * ( node_id % 50 ) )
+			pipe.get( 5000 )
+			pipe.get( 7 )
+		
+		self.assertEqual( pipe.results[ :6000 ], ["OK"] * 6000 )
+		self.assertEqual( pipe.results[ 6000: ], [False, {"id": 7, "properties": {"name": "x" * 7}}] )
+		self.assertEqual( client.get( 3000 )["id"], 3000 )
+	
+	def test_batch_commands( self ):
+		# The batch commands leave the graph as the single commands do.
+		one = self.client
+		batch = HawthornClient( "127.0.0.1", one.port )
+		
+		for node_id in range( 1, 11 ):
+			one.create( node_id )
+			one.set( node_id, "n", str( node_id ) )
+		for node_id in range( 1, 10 ):
+			one.connect( node_id, node_id + 1, "a", "w" )
+		one.disconnect( 4, 5, "a" )
+		state = [(one.get( node_id ), one.edges( node_id )) for node_id in range( 1, 11 )]
+		
+		for node_id in range( 1, 11 ):
+			one.delete( node_id )
+		self.assertEqual( batch.mcreate( range( 1, 11 ) ), 10 )
+		self.assertEqual( batch.mset( [(node_id, "n", node_id) for node_id in range( 1, 11 )] ), 10 )
+		self.assertEqual( batch.mconnect( [(node_id, node_id + 1, "a", "w") for node_id in range( 1, 10 )] ), 9 )
+		self.assertEqual( batch.mdisconnect( [(4, 5, "a")] ), 1 )
+		self.assertEqual( [(one.get( node_id ), one.edges( node_id )) for node_id in range( 1, 11 )], state )
+		
+		# A batch with a missing node changes nothing.
+		self.assertEqual( batch.mconnect( [(1, 3, "b", ""), (1, 99, "b", "")] ), False )
+		self.assertEqual( one.edges( 1 ), state[0][1] )
+		batch.close()
+	
+	def test_query_matches_steps( self ):
+		client = self.client
+		client.mcreate( range( 1, 21 ) )
+		client.mconnect( [(node_id, node_id % 20 + 1, "a", "") for node_id in range( 1, 21 )] )
+		client.mconnect( [(node_id, ( node_id * 7 ) % 20 + 1, "b", "") for node_id in range( 1, 21 )] )
+		
+		steps = [["START", "me", 1, 2, 3], ["FORWARD", "near", "me", "a"], ["FORWARD", "far", "near", "a", "b"], ["DIFFERENCE", "far", "far", "me"]]
+		result = client.query( ["near", "far"], steps )
+		
+		for step in steps:
+			client._execute( step )
+		self.assertEqual( result, {"near": client.fetch( "near" ), "far": client.fetch( "far" )} )
+		self.assertEqual( result["near"], [2, 3, 4] )
+	
+	def test_scan( self ):
+		client = self.client
+		client.mcreate( range( 1, 2501 ) )
+		client.start( "all", range( 1, 2501 ) )
+		self.assertEqual( client.count( "all" ), 2500 )
+		self.assertEqual( list( client.scan_iter( "all", 100 ) ), range( 1, 2501 ) )
+		self.assertEqual( client.scan( "all", 2400, 1000 ), [0, range( 2400, 2501 )] )
+		self.assertEqual( client.fetch( "all", 10, 3 ), [11, 12, 13] )
+		self.assertEqual( client.scan( "missing" ), False )
+	
+	def test_failed_query_keeps_existing_querysets( self ):
+		client = self.client
+		for node_id in [1, 2]:
+			client.create( node_id )
+		client.start( "mine", [1] )
+		
+		# The third step fails, so the fourth never replaces mine.
+		script = "START tmp 1 ; FORWARD out tmp knows ; FORWARD res missing knows ; START mine 2".split( " " )
+		self.assertEqual( client._execute( ["QUERY", "res"] + script ), False )
+		self.assertEqual( client.fetch( "mine" ), [1] )
+		self.assertEqual( client.fetch( "tmp" ), False )
+		self.assertEqual( client.fetch( "out" ), False )
+
+
+class ReplicationTests( unittest.TestCase ):
+	# A primary and a replica, each running hawthorn.py with its log in a
+	# temporary directory.
+	def setUp( self ):
+		self.servers = []
+		self.replica_directory = tempfile.mkdtemp()
+		self.primary_directory = tempfile.mkdtemp()
+	
+	def tearDown( self ):
+		for (server, client) in self.servers:
+			client.close()
+			server.kill()
+			server.wait()
+		shutil.rmtree( self.replica_directory )
+		shutil.rmtree( self.primary_directory )
+	
+	def _start( self, directory, settings = {} ):
+		(server, client) = _start_server( directory, settings )
+		self.servers.append( (server, client) )
+		return client
+	
+	def _caught_up( self, primary ):
+		for i in range( 200 ):
+			status = primary.replication()[0]
+			if status["state"] == "connected" and status["queued"] == 0:
+				return status
+			time.sleep( 0.05 )
+		self.fail( "Replica did not catch up (%s)." % status )
+	
+	def test_resync_after_node_replaced( self ):
+		primary = self._start( self.primary_directory )
+		for node_id in [1, 2, 3]:
+			primary.create( node_id )
+		primary.connect( 1, 2, "a", "" )
+		primary.connect( 1, 3, "a", "" )
+		primary.create( 2 )
+		primary.delete( 2 )
+		
+		replica = self._start( self.replica_directory )
+		primary.add_replica( "127.0.0.1:%i" % replica.port )
+		status = self._caught_up( primary )
+		
+		# The new replica is brought up to date from a dump.
+		self.assertEqual( status["syncs"], 1 )
+		self.assertEqual( status["errors"], 0 )
+		self.assertEqual( [edge["target"] for edge in replica.edges( 1 )["forward"]], [3] )
+		self.assertEqual( replica.get( 2 ), False )
+	
+	def test_catch_up_from_log( self ):
+		primary = self._start( self.primary_directory )
+		primary.mcreate( range( 1, 101 ) )
+		replica = self._start( self.replica_directory )
+		port = replica.port
+		primary.add_replica( "127.0.0.1:%i" % port )
+		self._caught_up( primary )
+		
+		# The replica is down while the primary keeps changing; its log is
+		# given time to reach the disk first.
+		time.sleep( 0.5 )
+		(server, client) = self.servers.pop()
+		client.close()
+		server.kill()
+		server.wait()
+		primary.mset( [(node_id, "name", "node%i" % node_id) for node_id in range( 1, 101 )] )
+		primary.connect( 1, 2, "a", "" )
+		primary.delete( 3 )
+		
+		replica = self._start( self.replica_directory, {"port": port} )
+		for i in range( 200 ):
+			if replica.offset() == primary.position():
+				break
+			time.sleep( 0.05 )
+		self.assertEqual( replica.offset(), primary.position() )
+		status = self._caught_up( primary )
+		self.assertEqual( status["syncs"], 1 )
+		self.assertEqual( status["errors"], 0 )
+		for node_id in [1, 2, 3, 100]:
+			self.assertEqual( replica.get( node_id ), primary.get( node_id ) )
+		self.assertEqual( replica.edges( 1 ), primary.edges( 1 ) )
+	
+	def test_reads_do_not_wait_for_a_stalled_replica( self ):
+		primary = self._start( self.primary_directory, {"replication": {"hosts": [], "queue_size": 10, "batch_size": 1}} )
+		replica = self._start( self.replica_directory )
+		primary.add_replica( "127.0.0.1:%i" % replica.port )
+		self._caught_up( primary )
+		
+		# The writer blocks once the stopped replica's queue is full.
+		self.servers[-1][0].send_signal( signal.SIGSTOP )
+		try:
+			writer = HawthornClient( "127.0.0.1", primary.port )
+			def write():
+				try:
+					for node_id in range( 100 ):
+						writer.create( node_id )
+				except (socket.error, IOError):
+					pass
+			thread = threading.Thread( target = write )
+			thread.daemon = True
+			thread.start()
+			
+			# Replies to the reader would hang without its timeout.
+			primary.conn.settimeout( 5.0 )
+			for i in range( 200 ):
+				if primary.replication()[0]["queued"] >= 10:
+					break
+				time.sleep( 0.05 )
+			self.assertTrue( thread.is_alive() )
+			
+			# Node 1 is created before the queue fills up.
+			self.assertEqual( primary.get( 1 ), {"id": 1, "properties": []} )
+		finally:
+			self.servers[-1][0].send_signal( signal.SIGCONT )
+
+
+if __name__ == "__main__":
+	unittest.main()